@@ -0,0 +1,90 @@
+#!/usr/bin/python
+
+import logging
+import os
+import time
+import tempfile
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from academics.utils import fmpxmlparser
+from academics.utils.fmpxmlwriter import write_export, format_date
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = "Time the full and lean FileMaker XML parse modes against a synthetic export"
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000, help='The number of rows in the synthetic export')
+        parser.add_argument('--date-format', default='yyyy-mm-dd', help='The DATEFORMAT of the synthetic export')
+    
+    def handle(self, *args, **kwargs):
+        row_count = kwargs['rows']
+        date_format = kwargs['date_format']
+        
+        fields = [
+            ('IDStudent', 'TEXT'),
+            ('NameFirst', 'TEXT'),
+            ('NameLast', 'TEXT'),
+            ('AcademicYear', 'TEXT'),
+            ('Grade', 'NUMBER'),
+            ('Division', 'TEXT'),
+            ('DormName', 'TEXT'),
+            ('IDAdvisor', 'TEXT'),
+            ('StatusEnrollment', 'TEXT'),
+            ('EnrollmentDate', 'DATE'),
+        ]
+        
+        def rows():
+            for i in range(row_count):
+                enrolled = date(2010, 9, 1) + timedelta(days=i % 365)
+                
+                yield (i + 1, [
+                    "ST{:05d}".format(i),
+                    "First{}".format(i),
+                    "Last{}".format(i),
+                    "2015-2016",
+                    str(5 + i % 5),
+                    "MS",
+                    i % 3 and "Dorm {}".format(i % 7) or None,
+                    "T{:03d}".format(i % 200),
+                    "Enrolled",
+                    format_date(enrolled, date_format),
+                ])
+        
+        handle, path = tempfile.mkstemp(suffix='.xml')
+        
+        try:
+            with os.fdopen(handle, 'w', encoding='utf-8') as f:
+                write_export(f, fields, rows(), database_name="ksEnrollment.fmp12", date_format=date_format)
+            
+            self.stdout.write("Synthetic export: {rows:} rows, {size:.1f} MB".format(rows=row_count, size=os.path.getsize(path) / 1024 / 1024))
+            
+            modes = [
+                ('parse_from_file', lambda: fmpxmlparser.parse_from_file(path)['results']),
+                ('parse_from_file lean', lambda: fmpxmlparser.parse_from_file(path, lean=True)['results']),
+                ('iter_rows', lambda: fmpxmlparser.iter_rows(path)),
+                ('iter_rows lean', lambda: fmpxmlparser.iter_rows(path, lean=True)),
+                ('iter_rows_parallel', lambda: fmpxmlparser.iter_rows_parallel(path, chunk_size=256 * 1024)),
+                ('parse_columnar', lambda: fmpxmlparser.parse_columnar(path)['RECORDID']),
+                ('parse_columnar 3 fields', lambda: fmpxmlparser.parse_columnar(path, fields=['IDStudent', 'AcademicYear', 'Grade'])['RECORDID']),
+            ]
+            
+            for label, parse in modes:
+                start = time.perf_counter()
+                
+                parsed_count = 0
+                for row in parse():
+                    parsed_count += 1
+                
+                elapsed = time.perf_counter() - start
+                
+                if parsed_count != row_count:
+                    raise CommandError("{label:} returned {parsed:} rows, expected {expected:}".format(label=label, parsed=parsed_count, expected=row_count))
+                
+                self.stdout.write("{label:<24}{elapsed:>8.2f}s {rate:>12,.0f} rows/s".format(label=label, elapsed=elapsed, rate=parsed_count / elapsed))
+        
+        finally:
+            os.remove(path)
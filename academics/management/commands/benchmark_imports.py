@@ -0,0 +1,125 @@
+#!/usr/bin/python
+
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import traceback
+from io import StringIO
+
+from django.apps import apps
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, DEFAULT_DB_ALIAS
+
+from academics.utils.synthetic import write_exports, DATE_FORMATS
+from academics.utils.instrumentation import instrumented
+from academics.management.commands.sync_keystone import STAGES
+
+logger = logging.getLogger(__name__)
+
+#The order sync_keystone applies the imports in, so families find the students permrecs created
+IMPORT_COMMANDS = tuple(command_name for stage, command_name in STAGES)
+
+def peak_rss():
+    #ru_maxrss is in kilobytes on Linux and in bytes on OS X
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    if sys.platform == 'darwin':
+        return peak
+    
+    return peak * 1024
+
+def use_sqlite(path):
+    #Point the default connection at a scratch SQLite database so the benchmark never touches real data
+    connections.close_all()
+    connections.databases[DEFAULT_DB_ALIAS] = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': path}
+    
+    del connections[DEFAULT_DB_ALIAS]
+
+def create_schema():
+    #The migrations expect existing data, so build the tables straight from the models
+    with connection.schema_editor() as editor:
+        for model in apps.get_models():
+            if model._meta.managed and not model._meta.proxy and not model._meta.swapped:
+                editor.create_model(model)
+
+def run_import(command_name, path, options, results):
+    #Runs in a forked child so the peak RSS belongs to this import alone
+    try:
+        with instrumented(command_name) as measurement:
+            call_command(command_name, path, stdout=StringIO(), **options)
+        
+        results.send((measurement.wall_time, measurement.queries, measurement.db_time, peak_rss(), None))
+    
+    except Exception:
+        results.send((None, None, None, None, traceback.format_exc()))
+    
+    finally:
+        connections.close_all()
+
+class Command(BaseCommand):
+    help = "Time every import command end to end against synthetic Keystone exports on SQLite"
+    
+    def add_arguments(self, parser):
+        parser.add_argument('--students', type=int, default=1000, help='The number of students, enrollments, families and permrecs')
+        parser.add_argument('--sections', type=int, default=200, help='The number of sections; teachers and courses scale with it')
+        parser.add_argument('--registrations', type=int, default=None, help='The number of student registrations; six per student by default')
+        parser.add_argument('--date-format', default='yyyy-mm-dd', choices=DATE_FORMATS, help='The DATEFORMAT of the synthetic exports')
+        parser.add_argument('--passes', type=int, default=2, help='How many times to run the imports; passes after the first re-import unchanged exports')
+        parser.add_argument('--full', action='store_true', default=False, help='Pass --full to the imports so unchanged rows are not skipped')
+        parser.add_argument('--keep', metavar='DIRECTORY', default=None, help='Write the exports and database to this directory and leave them there')
+    
+    def handle(self, *args, **kwargs):
+        directory = kwargs['keep'] or tempfile.mkdtemp(prefix='benchmark_imports')
+        os.makedirs(directory, exist_ok=True)
+        
+        try:
+            exports = write_exports(directory, students=kwargs['students'], sections=kwargs['sections'], registrations=kwargs['registrations'], date_format=kwargs['date_format'])
+            
+            database_path = os.path.join(directory, 'benchmark.sqlite3')
+            
+            if os.path.exists(database_path):
+                os.remove(database_path)
+            
+            use_sqlite(database_path)
+            create_schema()
+            
+            #The imports run in forked children, which must not share the parent's connection
+            connections.close_all()
+            
+            context = multiprocessing.get_context('fork')
+            
+            for pass_number in range(1, kwargs['passes'] + 1):
+                self.stdout.write("Pass {pass_number:}".format(pass_number=pass_number))
+                self.stdout.write("{command:<22}{rows:>9}{time:>10}{rate:>12}{queries:>10}{db_time:>10}{rss:>11}".format(command="command", rows="rows", time="time", rate="rows/s", queries="queries", db_time="db time", rss="peak RSS"))
+                
+                for command_name in IMPORT_COMMANDS:
+                    path, row_count = exports[command_name]
+                    
+                    receive, send = context.Pipe(duplex=False)
+                    process = context.Process(target=run_import, args=(command_name, path, {'full': kwargs['full']}, send))
+                    process.start()
+                    
+                    #Close this end so a child that dies without reporting raises EOFError here instead of hanging
+                    send.close()
+                    
+                    try:
+                        elapsed, query_count, query_time, rss, error = receive.recv()
+                    except EOFError:
+                        raise CommandError("{command:} exited with code {code:}".format(command=command_name, code=process.exitcode))
+                    finally:
+                        process.join()
+                    
+                    if error:
+                        raise CommandError("{command:} failed:\n{error:}".format(command=command_name, error=error))
+                    
+                    logger.info("{command:} pass {pass_number:}: {rows:} rows in {time:.2f}s, {queries:} queries".format(command=command_name, pass_number=pass_number, rows=row_count, time=elapsed, queries=query_count))
+                    self.stdout.write("{command:<22}{rows:>9}{time:>9.2f}s{rate:>12,.0f}{queries:>10}{db_time:>9.2f}s{rss:>8.1f} MB".format(command=command_name, rows=row_count, time=elapsed, rate=row_count / elapsed, queries=query_count, db_time=query_time, rss=rss / 1024 / 1024))
+        
+        finally:
+            if not kwargs['keep']:
+                shutil.rmtree(directory)
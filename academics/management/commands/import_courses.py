@@ -4,80 +4,71 @@ import logging
 from datetime import date
 
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
 
 from validate_email import validate_email
 
 from academics.models import Course
 from academics.utils import fmpxmlparser
+from academics.utils.checksums import RowChecksums
+from academics.utils.bulksync import BulkSync, SharedLookups, sync_transaction
+from academics.utils.instrumentation import InstrumentedCommand, counted
 
 logger = logging.getLogger(__name__)
 
-class Command(BaseCommand):
+class Command(InstrumentedCommand):
     help = "Import Courses"
     
     def add_arguments(self, parser):
         parser.add_argument('filename', metavar='FILENAME', help='The filename to process the courses from')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False, help='Run the import and log what it would change, then roll the whole import back')
+        parser.add_argument('--full', action='store_true', default=False, help='Resync every row, including the rows that have not changed since the last import')
+        parser.add_argument('--workers', type=int, default=1, help='Decode the export in this many processes, for very large exports')
     
     def handle(self, *args, **kwargs):
         logger.info("Beginning course import routine")
         
-        data = fmpxmlparser.parse_from_file(kwargs['filename'])
-
-        results = data['results']    
+        results = fmpxmlparser.iter_rows_parallel(kwargs['filename'], max_workers=kwargs['workers'])
+        
+        with sync_transaction(dry_run=kwargs['dry_run']):
+            self.sync(results, SharedLookups(), dry_run=kwargs['dry_run'], full=kwargs['full'])
+    
+    def sync(self, results, lookups, dry_run=False, full=False):
+        courses = BulkSync(Course, 'number')
+        checksums = RowChecksums('courses', full=full)
+        
+        for fields in counted(results):
+            course_number = fields['CourseNumber']
+            course_name = fields['CourseName'] or ""
+            course_name_short = fields["CourseNameShort"] or ""
+            course_name_transcript = fields["CourseNameTranscript"] or ""
+            division = fields["Division"] or ""
+            grade_level = fields["GradeLevel"] or ""
+            department = fields["DepartmentName"] or ""
+            course_type = fields["CourseType"] or ""
+            
+            if not course_number:
+                continue
+            
+            if checksums.unchanged(course_number, fields, exists=(course_number, ) in courses):
+                courses.mark_seen(course_number)
+                continue
+            
+            attrMap = {
+                'course_name': course_name,
+                'course_name_short': course_name_short,
+                'course_name_transcript': course_name_transcript,
+                'division': division,
+                'grade_level': grade_level,
+                'department': department,
+                'course_type': course_type,
+            }
+            
+            courses.sync({'number': course_number}, attrMap, label=course_number)
+            checksums.synced(course_number)
+        
+        courses.write()
         
-        seen_ids = set()
+        courses.delete_stale(dry_run=dry_run)
+        checksums.write(dry_run=dry_run)
         
-        with transaction.atomic():
-            for row in results:
-                fields = row['parsed_fields']
-                
-                course_number = fields['CourseNumber']
-                course_name = fields['CourseName'] or ""
-                course_name_short = fields["CourseNameShort"] or ""
-                course_name_transcript = fields["CourseNameTranscript"] or ""
-                division = fields["Division"] or ""
-                grade_level = fields["GradeLevel"] or ""
-                department = fields["DepartmentName"] or ""
-                course_type = fields["CourseType"] or ""
-                
-                if not course_number:
-                    continue
-                
-                seen_ids.add(course_number)
-                
-                try:
-                    course = Course.objects.get(number=course_number)
-                    logger.info("Found course {number:}".format(number=course_number))
-                    forceSave = False
-                    
-                except Course.DoesNotExist:
-                    course = Course(number=course_number)
-                    logger.info("Creating course {number:}".format(number=course_number))
-                    forceSave = True
-                    
-                attrMap = {
-                    'course_name': course_name,
-                    'course_name_short': course_name_short,
-                    'course_name_transcript': course_name_transcript,
-                    'division': division,
-                    'grade_level': grade_level,
-                    'department': department,
-                    'course_type': course_type,
-                }
-                
-                for attr in attrMap:
-                    dbValue = getattr(course, attr)
-                    
-                    if dbValue != attrMap[attr]:
-                        setattr(course, attr, attrMap[attr])
-                        logger.info("Updating {attr:} on {course:} from {oldValue:} to {newValue:}".format(attr=attr, course=course_number, oldValue=dbValue, newValue=attrMap[attr]))
-                        forceSave = True
-                    
-                if forceSave:
-                    course.save()
-                    
-            extra_courses = Course.objects.exclude(number__in=seen_ids)
-            for extra_course in extra_courses:
-                logger.warn("Deleting extra course {}".format(extra_course.id))
-                extra_course.delete()
\ No newline at end of file
+        lookups.publish('courses', courses)
\ No newline at end of file
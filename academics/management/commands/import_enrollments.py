@@ -4,126 +4,128 @@ import logging
 from datetime import date
 
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
 
 from validate_email import validate_email
 
 from academics.models import Student, Enrollment, AcademicYear, Dorm, Teacher, Grade
 from academics.utils import fmpxmlparser
+from academics.utils.checksums import RowChecksums
+from academics.utils.bulksync import BulkSync, SharedLookups, sync_transaction
+from academics.utils.instrumentation import InstrumentedCommand, counted
 
 logger = logging.getLogger(__name__)
 
-class Command(BaseCommand):
+class Command(InstrumentedCommand):
     help = "Import Enrollments"
     
     def add_arguments(self, parser):
         parser.add_argument('filename', metavar='FILENAME', help='The filename to process the enrollments from')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False, help='Run the import and log what it would change, then roll the whole import back')
+        parser.add_argument('--full', action='store_true', default=False, help='Resync every row, including the rows that have not changed since the last import')
+        parser.add_argument('--workers', type=int, default=1, help='Decode the export in this many processes, for very large exports')
     
     def handle(self, *args, **kwargs):
         logger.info("Beginning enrollment import routine")
         
-        data = fmpxmlparser.parse_from_file(kwargs['filename'])
-
-        results = data['results']    
+        results = fmpxmlparser.iter_rows_parallel(kwargs['filename'], max_workers=kwargs['workers'])
         
-        with transaction.atomic():
-            for row in results:
-                fields = row['parsed_fields']
-                
-                studentID = fields['IDStudent']
-                academicYear = fields['AcademicYear']
-                boarderDay = fields['BoarderDay']
-                dormName = fields['DormName'] or ""
-                grade_code = fields['Grade']
-                division = fields['Division'] or ""
-                section = fields["Section Letter"] or ""
-                advisorID = fields["IDAdvisor"]
-                statusEnrollment = fields["StatusEnrollment"] or ""
-                statusAttending = fields["StatusAttending"] or ""
-                enrolledDate = fields["EnrollmentDate"]
-                
-                if not studentID or not academicYear:
-                    continue
-                
-                try:
-                    academicYear = AcademicYear.objects.get(year=academicYear)
-                except AcademicYear.DoesNotExist:
-                    academicYear = AcademicYear(year=academicYear)
-                    academicYear.save()
-                
-                
-                try:
-                    student = Student.objects.get(student_id=studentID)
-                except Student.DoesNotExist:
-                    logger.error("Student {studentID:} is in enrollments but not in permrecs".format(studentID=studentID))
-                    continue
-                
-                if boarderDay and boarderDay.upper() == "B":
-                    boarder = True
-                else:
-                    boarder = False
-                
-                if dormName:
-                    try:
-                        dorm = Dorm.objects.get(dorm_name=dormName)
-                    except Dorm.DoesNotExist:
-                        logger.error("Dorm {dorm:} does not exist".format(dorm=dormName))
-                        dorm = None
-                else:
-                    dorm = None
-                
-                
-                if advisorID:
-                    try:
-                        advisor = Teacher.objects.get(teacher_id = advisorID)
-                    except Teacher.DoesNotExist:
-                        logger.error("Advisor {advisorID:} does not exist".format(advisorID=advisorID))
-                        advisor = None
-                else:
-                    advisor = None
-                
-                if grade_code:
-                  try:
-                    grade = Grade.objects.get(grade=grade_code)
-                  except Grade.DoesNotExist:
-                    grade = Grade()
-                    grade.grade = grade_code
-                    grade.description = "Grade {grade:}".format(grade=grade_code)
-                    grade.save()
+        with sync_transaction(dry_run=kwargs['dry_run']):
+            self.sync(results, SharedLookups(), dry_run=kwargs['dry_run'], full=kwargs['full'])
+    
+    def sync(self, results, lookups, dry_run=False, full=False):
+        academic_years = lookups.table('academic_years', AcademicYear.objects.all(), 'year', create=lambda year: AcademicYear(year=year))
+        students = lookups.table('students', Student.objects.all(), 'student_id')
+        dorms = lookups.table('dorms', Dorm.objects.all(), 'dorm_name')
+        advisors = lookups.table('teachers', Teacher.objects.all(), 'teacher_id')
+        grades = lookups.table('grades', Grade.objects.all(), 'grade', create=lambda grade_code: Grade(grade=grade_code, description="Grade {grade:}".format(grade=grade_code)))
+        
+        enrollments = BulkSync(Enrollment, ('student_id', 'academic_year_id'))
+        checksums = RowChecksums('enrollments', full=full)
+        seen_academic_year_ids = set()
+        
+        for fields in counted(results):
+            studentID = fields['IDStudent']
+            academicYear = fields['AcademicYear']
+            boarderDay = fields['BoarderDay']
+            dormName = fields['DormName'] or ""
+            grade_code = fields['Grade']
+            division = fields['Division'] or ""
+            section = fields["Section Letter"] or ""
+            advisorID = fields["IDAdvisor"]
+            statusEnrollment = fields["StatusEnrollment"] or ""
+            statusAttending = fields["StatusAttending"] or ""
+            enrolledDate = fields["EnrollmentDate"]
+            
+            if not studentID or not academicYear:
+                continue
+            
+            academicYear = academic_years.get(academicYear)
+            seen_academic_year_ids.add(academicYear.id)
+            
+            student = students.get(studentID)
+            
+            if not student:
+                logger.error("Student {studentID:} is in enrollments but not in permrecs".format(studentID=studentID))
+                continue
+            
+            if checksums.unchanged((studentID, academicYear.year), fields, exists=(student.id, academicYear.id) in enrollments):
+                enrollments.mark_seen(student.id, academicYear.id)
+                continue
+            
+            if boarderDay and boarderDay.upper() == "B":
+                boarder = True
+            else:
+                boarder = False
+            
+            lookup_failed = False
+            
+            if dormName:
+                dorm = dorms.get(dormName)
                 
-                try:
-                    enrollment = Enrollment.objects.get(student = student, academic_year = academicYear)
-                    logger.info("Found enrollment {studentID:}/{academicYear:}".format(studentID=studentID, academicYear=academicYear))
-                    forceSave = False
-                    
-                except Enrollment.DoesNotExist:
-                    logger.info("Creating enrollment {studentID:}/{academicYear:}".format(studentID=studentID, academicYear=academicYear))
-                    enrollment = Enrollment()
-                    enrollment.student = student
-                    enrollment.academic_year = academicYear
-                    forceSave = True
-                                        
-                attrMap = {
-                    'boarder': boarder,
-                    'dorm': dorm,
-                    'grade': grade,
-                    'division': division,
-                    'section': section,
-                    'advisor': advisor,
-                    'status_enrollment': statusEnrollment,
-                    'status_attending': statusAttending,
-                    'enrolled_date': enrolledDate
-                }
+                if not dorm:
+                    logger.error("Dorm {dorm:} does not exist".format(dorm=dormName))
+                    lookup_failed = True
+            else:
+                dorm = None
+            
+            
+            if advisorID:
+                advisor = advisors.get(advisorID)
                 
-                for attr in attrMap:
-                    dbValue = getattr(enrollment, attr)
-                    
-                    if dbValue != attrMap[attr]:
-                        setattr(enrollment, attr, attrMap[attr])
-                        logger.info("Updating {attr:} on {studentID:}/{academicYear:} from {oldValue:} to {newValue:}".format(attr=attr, studentID=studentID, academicYear=academicYear, oldValue=dbValue, newValue=attrMap[attr]))
-                        forceSave = True
-                    
-                if forceSave:
-                    enrollment.save()
-
-            #TODO: Delete the extra records
+                if not advisor:
+                    logger.error("Advisor {advisorID:} does not exist".format(advisorID=advisorID))
+                    lookup_failed = True
+            else:
+                advisor = None
+            
+            if grade_code:
+                grade = grades.get(str(grade_code))
+            else:
+                grade = None
+            
+            attrMap = {
+                'boarder': boarder,
+                'dorm': dorm,
+                'grade': grade,
+                'division': division,
+                'section': section,
+                'advisor': advisor,
+                'status_enrollment': statusEnrollment,
+                'status_attending': statusAttending,
+                'enrolled_date': enrolledDate
+            }
+            
+            label = "{studentID:}/{academicYear:}".format(studentID=studentID, academicYear=academicYear)
+            enrollments.sync({'student_id': student.id, 'academic_year_id': academicYear.id}, attrMap, label=label)
+            
+            #A missing dorm or advisor was saved as None; retry the row once it exists
+            if lookup_failed:
+                checksums.failed((studentID, academicYear.year))
+            else:
+                checksums.synced((studentID, academicYear.year))
+        
+        enrollments.write()
+        
+        #Only reconcile the years in the export; older years are not exported again
+        enrollments.delete_stale(dry_run=dry_run, within=lambda enrollment: enrollment.academic_year_id in seen_academic_year_ids)
+        checksums.write(dry_run=dry_run)
@@ -4,97 +4,93 @@ import logging
 from datetime import date
 
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
 
 from validate_email import validate_email
 
 from academics.models import Parent
 from academics.utils import fmpxmlparser
+from academics.utils.checksums import RowChecksums
+from academics.utils.bulksync import BulkSync, SharedLookups, sync_transaction
+from academics.utils.instrumentation import InstrumentedCommand, counted
 
 logger = logging.getLogger(__name__)
 
-class Command(BaseCommand):
+class Command(InstrumentedCommand):
     help = "Import Permrecs"
     
     def add_arguments(self, parser):
         parser.add_argument('filename', metavar='FILENAME', help='The filename to process the families from')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False, help='Run the import and log what it would change, then roll the whole import back')
+        parser.add_argument('--full', action='store_true', default=False, help='Resync every row, including the rows that have not changed since the last import')
+        parser.add_argument('--workers', type=int, default=1, help='Decode the export in this many processes, for very large exports')
     
     def handle(self, *args, **kwargs):
         logger.info("Beginning family import routine")
         
-        data = fmpxmlparser.parse_from_file(kwargs['filename'])
-
-        results = data['results']    
+        results = fmpxmlparser.iter_rows_parallel(kwargs['filename'], max_workers=kwargs['workers'])
         
-        seen_ids = set()
+        with sync_transaction(dry_run=kwargs['dry_run']):
+          self.sync(results, SharedLookups(), dry_run=kwargs['dry_run'], full=kwargs['full'])
+    
+    def sync(self, results, lookups, dry_run=False, full=False):
+        parents = BulkSync(Parent, 'full_id')
+        checksums = RowChecksums('families', full=full)
         
-        with transaction.atomic():
-          for row in results:
-            fields = row['parsed_fields']
-            
-            family_id = fields["IDFAMILY"]
-            
-            parents = {}
-            
-            address = fields['P_address_full'] or ""
-            address_lines = address.splitlines()
-            address = "\n".join([line.strip() for line in address_lines])
-            
-            parent_attr_map = {              
-              'Pa': {
-                'first_name': (fields['Pa_first'] or "").strip(),
-                'last_name': (fields['Pa_last'] or "").strip(),
-                'email': (fields['Pa_email'] or "").strip(),
-                'phone_home': (fields['P_phone_H'] or "").strip(),
-                'phone_work': (fields['Pa_phone_W'] or "").strip(),
-                'phone_cell': (fields['Pa_phone_cell'] or "").strip(),
-                'address': address,
-                'family_id': family_id,
-                'parent_id': 'Pa',
-              },
-              'Pb': {
-                'first_name': (fields['Pb_first'] or "").strip(),
-                'last_name': (fields['Pb_last'] or "").strip(),
-                'email': (fields['Pb_email'] or "").strip(),
-                'phone_home': (fields['P_phone_H'] or "").strip(),
-                'phone_work': (fields['Pb_phone_W'] or "").strip(),
-                'phone_cell': (fields['Pb_phone_cell'] or "").strip(),
-                'address': address,
-                'family_id': family_id,
-                'parent_id': 'Pa',
-              }
+        for fields in counted(results):
+          family_id = fields["IDFAMILY"]
+          
+          #A family whose parents have both gone from the database is synced again
+          exists = (family_id + 'Pa', ) in parents or (family_id + 'Pb', ) in parents
+          
+          if checksums.unchanged(family_id, fields, exists=exists):
+            parents.mark_seen(family_id + 'Pa')
+            parents.mark_seen(family_id + 'Pb')
+            continue
+          
+          address = fields['P_address_full'] or ""
+          address_lines = address.splitlines()
+          address = "\n".join([line.strip() for line in address_lines])
+          
+          parent_attr_map = {              
+            'Pa': {
+              'first_name': (fields['Pa_first'] or "").strip(),
+              'last_name': (fields['Pa_last'] or "").strip(),
+              'email': (fields['Pa_email'] or "").strip(),
+              'phone_home': (fields['P_phone_H'] or "").strip(),
+              'phone_work': (fields['Pa_phone_W'] or "").strip(),
+              'phone_cell': (fields['Pa_phone_cell'] or "").strip(),
+              'address': address,
+              'family_id': family_id,
+              'parent_id': 'Pa',
+            },
+            'Pb': {
+              'first_name': (fields['Pb_first'] or "").strip(),
+              'last_name': (fields['Pb_last'] or "").strip(),
+              'email': (fields['Pb_email'] or "").strip(),
+              'phone_home': (fields['P_phone_H'] or "").strip(),
+              'phone_work': (fields['Pb_phone_W'] or "").strip(),
+              'phone_cell': (fields['Pb_phone_cell'] or "").strip(),
+              'address': address,
+              'family_id': family_id,
+              'parent_id': 'Pa',
             }
+          }
+          
+          for parent_code, parent_attrs in parent_attr_map.items():
+            full_id = family_id + parent_code
+            parents.mark_seen(full_id)
             
-            for parent_code, parent_attrs in parent_attr_map.items():
-              full_id = family_id + parent_code
-              seen_ids.add(full_id)
-              
-              do_save = False
-              
-              if not (parent_attrs['first_name'] and parent_attrs['last_name']):
-                #First and last name is the criteria for me to import
-                continue
-              
-              try:
-                parent = Parent.objects.get(full_id=full_id)
-              except Parent.DoesNotExist:
-                logger.info("Creating parent {parent_id:}".format(parent_id=full_id))
-                
-                do_save = True
-                parent = Parent()
-                parent.full_id = full_id
+            if not (parent_attrs['first_name'] and parent_attrs['last_name']):
+              #First and last name is the criteria for me to import
+              continue
             
-              for attr, desired_value in parent_attrs.items():
-                db_value = getattr(parent, attr)
-                if db_value != desired_value:
-                  logger.info("Updating {attr:} on {parent_id:} from {db_value} to {desired_value:}".format(attr=attr, parent_id=full_id, db_value=db_value, desired_value=desired_value))
-                  do_save = True
-                  setattr(parent, attr, desired_value)
-              
-              if do_save:
-                parent.save()
+            parents.sync({'full_id': full_id}, parent_attrs, label=full_id)
           
-          extra_parents = Parent.objects.exclude(full_id__in=seen_ids)
-          for extra_parent in extra_parents:
-              logger.warn("Deleting extra parent {}".format(extra_parent.id))
-              extra_parent.delete()
\ No newline at end of file
+          checksums.synced(family_id)
+        
+        parents.write()
+        
+        parents.delete_stale(dry_run=dry_run)
+        checksums.write(dry_run=dry_run)
+        
+        lookups.publish('parents', parents)
\ No newline at end of file
@@ -4,144 +4,136 @@ import logging
 from datetime import date
 
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
 
 from validate_email import validate_email
 
 from academics.models import Student, Parent, StudentParentRelation
 from academics.utils import fmpxmlparser
+from academics.utils.checksums import RowChecksums
+from academics.utils.bulksync import BulkSync, SharedLookups, sync_transaction
+from academics.utils.instrumentation import InstrumentedCommand, counted
 
 logger = logging.getLogger(__name__)
 
-class Command(BaseCommand):
+class Command(InstrumentedCommand):
     help = "Import Permrecs"
     
     def add_arguments(self, parser):
         parser.add_argument('filename', metavar='FILENAME', help='The filename to process the students from')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False, help='Run the import and log what it would change, then roll the whole import back')
+        parser.add_argument('--full', action='store_true', default=False, help='Resync every row, including the rows that have not changed since the last import')
+        parser.add_argument('--workers', type=int, default=1, help='Decode the export in this many processes, for very large exports')
     
     def handle(self, *args, **kwargs):
         logger.info("Beginning student import routine")
         
-        data = fmpxmlparser.parse_from_file(kwargs['filename'])
-
-        results = data['results']    
+        results = fmpxmlparser.iter_rows_parallel(kwargs['filename'], max_workers=kwargs['workers'])
         
-        seen_ids = set()
+        with sync_transaction(dry_run=kwargs['dry_run']):
+            self.sync(results, SharedLookups(), dry_run=kwargs['dry_run'], full=kwargs['full'])
+    
+    def sync(self, results, lookups, dry_run=False, full=False):
+        students = BulkSync(Student, 'student_id')
+        checksums = RowChecksums('permrecs', full=full)
+        relation_fields = {}
         
-        with transaction.atomic():
-            for row in results:
-                fields = row['parsed_fields']
-                
-                nameFirst = fields['NameFirst'] or ""
-                nameLast = fields['NameLast'] or ""
-                nameNickname = fields['NameNickname'] or ""
-                email = fields['EMailSchool'] or ""
-                studentID = fields['IDSTUDENT']
-                password = fields["PasswordActiveDirctory"] or ""
-                username = fields["Network_User_Name"] or ""
-                gender = fields["Sex"] or ""
-                
-                if not studentID:
-                    continue
-                
-                seen_ids.add(studentID)
-                
-                if username:
-                    if len(username) > 20:
-                        username = username[0:20]
-                        logger.warn("Username {username:} was truncated to 20 characters".format(username=username))
-                
-                if email:
-                    validEmail = validate_email(email)
-                
-                    if not validEmail:
-                        email = ""
-                        logger.warn("E-mail address {email:} for {id:} ({first:} {last:}) is invalid; address blanked".format(email=email, id=studentID, first=nameFirst, last=nameLast))
-                
-                try:
-                    student = Student.objects.get(student_id=studentID)
-                    logger.info("Found student {studentID:}".format(studentID=studentID))
-                    forceSave = False
-                    
-                except Student.DoesNotExist:
-                    student = Student(student_id=studentID)
-                    logger.info("Creating student {studentID:}".format(studentID=studentID))
-                    forceSave = True
-                    
-                attrMap = {
-                    'first_name': nameFirst,
-                    'last_name': nameLast,
-                    'nickname': nameNickname,
-                    'email': email,
-                    'rectory_password': password,
-                    'username': username,
-                    'gender': gender,
-                }
-                
-                for attr in attrMap:
-                    dbValue = getattr(student, attr)
-                    
-                    if dbValue != attrMap[attr]:
-                        setattr(student, attr, attrMap[attr])
-                        logger.info("Updating {attr:} on {studentID:} from {oldValue:} to {newValue:}".format(attr=attr, studentID=studentID, oldValue=dbValue, newValue=attrMap[attr]))
-                        forceSave = True
-                    
-                if forceSave:
-                    student.save()
+        for fields in counted(results):
+            nameFirst = fields['NameFirst'] or ""
+            nameLast = fields['NameLast'] or ""
+            nameNickname = fields['NameNickname'] or ""
+            email = fields['EMailSchool'] or ""
+            studentID = fields['IDSTUDENT']
+            password = fields["PasswordActiveDirctory"] or ""
+            username = fields["Network_User_Name"] or ""
+            gender = fields["Sex"] or ""
+            
+            if not studentID:
+                continue
+            
+            #Relations depend on which parents exist, so they are synced whether or not the row changed
+            relation_fields[studentID] = fields
+            
+            if checksums.unchanged(studentID, fields, exists=(studentID, ) in students):
+                students.mark_seen(studentID)
+                continue
+            
+            if username:
+                if len(username) > 20:
+                    username = username[0:20]
+                    logger.warn("Username {username:} was truncated to 20 characters".format(username=username))
+            
+            if email:
+                validEmail = validate_email(email)
                 
-                self.sync_relations(student, fields)
-                    
-            extra_students = Student.objects.exclude(student_id__in=seen_ids)
-            for extra_student in extra_students:
-                logger.warn("Deleting extra student {}".format(extra_student.id))
-                extra_student.delete()
-
-    def sync_relations(self, student, fields):
-      relevant_parent_ids = set()
-      
-      for family_number in ('1', '2', '3', '4'):
-        family_id_key = "IDFamily" + family_number
-        family_id = fields[family_id_key]
+                if not validEmail:
+                    email = ""
+                    logger.warn("E-mail address {email:} for {id:} ({first:} {last:}) is invalid; address blanked".format(email=email, id=studentID, first=nameFirst, last=nameLast))
+            
+            attrMap = {
+                'first_name': nameFirst,
+                'last_name': nameLast,
+                'nickname': nameNickname,
+                'email': email,
+                'rectory_password': password,
+                'username': username,
+                'gender': gender,
+            }
+            
+            students.sync({'student_id': studentID}, attrMap, label=studentID)
+            checksums.synced(studentID)
         
-        if not family_id:
-          continue
+        students.write()
         
-        for parent_code in ('a', 'b'):
-          relation_field = "P" + family_number + parent_code + "_Relation"
-          full_parent_id = family_id + "P" + parent_code
-          
-          relationship = fields[relation_field] or ""
+        #Relations need the student's primary key, so they are synced once the students are written
+        self.sync_relations(students, relation_fields, lookups, dry_run=dry_run)
+        
+        students.delete_stale(dry_run=dry_run)
+        checksums.write(dry_run=dry_run)
+        
+        lookups.publish('students', students)
+    
+    def sync_relations(self, students, relation_fields, lookups, dry_run=False):
+      """Sync the parent relations of every student in the export at once.
+      
+      Every existing relation is loaded once and diffed in memory; new ones
+      go in with bulk_create and the relations of these students to parents
+      no longer in their families go in one batched delete."""
+      
+      parents = lookups.table('parents', Parent.objects.all(), 'full_id')
+      relations = BulkSync(StudentParentRelation, ('student_id', 'parent_id'))
+      
+      synced_student_ids = set()
+      
+      for studentID, fields in relation_fields.items():
+        student = students.get(studentID)
+        synced_student_ids.add(student.id)
+        
+        for family_number in ('1', '2', '3', '4'):
+          family_id_key = "IDFamily" + family_number
+          family_id = fields[family_id_key]
           
-          try:
-            parent = Parent.objects.get(full_id=full_parent_id)
-          except Parent.DoesNotExist:
+          if not family_id:
             continue
           
-          do_save = False
-          
-          try:
-            student_parent_relation = StudentParentRelation.objects.get(parent=parent, student=student)
-          except StudentParentRelation.DoesNotExist:
-            student_parent_relation = StudentParentRelation(parent=parent, student=student)
-            do_save = True
-          
-          attr_map = {
-            'relationship': relationship,
-            'family_id_key': family_id_key
-          }
-          
-          for attr, desired_value in attr_map.items():
-            db_value = getattr(student_parent_relation, attr)
+          for parent_code in ('a', 'b'):
+            relation_field = "P" + family_number + parent_code + "_Relation"
+            full_parent_id = family_id + "P" + parent_code
             
-            if db_value != desired_value:
-              setattr(student_parent_relation, attr, desired_value)
-              do_save = True
-          
-          if do_save:
-            student_parent_relation.save()
+            relationship = fields[relation_field] or ""
             
-          relevant_parent_ids.add(parent.id)
-
-      extra_parents = student.parents.exclude(pk__in=relevant_parent_ids)
-      for extra_parent in extra_parents:
-        logger.warn("Deleting parent {:}".format(extra_parent.id))
\ No newline at end of file
+            parent = parents.get(full_parent_id)
+            
+            if parent is None:
+              continue
+            
+            attr_map = {
+              'relationship': relationship,
+              'family_id_key': family_id_key
+            }
+            
+            relations.sync({'student_id': student.id, 'parent_id': parent.id}, attr_map, label="{student:}/{parent:}".format(student=studentID, parent=full_parent_id))
+      
+      relations.write()
+      
+      #Only the students in this export are reconciled; the others' relations go with the students themselves
+      relations.delete_stale(dry_run=dry_run, within=lambda relation: relation.student_id in synced_student_ids)
@@ -4,87 +4,93 @@ import logging
 from datetime import date
 
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
 
 from validate_email import validate_email
 
 from academics.models import Course, Section, AcademicYear, Teacher
 from academics.utils import fmpxmlparser
+from academics.utils.checksums import RowChecksums
+from academics.utils.bulksync import BulkSync, SharedLookups, sync_transaction
+from academics.utils.instrumentation import InstrumentedCommand, counted
 
 logger = logging.getLogger(__name__)
 
-class Command(BaseCommand):
+class Command(InstrumentedCommand):
     help = "Import Sections"
     
     def add_arguments(self, parser):
         parser.add_argument('filename', metavar='FILENAME', help='The filename to process the sections from')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False, help='Run the import and log what it would change, then roll the whole import back')
+        parser.add_argument('--full', action='store_true', default=False, help='Resync every row, including the rows that have not changed since the last import')
+        parser.add_argument('--workers', type=int, default=1, help='Decode the export in this many processes, for very large exports')
     
     def handle(self, *args, **kwargs):
         logger.info("Beginning section import routine")
         
-        data = fmpxmlparser.parse_from_file(kwargs['filename'])
-
-        results = data['results']    
+        results = fmpxmlparser.iter_rows_parallel(kwargs['filename'], max_workers=kwargs['workers'])
         
-        seen_ids = set()
+        with sync_transaction(dry_run=kwargs['dry_run']):
+            self.sync(results, SharedLookups(), dry_run=kwargs['dry_run'], full=kwargs['full'])
+    
+    def sync(self, results, lookups, dry_run=False, full=False):
+        courses = lookups.table('courses', Course.objects.all(), 'number')
+        academic_years = lookups.table('academic_years', AcademicYear.objects.all(), 'year', create=lambda year: AcademicYear(year=year))
+        teachers = lookups.table('teachers', Teacher.objects.all(), 'teacher_id')
         
-        with transaction.atomic():
-            for row in results:
-                fields = row['parsed_fields']
-                
-                course_number = fields['CourseNumber']
-                csn = fields['CourseSectionNumber']
-                academic_year = fields["AcademicYear"]
-                teacher_id = fields["IDTeacher"]
-                
-                if not course_number or not csn or not academic_year:
-                    continue
-                
-                try:
-                    course = Course.objects.get(number=course_number)
-                    logger.info("Found course {number:}".format(number=course_number))
-                    forceSave = False
-                    
-                except Course.DoesNotExist:
-                    logger.error("Course {course:} is in sections but not courses".format(course=course_number))
-                    continue
-                
-                try:
-                    academic_year = AcademicYear.objects.get(year=academic_year)
-                except AcademicYear.DoesNotExist:
-                    academic_year = AcademicYear(year=academic_year)
-                    academic_year.save()
-                
-                try:
-                    section = Section.objects.get(course=course, academic_year=academic_year, csn=csn)
-                    logger.info("Found section {csn:} for {academic_year:}".format(csn=csn, academic_year=academic_year))
-
-                except Section.DoesNotExist:
-                    logger.info("Creating section {csn:} for {academic_year:}".format(csn=csn, academic_year=academic_year))
-                    section = Section(course=course, academic_year=academic_year, csn=csn)
-                    section.save()
-                
-                teacher = None
-                
-                if teacher_id:
-                    try:
-                        teacher = Teacher.objects.get(teacher_id=teacher_id)
-                    except Teacher.DoesNotExist:
-                        logger.error("Teacher {id:} is in sections but not in teachers".format(id=teacher_id))
-                    
-                attrMap = {
-                    'teacher': teacher,
-                }
+        sections = BulkSync(Section, ('csn', 'academic_year_id'))
+        checksums = RowChecksums('sections', full=full)
+        seen_academic_year_ids = set()
+        
+        for fields in counted(results):
+            course_number = fields['CourseNumber']
+            csn = fields['CourseSectionNumber']
+            academic_year = fields["AcademicYear"]
+            teacher_id = fields["IDTeacher"]
+            
+            if not course_number or not csn or not academic_year:
+                continue
+            
+            course = courses.get(course_number)
+            
+            if not course:
+                logger.error("Course {course:} is in sections but not courses".format(course=course_number))
+                continue
+            
+            academic_year = academic_years.get(academic_year)
+            seen_academic_year_ids.add(academic_year.id)
+            
+            if checksums.unchanged((csn, academic_year.year), fields, exists=(csn, academic_year.id) in sections):
+                sections.mark_seen(csn, academic_year.id)
+                continue
+            
+            teacher = None
+            lookup_failed = False
+            
+            if teacher_id:
+                teacher = teachers.get(teacher_id)
                 
-                for attr in attrMap:
-                    dbValue = getattr(section, attr)
-                    
-                    if dbValue != attrMap[attr]:
-                        setattr(section, attr, attrMap[attr])
-                        logger.info("Updating {attr:} on {course:} from {oldValue:} to {newValue:}".format(attr=attr, course=course_number, oldValue=dbValue, newValue=attrMap[attr]))
-                        forceSave = True
-                    
-                if forceSave:
-                    section.save()
+                if not teacher:
+                    logger.error("Teacher {id:} is in sections but not in teachers".format(id=teacher_id))
+                    lookup_failed = True
             
-            #TODO: Delete extra sessions
\ No newline at end of file
+            attrMap = {
+                'course': course,
+                'teacher': teacher,
+            }
+            
+            label = "{csn:} for {academic_year:}".format(csn=csn, academic_year=academic_year)
+            sections.sync({'csn': csn, 'academic_year_id': academic_year.id}, attrMap, label=label)
+            
+            #A missing teacher was saved as None; retry the row once the teacher exists
+            if lookup_failed:
+                checksums.failed((csn, academic_year.year))
+            else:
+                checksums.synced((csn, academic_year.year))
+        
+        sections.write()
+        
+        #Only reconcile the years in the export; older years are not exported again
+        sections.delete_stale(dry_run=dry_run, within=lambda section: section.academic_year_id in seen_academic_year_ids)
+        checksums.write(dry_run=dry_run)
+        
+        lookups.publish('sections', sections)
\ No newline at end of file
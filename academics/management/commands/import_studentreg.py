@@ -4,88 +4,80 @@ import logging
 from datetime import date
 
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
 
 from validate_email import validate_email
 
 from academics.models import Section, AcademicYear, StudentRegistration, Student
 from academics.utils import fmpxmlparser
+from academics.utils.checksums import RowChecksums
+from academics.utils.bulksync import BulkSync, SharedLookups, sync_transaction
+from academics.utils.instrumentation import InstrumentedCommand, counted
 
 logger = logging.getLogger(__name__)
 
-class Command(BaseCommand):
+#The only columns of the studentreg export the import reads
+EXPORT_FIELDS = ('CSN', 'AcademicYear', 'IDStudent', 'IDSTUDENTREG')
+
+class Command(InstrumentedCommand):
     help = "Import Student Registrations"
     
     def add_arguments(self, parser):
         parser.add_argument('filename', metavar='FILENAME', help='The filename to process the student registrations from')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False, help='Run the import and log what it would change, then roll the whole import back')
+        parser.add_argument('--full', action='store_true', default=False, help='Resync every row, including the rows that have not changed since the last import')
     
     def handle(self, *args, **kwargs):
         logger.info("Beginning student registration import routine")
         
-        data = fmpxmlparser.parse_from_file(kwargs['filename'])
-
-        results = data['results']    
+        results = fmpxmlparser.columnar_rows(fmpxmlparser.parse_columnar(kwargs['filename'], fields=EXPORT_FIELDS))
+        
+        with sync_transaction(dry_run=kwargs['dry_run']):
+            self.sync(results, SharedLookups(), dry_run=kwargs['dry_run'], full=kwargs['full'])
+    
+    def sync(self, results, lookups, dry_run=False, full=False):
+        academic_years = lookups.table('academic_years', AcademicYear.objects.all(), 'year', create=lambda year: AcademicYear(year=year))
+        sections = lookups.table('sections', Section.objects.all(), ('csn', 'academic_year_id'))
+        students = lookups.table('students', Student.objects.all(), 'student_id')
         
-        seen_ids = set()
+        student_registrations = BulkSync(StudentRegistration, 'student_reg_id')
+        checksums = RowChecksums('studentreg', full=full, fields=EXPORT_FIELDS)
         
-        with transaction.atomic():
-            for row in results:
-                fields = row['parsed_fields']
-                
-                csn = fields['CSN']
-                academic_year = fields["AcademicYear"]
-                student_id = fields["IDStudent"]
-                student_reg_id = fields["IDSTUDENTREG"]
-                
-                if not csn or not academic_year or not student_id or not student_reg_id:
-                    continue
-                
-                try:
-                    academic_year = AcademicYear.objects.get(year=academic_year)
-                except AcademicYear.DoesNotExist:
-                    academic_year = AcademicYear(year=academic_year)
-                    academic_year.save()
-                
-                try:
-                    section = Section.objects.get(csn=csn, academic_year=academic_year)
-                except Section.DoesNotExist:
-                    logger.error("Section {csn:}/{year:} is in studentreg but not in sections".format(csn=csn, year=academic_year))
-                    continue
-                
-                try:
-                    student = Student.objects.get(student_id=student_id)
-                except Student.DoesNotExist:
-                    logger.error("Student {id:} is in studentreg but not in students".format(id=student_id))
-                    continue
-                
-                try:
-                    student_registration = StudentRegistration.objects.get(student_reg_id=student_reg_id)
-                    logger.info("Found student registration {id:}".format(id=student_reg_id))
-                    forceSave = False
-                    
-                except StudentRegistration.DoesNotExist:
-                    student_registration = StudentRegistration(student_reg_id=student_reg_id, section=section, student=student)    
-                    forceSave = True
-                
-                attrMap = {
-                    'student': student,
-                    'section': section
-                }
-                
-                for attr in attrMap:
-                    dbValue = getattr(student_registration, attr)
-                    
-                    if dbValue != attrMap[attr]:
-                        setattr(student_registration, attr, attrMap[attr])
-                        logger.info("Updating {attr:} on {student_registration:} from {oldValue:} to {newValue:}".format(attr=attr, student_registration=student_registration.student_reg_id, oldValue=dbValue, newValue=attrMap[attr]))
-                        forceSave = True
-                
-                seen_ids.add(student_reg_id)
-                    
-                if forceSave:
-                    student_registration.save()
+        for fields in counted(results):
+            csn = fields['CSN']
+            academic_year = fields["AcademicYear"]
+            student_id = fields["IDStudent"]
+            student_reg_id = fields["IDSTUDENTREG"]
+            
+            if not csn or not academic_year or not student_id or not student_reg_id:
+                continue
+            
+            if checksums.unchanged(student_reg_id, fields, exists=(student_reg_id, ) in student_registrations):
+                student_registrations.mark_seen(student_reg_id)
+                continue
+            
+            academic_year = academic_years.get(academic_year)
             
-            extra_student_registrations = StudentRegistration.objects.exclude(student_reg_id__in=seen_ids)
-            for extra_student_registration in extra_student_registrations:
-                logger.warn("Deleting extra student registration {}".format(extra_student_registration.student_reg_id))
-                extra_student_registration.delete()
\ No newline at end of file
+            section = sections.get(csn, academic_year.id)
+            
+            if not section:
+                logger.error("Section {csn:}/{year:} is in studentreg but not in sections".format(csn=csn, year=academic_year))
+                continue
+            
+            student = students.get(student_id)
+            
+            if not student:
+                logger.error("Student {id:} is in studentreg but not in students".format(id=student_id))
+                continue
+            
+            attrMap = {
+                'student': student,
+                'section': section
+            }
+            
+            student_registrations.sync({'student_reg_id': student_reg_id}, attrMap, label=student_reg_id)
+            checksums.synced(student_reg_id)
+        
+        student_registrations.write()
+        
+        student_registrations.delete_stale(dry_run=dry_run)
+        checksums.write(dry_run=dry_run)
\ No newline at end of file
@@ -4,90 +4,81 @@ import logging
 from datetime import date
 
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
 
 from validate_email import validate_email
 
 from academics.models import Teacher
 from academics.utils import fmpxmlparser
+from academics.utils.checksums import RowChecksums
+from academics.utils.bulksync import BulkSync, SharedLookups, sync_transaction
+from academics.utils.instrumentation import InstrumentedCommand, counted
 
 logger = logging.getLogger(__name__)
 
-class Command(BaseCommand):
+class Command(InstrumentedCommand):
     help = "Import Teachers"
     
     def add_arguments(self, parser):
         parser.add_argument('filename', metavar='FILENAME', help='The filename to process the teachers from')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False, help='Run the import and log what it would change, then roll the whole import back')
+        parser.add_argument('--full', action='store_true', default=False, help='Resync every row, including the rows that have not changed since the last import')
+        parser.add_argument('--workers', type=int, default=1, help='Decode the export in this many processes, for very large exports')
     
     def handle(self, *args, **kwargs):
         logger.info("Beginning teacher import routine")
         
-        data = fmpxmlparser.parse_from_file(kwargs['filename'])
-
-        results = data['results'] 
-           
-        seen_ids = set()
+        results = fmpxmlparser.iter_rows_parallel(kwargs['filename'], max_workers=kwargs['workers'])
         
-        with transaction.atomic():
-            for row in results:
-                fields = row['parsed_fields']
-                
-                nameFirst = fields['NameFirst'] or ""
-                nameLast = fields['NameLast'] or ""
-                namePrefix = fields['NamePrefix'] or ""
-                email = fields['EmailSchool'] or ""
-                activeEmployee = fields['Active Employee'] or ""
-                uniqueName = fields['NameUnique'] or ""
-                teacherID = fields['IDTEACHER']
-                
-                if not teacherID:
-                    continue
-                
-                seen_ids.add(teacherID)
-                
-                if activeEmployee in ("1", 1):
-                    activeEmployee = True
-                else:
-                    activeEmployee = False
-                
-                if email:
-                    validEmail = validate_email(email)
-                
-                    if not validEmail:
-                        email = ""
-                        logger.warn("E-mail address {email:} for {id:} ({first:} {last:}) is invalid; address blanked".format(email=email, id=teacherID, first=firstName, last=lastName))
-                
-                try:
-                    teacher = Teacher.objects.get(teacher_id=teacherID)
-                    logger.info("Found teacher {teacherID:}".format(teacherID=teacherID))
-                    forceSave = False
-                    
-                except Teacher.DoesNotExist:
-                    teacher = Teacher(teacher_id=teacherID)
-                    logger.info("Creating teacher {teacherID:}".format(teacherID=teacherID))
-                    forceSave = True
-                    
-                attrMap = {
-                    'first_name': nameFirst,
-                    'last_name': nameLast,
-                    'prefix': namePrefix,
-                    'email': email,
-                    'active': activeEmployee,
-                    'unique_name': uniqueName
-                }
+        with sync_transaction(dry_run=kwargs['dry_run']):
+            self.sync(results, SharedLookups(), dry_run=kwargs['dry_run'], full=kwargs['full'])
+    
+    def sync(self, results, lookups, dry_run=False, full=False):
+        teachers = BulkSync(Teacher, 'teacher_id')
+        checksums = RowChecksums('teachers', full=full)
+        
+        for fields in counted(results):
+            nameFirst = fields['NameFirst'] or ""
+            nameLast = fields['NameLast'] or ""
+            namePrefix = fields['NamePrefix'] or ""
+            email = fields['EmailSchool'] or ""
+            activeEmployee = fields['Active Employee'] or ""
+            uniqueName = fields['NameUnique'] or ""
+            teacherID = fields['IDTEACHER']
+            
+            if not teacherID:
+                continue
+            
+            if checksums.unchanged(teacherID, fields, exists=(teacherID, ) in teachers):
+                teachers.mark_seen(teacherID)
+                continue
+            
+            if activeEmployee in ("1", 1):
+                activeEmployee = True
+            else:
+                activeEmployee = False
+            
+            if email:
+                validEmail = validate_email(email)
                 
-                for attr in attrMap:
-                    dbValue = getattr(teacher, attr)
-                    
-                    if dbValue != attrMap[attr]:
-                        setattr(teacher, attr, attrMap[attr])
-                        logger.info("Updating {attr:} on {teacherID:} from {oldValue:} to {newValue:}".format(attr=attr, teacherID=teacherID, oldValue=dbValue, newValue=attrMap[attr]))
-                        forceSave = True
-                    
-                if forceSave:
-                    teacher.save()
+                if not validEmail:
+                    email = ""
+                    logger.warn("E-mail address {email:} for {id:} ({first:} {last:}) is invalid; address blanked".format(email=email, id=teacherID, first=firstName, last=lastName))
             
-            extra_teachers = Teacher.objects.exclude(teacher_id__in=seen_ids)
-            for extra_teacher in extra_teachers:
-                logger.warn("Deleting extra teacher {}".format(extra_teacher.id))
-                extra_teacher.delete()
+            attrMap = {
+                'first_name': nameFirst,
+                'last_name': nameLast,
+                'prefix': namePrefix,
+                'email': email,
+                'active': activeEmployee,
+                'unique_name': uniqueName
+            }
+            
+            teachers.sync({'teacher_id': teacherID}, attrMap, label=teacherID)
+            checksums.synced(teacherID)
+        
+        teachers.write()
+        
+        teachers.delete_stale(dry_run=dry_run)
+        checksums.write(dry_run=dry_run)
+        
+        lookups.publish('teachers', teachers)
@@ -7,10 +7,11 @@ from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
 
 from academics.models import Student, Enrollment, AcademicYear
+from academics.utils.instrumentation import InstrumentedCommand, count_rows
 
 logger = logging.getLogger(__name__)
 
-class Command(BaseCommand):
+class Command(InstrumentedCommand):
     help = "Import reset student's current status"
     
     def handle(self, *args, **kwargs):
@@ -21,4 +22,4 @@ class Command(BaseCommand):
             
             current_enrollments = Enrollment.objects.filter(academic_year=AcademicYear.objects.current(), status_enrollment="Enrolled", status_attending="Attending")
             current_students = Student.objects.filter(enrollment__in=current_enrollments)
-            current_students.update(current=True)
\ No newline at end of file
+            count_rows(current_students.update(current=True))
\ No newline at end of file
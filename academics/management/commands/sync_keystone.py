@@ -0,0 +1,93 @@
+#!/usr/bin/python
+
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management import load_command_class
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from academics.utils.exportcache import load_rows
+from academics.utils.bulksync import SharedLookups, sync_transaction
+from academics.utils.instrumentation import InstrumentedCommand
+
+logger = logging.getLogger(__name__)
+
+#Stages in the order they are applied; each one may look up rows synced by the stages before it
+STAGES = (
+    ('teachers', 'import_teachers'),
+    ('courses', 'import_courses'),
+    ('permrecs', 'import_permrecs'),
+    ('families', 'import_families'),
+    ('enrollments', 'import_enrollments'),
+    ('sections', 'import_sections'),
+    ('studentreg', 'import_studentreg'),
+)
+
+def load_export(filename):
+    #Runs in a worker process; LeanRows pickle by their field names so the rows can be sent back
+    start = time.perf_counter()
+    rows = load_rows(filename)
+    
+    return rows, time.perf_counter() - start
+
+class Command(InstrumentedCommand):
+    help = "Import every Keystone export in one run"
+    
+    def add_arguments(self, parser):
+        for stage, command_name in STAGES:
+            parser.add_argument('--' + stage, metavar='FILENAME', help='The filename to process the {stage:} from'.format(stage=stage))
+        
+        parser.add_argument('--workers', type=int, default=None, help='The number of processes parsing exports; defaults to the number of CPUs')
+        parser.add_argument('--dry-run', action='store_true', dest='dry_run', default=False, help='Run the import and log what it would change, then roll the whole import back')
+        parser.add_argument('--full', action='store_true', default=False, help='Resync every row, including the rows that have not changed since the last import')
+    
+    def handle(self, *args, **kwargs):
+        stages = [(stage, command_name, kwargs[stage]) for stage, command_name in STAGES if kwargs[stage]]
+        
+        if not stages:
+            raise CommandError("No export files were given")
+        
+        logger.info("Beginning Keystone sync of {stages:}".format(stages=", ".join(stage for stage, command_name, filename in stages)))
+        
+        run_start = time.perf_counter()
+        timings = []
+        
+        #The parse workers are forked, so do not hand them an open database connection
+        connections.close_all()
+        
+        with ProcessPoolExecutor(max_workers=kwargs['workers']) as executor:
+            #Every export is parsed up front; a stage only waits for its own file
+            parsed = [(stage, command_name, executor.submit(load_export, filename)) for stage, command_name, filename in stages]
+            
+            with sync_transaction(dry_run=kwargs['dry_run']):
+                lookups = SharedLookups()
+                
+                for stage, command_name, future in parsed:
+                    wait_start = time.perf_counter()
+                    rows, parse_time = future.result()
+                    wait_time = time.perf_counter() - wait_start
+                    
+                    logger.info("Beginning {stage:} stage with {rows:} row(s)".format(stage=stage, rows=len(rows)))
+                    
+                    apply_start = time.perf_counter()
+                    load_command_class('academics', command_name).sync(rows, lookups, dry_run=kwargs['dry_run'], full=kwargs['full'])
+                    apply_time = time.perf_counter() - apply_start
+                    
+                    timings.append((stage, len(rows), parse_time, wait_time, apply_time))
+                
+                commit_start = time.perf_counter()
+            
+            commit_time = time.perf_counter() - commit_start
+        
+        self.stdout.write("{stage:<12}{rows:>10}{parse:>10}{wait:>10}{apply:>10}".format(stage="stage", rows="rows", parse="parse", wait="wait", apply="apply"))
+        
+        for stage, row_count, parse_time, wait_time, apply_time in timings:
+            logger.info("Stage {stage:}: {rows:} row(s), parsed in {parse:.2f}s, waited {wait:.2f}s, applied in {apply:.2f}s".format(stage=stage, rows=row_count, parse=parse_time, wait=wait_time, apply=apply_time))
+            self.stdout.write("{stage:<12}{rows:>10}{parse:>9.2f}s{wait:>9.2f}s{apply:>9.2f}s".format(stage=stage, rows=row_count, parse=parse_time, wait=wait_time, apply=apply_time))
+        
+        total_time = time.perf_counter() - run_start
+        
+        logger.info("Keystone sync finished in {total:.2f}s ({commit:.2f}s writing history and committing)".format(total=total_time, commit=commit_time))
+        self.stdout.write("History and commit {commit:.2f}s, total {total:.2f}s".format(commit=commit_time, total=total_time))
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('academics', '0034_auto_20160204_1405'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportChecksum',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('importer', models.CharField(max_length=20)),
+                ('key', models.CharField(max_length=255)),
+                ('checksum', models.CharField(max_length=40)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='importchecksum',
+            unique_together=set([('importer', 'key')]),
+        ),
+    ]
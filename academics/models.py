@@ -270,4 +270,16 @@ class StudentParentRelation(models.Model):
     return "{:}/{:}".format(self.student, self.parent)
   
   class Meta:
-    unique_together = (('student', 'parent'), )
\ No newline at end of file
+    unique_together = (('student', 'parent'), )
+
+class ImportChecksum(models.Model):
+    #Content hash of a Keystone export row as of the last import that synced it
+    importer = models.CharField(max_length=20)
+    key = models.CharField(max_length=255)
+    checksum = models.CharField(max_length=40)
+    
+    class Meta:
+        unique_together = (('importer', 'key'), )
+    
+    def __str__(self):
+        return "{importer:}/{key:}".format(importer=self.importer, key=self.key)
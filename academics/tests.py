@@ -1,5 +1,54 @@
+import json
+import os
+import pickle
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import mock
+from datetime import date
+from decimal import Decimal
+
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
-from academics.models import Student, AcademicYear, Teacher
+from academics.models import Student, AcademicYear, Teacher, Enrollment, Course, Section, ImportChecksum, Parent, StudentParentRelation
+from academics.utils import fmpxmlparser
+from academics.utils.bulksync import BulkSync, Lookup, SharedLookups
+from academics.utils.history import buffered_history
+from academics.utils.exportcache import ExportCache, UnsafeCacheDirectoryException, CACHE_FORMAT, file_digest
+from academics.utils.synthetic import write_exports
+from academics.utils.instrumentation import instrumented, counted, query_pattern
+from academics.management.commands import import_courses, import_permrecs, import_families, import_sections
+
+SAMPLE_EXPORT = """<?xml version="1.0" encoding="UTF-8" ?>
+<FMPXMLRESULT xmlns="http://www.filemaker.com/fmpxmlresult">
+  <ERRORCODE>0</ERRORCODE>
+  <PRODUCT BUILD="11-07-2013" NAME="FileMaker" VERSION="ProAdvanced 13.0v1"/>
+  <DATABASE DATEFORMAT="M/d/yyyy" LAYOUT="" NAME="ksEnrollment.fmp12" RECORDS="3" TIMEFORMAT="h:mm:ss a"/>
+  <METADATA>
+    <FIELD EMPTYOK="YES" MAXREPEAT="1" NAME="IDStudent" TYPE="TEXT"/>
+    <FIELD EMPTYOK="YES" MAXREPEAT="1" NAME="Grade" TYPE="NUMBER"/>
+    <FIELD EMPTYOK="YES" MAXREPEAT="1" NAME="EnrollmentDate" TYPE="DATE"/>
+  </METADATA>
+  <RESULTSET FOUND="3">
+    <ROW MODID="1" RECORDID="101">
+      <COL><DATA>ST00001 </DATA></COL>
+      <COL><DATA>8</DATA></COL>
+      <COL><DATA>9/2/2015</DATA></COL>
+    </ROW>
+    <ROW MODID="1" RECORDID="102">
+      <COL><DATA>ST00002</DATA></COL>
+      <COL><DATA>9</DATA></COL>
+      <COL><DATA></DATA></COL>
+    </ROW>
+    <ROW MODID="4" RECORDID="103">
+      <COL><DATA>ST00003</DATA></COL>
+      <COL><DATA></DATA></COL>
+      <COL><DATA>12/15/2015</DATA></COL>
+    </ROW>
+  </RESULTSET>
+</FMPXMLRESULT>
+"""
 
 # Create your tests here.
 class StudentTestCase(TestCase):
@@ -89,4 +138,494 @@ class AcademicYearNoObjectsTestCase(AcademicYearTestCase):
             thrown = True
     
         self.assertEquals(thrown, True)
-    
\ No newline at end of file
+    
+
+class FMPXMLParserTestCase(TestCase):
+    def test_parse_from_string(self):
+        data = fmpxmlparser.parse_from_string(SAMPLE_EXPORT)
+        results = data['results']
+        
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[0]['RECORDID'], "101")
+        self.assertEqual(results[0]['parsed_fields'], {'IDStudent': "ST00001", 'Grade': Decimal(8), 'EnrollmentDate': date(2015, 9, 2)})
+        self.assertEqual(results[1]['parsed_fields']['EnrollmentDate'], None)
+        self.assertEqual(results[2]['parsed_fields']['Grade'], None)
+    
+    def test_iter_rows(self):
+        expected = fmpxmlparser.parse_from_string(SAMPLE_EXPORT)['results']
+        rows = list(fmpxmlparser.iter_rows(BytesIO(SAMPLE_EXPORT.encode("utf-8"))))
+        
+        self.assertEqual(rows, expected)
+    
+    def test_lean_rows(self):
+        expected = fmpxmlparser.parse_from_string(SAMPLE_EXPORT)['results']
+        rows = fmpxmlparser.parse_from_string(SAMPLE_EXPORT, lean=True)['results']
+        streamed_rows = list(fmpxmlparser.iter_rows(BytesIO(SAMPLE_EXPORT.encode("utf-8")), lean=True))
+        
+        self.assertEqual(rows, streamed_rows)
+        
+        for row, expected_row in zip(rows, expected):
+            self.assertEqual(row.RECORDID, expected_row['RECORDID'])
+            self.assertEqual(row.as_dict(), expected_row['parsed_fields'])
+        
+        self.assertEqual(rows[0]['IDStudent'], "ST00001")
+        self.assertEqual(rows[0].get('Missing'), None)
+    
+    def test_iter_rows_parallel(self):
+        expected = fmpxmlparser.parse_from_string(SAMPLE_EXPORT, lean=True)['results']
+        
+        #Small chunks so the rows are split across several workers
+        rows = list(fmpxmlparser.iter_rows_parallel(BytesIO(SAMPLE_EXPORT.encode("utf-8")), max_workers=2, chunk_size=64))
+        
+        self.assertEqual(rows, expected)
+        self.assertEqual([row.RECORDID for row in rows], ["101", "102", "103"])
+    
+    def test_parse_columnar(self):
+        data = fmpxmlparser.parse_columnar(BytesIO(SAMPLE_EXPORT.encode("utf-8")))
+        columns = data['columns']
+        
+        self.assertEqual(data['RECORDID'], ["101", "102", "103"])
+        self.assertEqual(list(columns.keys()), ["IDStudent", "Grade", "EnrollmentDate"])
+        self.assertEqual(columns['IDStudent'][0], "ST00001")
+        self.assertEqual(columns['Grade'].typecode, 'd')
+        self.assertEqual(columns['Grade'][1], 9.0)
+        self.assertEqual(columns['EnrollmentDate'][:2], [date(2015, 9, 2), None])
+    
+    def test_parse_columnar_fields(self):
+        data = fmpxmlparser.parse_columnar(BytesIO(SAMPLE_EXPORT.encode("utf-8")), fields=["IDStudent"])
+        rows = list(fmpxmlparser.columnar_rows(data))
+        
+        self.assertEqual(list(data['columns'].keys()), ["IDStudent"])
+        self.assertEqual(rows[1].as_dict(), {"IDStudent": "ST00002"})
+        self.assertEqual(rows[1].RECORDID, "102")
+        
+        with self.assertRaises(fmpxmlparser.FieldNotFoundException):
+            fmpxmlparser.parse_columnar(BytesIO(SAMPLE_EXPORT.encode("utf-8")), fields=["Missing"])
+    
+    def test_pickle_lean_rows(self):
+        rows = fmpxmlparser.parse_from_string(SAMPLE_EXPORT, lean=True)['results']
+        
+        self.assertEqual(pickle.loads(pickle.dumps(rows)), rows)
+
+class FilemakerFuzzyDateParserTestCase(TestCase):
+    def test_strptime_formats(self):
+        parser = fmpxmlparser.FilemakerFuzzyDateParser("M/d/yyyy")
+        
+        self.assertEqual(parser.parse_date("9/2/2015"), date(2015, 9, 2))
+        self.assertEqual(parser.parse_date("12/15/15"), date(2015, 12, 15))
+    
+    def test_dateparser_fallback(self):
+        parser = fmpxmlparser.FilemakerFuzzyDateParser("M/d/yyyy")
+        
+        self.assertEqual(parser.parse_date("September 2, 2015"), date(2015, 9, 2))
+    
+    def test_cache(self):
+        parser = fmpxmlparser.FilemakerFuzzyDateParser("M/d/yyyy", cache_size=2)
+        
+        for i in range(3):
+            parser.parse_date("9/2/2015")
+        
+        parser.parse_date("9/3/2015")
+        parser.parse_date("9/4/2015")
+        
+        cache_info = parser.parse_date.cache_info()
+        self.assertEqual(cache_info.hits, 2)
+        self.assertEqual(cache_info.currsize, 2)
+
+class BulkSyncTestCase(TestCase):
+    def setUp(self):
+        Teacher.objects.create(first_name="Adam", last_name="Peacock", teacher_id="T001")
+        Teacher.objects.create(first_name="Jane", last_name="Doe", teacher_id="T002")
+    
+    def test_sync(self):
+        teachers = BulkSync(Teacher, 'teacher_id')
+        
+        teachers.sync({'teacher_id': "T001"}, {'first_name': "Adam", 'last_name': "Peacock"}, label="T001")
+        teachers.sync({'teacher_id': "T002"}, {'first_name': "Janet", 'last_name': "Doe"}, label="T002")
+        teachers.sync({'teacher_id': "T003"}, {'first_name': "John", 'last_name': "Smith"}, label="T003")
+        
+        #One insert, the reload of the new rows, its history, one update and its history
+        with self.assertNumQueries(5):
+            teachers.write()
+        
+        self.assertEqual(Teacher.objects.get(teacher_id="T002").first_name, "Janet")
+        self.assertEqual(Teacher.objects.get(teacher_id="T003").name, "John Smith")
+        
+        self.assertEqual(Teacher.objects.get(teacher_id="T001").history.count(), 1)
+        self.assertEqual(Teacher.objects.get(teacher_id="T002").history.latest().history_type, "~")
+        self.assertEqual(Teacher.objects.get(teacher_id="T003").history.get().history_type, "+")
+    
+    def test_foreign_keys(self):
+        academic_year = AcademicYear.objects.create(year="2015-2016")
+        student = Student.objects.create(first_name="Adam", last_name="Peacock", student_id="ST00001")
+        Enrollment.objects.create(student=student, academic_year=academic_year, boarder=False, division="MS")
+        
+        advisors = Lookup(Teacher.objects.all(), 'teacher_id')
+        enrollments = BulkSync(Enrollment, ('student_id', 'academic_year_id'))
+        
+        lookup = {'student_id': student.id, 'academic_year_id': academic_year.id}
+        enrollments.sync(lookup, {'advisor': advisors.get("T002"), 'boarder': True}, label="ST00001")
+        enrollments.write()
+        
+        enrollment = Enrollment.objects.get(student=student)
+        self.assertEqual(enrollment.advisor.teacher_id, "T002")
+        self.assertEqual(enrollment.boarder, True)
+        
+        enrollments = BulkSync(Enrollment, ('student_id', 'academic_year_id'))
+        
+        with self.assertNumQueries(0):
+            enrollments.sync(lookup, {'advisor': advisors.get("T002"), 'boarder': True}, label="ST00001")
+            enrollments.write()
+    
+    def test_clear_foreign_key(self):
+        academic_year = AcademicYear.objects.create(year="2015-2016")
+        students = [Student.objects.create(first_name="Student", last_name=str(i), student_id="ST0000{}".format(i)) for i in range(3)]
+        advisor = Teacher.objects.get(teacher_id="T001")
+        
+        for student in students:
+            Enrollment.objects.create(student=student, academic_year=academic_year, boarder=False, division="MS", advisor=advisor)
+        
+        enrollments = BulkSync(Enrollment, ('student_id', 'academic_year_id'))
+        
+        #Every changed advisor in the batch is cleared, so the UPDATE must not rely on a CASE to type the NULL
+        for student in students[:2]:
+            enrollments.sync({'student_id': student.id, 'academic_year_id': academic_year.id}, {'advisor': None, 'boarder': False}, label=student.student_id)
+        
+        enrollments.write()
+        
+        self.assertEqual(list(Enrollment.objects.order_by('student__last_name').values_list('advisor__teacher_id', flat=True)), [None, None, "T001"])
+        self.assertEqual(Enrollment.history.filter(history_type="~", advisor=None).count(), 2)
+    
+    def test_delete_stale(self):
+        academic_year = AcademicYear.objects.create(year="2015-2016")
+        student = Student.objects.create(first_name="Adam", last_name="Peacock", student_id="ST00001")
+        Student.objects.create(first_name="Jane", last_name="Doe", student_id="ST00002")
+        Enrollment.objects.create(student=student, academic_year=academic_year, boarder=False, division="MS")
+        
+        students = BulkSync(Student, 'student_id')
+        students.sync({'student_id': "ST00002"}, {'first_name': "Jane", 'last_name': "Doe"}, label="ST00002")
+        
+        counts = students.delete_stale(dry_run=True)
+        
+        self.assertEqual(counts[Student], 1)
+        self.assertEqual(counts[Enrollment], 1)
+        self.assertEqual(Student.objects.count(), 2)
+        
+        students.delete_stale()
+        
+        self.assertEqual(list(Student.objects.values_list('student_id', flat=True)), ["ST00002"])
+        self.assertEqual(Enrollment.objects.count(), 0)
+        self.assertEqual(Student.history.filter(student_id="ST00001", history_type="-").count(), 1)
+        self.assertEqual(Enrollment.history.filter(history_type="-").count(), 1)
+    
+    def test_lookup_create(self):
+        academic_years = Lookup(AcademicYear.objects.all(), 'year', create=lambda year: AcademicYear(year=year))
+        
+        academic_year = academic_years.get("2016-2017")
+        
+        self.assertEqual(academic_years.get("2016-2017"), academic_year)
+        self.assertEqual(AcademicYear.objects.get(year="2016-2017"), academic_year)
+    
+    def test_shared_lookups(self):
+        lookups = SharedLookups()
+        
+        teachers = BulkSync(Teacher, 'teacher_id')
+        teachers.sync({'teacher_id': "T003"}, {'first_name': "John", 'last_name': "Smith"}, label="T003")
+        teachers.write()
+        lookups.publish('teachers', teachers)
+        
+        #A later stage gets the published rows, new ones included, without loading teachers again
+        with self.assertNumQueries(0):
+            advisors = lookups.table('teachers', Teacher.objects.all(), 'teacher_id')
+            
+            self.assertEqual(advisors.get("T001").last_name, "Peacock")
+            self.assertIsNotNone(advisors.get("T003").pk)
+        
+        academic_years = lookups.table('academic_years', AcademicYear.objects.all(), 'year')
+        self.assertIs(lookups.table('academic_years', AcademicYear.objects.all(), 'year'), academic_years)
+
+class BufferedHistoryTestCase(TestCase):
+    def test_buffered_history(self):
+        with buffered_history() as history_buffer:
+            teacher = Teacher.objects.create(first_name="Adam", last_name="Peacock", teacher_id="T001")
+            teacher.first_name = "Adrian"
+            teacher.save()
+            
+            teachers = BulkSync(Teacher, 'teacher_id')
+            teachers.sync({'teacher_id': "T002"}, {'first_name': "Jane", 'last_name': "Doe"}, label="T002")
+            teachers.write()
+            
+            self.assertEqual(len(history_buffer), 3)
+            self.assertEqual(Teacher.history.count(), 0)
+        
+        self.assertEqual(len(history_buffer), 0)
+        self.assertEqual([record.history_type for record in teacher.history.order_by('history_date')], ["+", "~"])
+        self.assertEqual(teacher.history.latest().first_name, "Adrian")
+        self.assertEqual(Teacher.history.filter(teacher_id="T002", history_type="+").count(), 1)
+    
+    def test_bulk_write_into_empty_buffer(self):
+        #The first write of a sync finds the buffer still empty
+        with buffered_history() as history_buffer:
+            teachers = BulkSync(Teacher, 'teacher_id')
+            teachers.sync({'teacher_id': "T001"}, {'first_name': "Jane", 'last_name': "Doe"}, label="T001")
+            teachers.write()
+            
+            self.assertEqual(len(history_buffer), 1)
+            self.assertEqual(Teacher.history.count(), 0)
+        
+        self.assertEqual(Teacher.history.count(), 1)
+    
+    def test_discarded_on_error(self):
+        try:
+            with buffered_history():
+                Teacher.objects.create(first_name="Adam", last_name="Peacock", teacher_id="T001")
+                raise ValueError()
+        except ValueError:
+            pass
+        
+        self.assertEqual(Teacher.history.count(), 0)
+        
+        Teacher.objects.create(first_name="Jane", last_name="Doe", teacher_id="T002")
+        self.assertEqual(Teacher.history.count(), 1)
+
+class DeltaImportTestCase(TestCase):
+    def setUp(self):
+        self.rows = [{
+            'CourseNumber': "1010",
+            'CourseName': "Algebra I",
+            'CourseNameShort': "Algebra",
+            'CourseNameTranscript': "Algebra I",
+            'Division': "US",
+            'GradeLevel': "9",
+            'DepartmentName': "Mathematics",
+            'CourseType': "Academic",
+        }]
+        
+        self.command = import_courses.Command()
+        self.command.sync(self.rows, SharedLookups())
+    
+    def test_skip_unchanged(self):
+        Course.objects.filter(number="1010").update(course_name="Edited")
+        
+        self.command.sync(self.rows, SharedLookups())
+        self.assertEqual(Course.objects.get(number="1010").course_name, "Edited")
+        
+        self.command.sync(self.rows, SharedLookups(), full=True)
+        self.assertEqual(Course.objects.get(number="1010").course_name, "Algebra I")
+    
+    def test_changed_and_vanished_rows(self):
+        self.rows[0]['CourseName'] = "Geometry"
+        self.command.sync(self.rows, SharedLookups())
+        
+        self.assertEqual(Course.objects.get(number="1010").course_name, "Geometry")
+        self.assertEqual(ImportChecksum.objects.filter(importer='courses').count(), 1)
+        
+        self.command.sync([], SharedLookups())
+        
+        self.assertFalse(Course.objects.exists())
+        self.assertFalse(ImportChecksum.objects.exists())
+    
+    def test_deleted_row_is_resynced(self):
+        Course.objects.all().delete()
+        
+        self.command.sync(self.rows, SharedLookups())
+        self.assertEqual(Course.objects.get(number="1010").course_name, "Algebra I")
+    
+    def test_failed_lookup_is_retried(self):
+        rows = [{'CourseNumber': "1010", 'CourseSectionNumber': "1010-01", 'AcademicYear': "2015-2016", 'IDTeacher': "T001"}]
+        command = import_sections.Command()
+        
+        command.sync(rows, SharedLookups())
+        self.assertIsNone(Section.objects.get(csn="1010-01").teacher)
+        
+        #The row has not changed, but the teacher it could not find now exists
+        Teacher.objects.create(first_name="Adam", last_name="Peacock", teacher_id="T001")
+        command.sync(rows, SharedLookups())
+        
+        self.assertEqual(Section.objects.get(csn="1010-01").teacher.teacher_id, "T001")
+        self.assertEqual(ImportChecksum.objects.filter(importer='sections').count(), 1)
+
+class RelationSyncTestCase(TestCase):
+    def setUp(self):
+        for full_id in ("F1Pa", "F1Pb", "F2Pa"):
+            Parent.objects.create(family_id=full_id[:2], parent_id=full_id[2:], full_id=full_id)
+        
+        self.row = {
+            'IDSTUDENT': "S000001", 'NameFirst': "Sam", 'NameLast': "Student", 'NameNickname': None, 'EMailSchool': None,
+            'PasswordActiveDirctory': None, 'Network_User_Name': None, 'Sex': "M",
+        }
+        
+        for family_number in '1234':
+            self.row['IDFamily' + family_number] = None
+            self.row['P' + family_number + 'a_Relation'] = None
+            self.row['P' + family_number + 'b_Relation'] = None
+        
+        self.row.update({'IDFamily1': "F1", 'P1a_Relation': "Mother", 'P1b_Relation': "Father"})
+    
+    def relations(self):
+        return sorted(StudentParentRelation.objects.values_list('parent__full_id', 'relationship', 'family_id_key'))
+    
+    def test_sync_relations(self):
+        import_permrecs.Command().sync([self.row], SharedLookups())
+        self.assertEqual(self.relations(), [("F1Pa", "Mother", "IDFamily1"), ("F1Pb", "Father", "IDFamily1")])
+        
+        self.row.update({'IDFamily1': "F2", 'P1a_Relation': "Guardian"})
+        
+        with self.assertNumQueries(11):
+            import_permrecs.Command().sync([self.row], SharedLookups())
+        
+        self.assertEqual(self.relations(), [("F2Pa", "Guardian", "IDFamily1")])
+
+class FamilyImportTestCase(TestCase):
+    def setUp(self):
+        self.rows = [{
+            'IDFAMILY': "F1", 'P_address_full': "1 Main Street\n Pomfret", 'P_phone_H': "555-0100",
+            'Pa_first': "Pat", 'Pa_last': "Parent", 'Pa_email': "pat@example.com", 'Pa_phone_W': None, 'Pa_phone_cell': None,
+            'Pb_first': "Chris", 'Pb_last': "Parent", 'Pb_email': None, 'Pb_phone_W': None, 'Pb_phone_cell': "555-0101",
+        }]
+        
+        import_families.Command().sync(self.rows, SharedLookups())
+    
+    def test_unchanged_parents_are_not_saved(self):
+        updated_at = dict(Parent.objects.values_list('full_id', 'updated_at'))
+        
+        import_families.Command().sync(self.rows, SharedLookups(), full=True)
+        
+        self.assertEqual(dict(Parent.objects.values_list('full_id', 'updated_at')), updated_at)
+        self.assertEqual(Parent.history.count(), 2)
+        
+        self.rows[0]['Pb_phone_cell'] = "555-0102"
+        import_families.Command().sync(self.rows, SharedLookups())
+        
+        self.assertEqual(Parent.objects.get(full_id="F1Pa").updated_at, updated_at["F1Pa"])
+        self.assertNotEqual(Parent.objects.get(full_id="F1Pb").updated_at, updated_at["F1Pb"])
+        self.assertEqual(Parent.history.filter(history_type='~').count(), 1)
+    
+    def test_vanished_parents_are_resynced(self):
+        Parent.objects.all().delete()
+        
+        import_families.Command().sync(self.rows, SharedLookups())
+        self.assertEqual(Parent.objects.count(), 2)
+
+class ExportCacheTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def test_load_rows(self):
+        export = BytesIO(SAMPLE_EXPORT.encode("utf-8"))
+        cache = ExportCache(self.directory, 1024 * 1024)
+        
+        rows = cache.load_rows(export)
+        
+        self.assertEqual(rows, fmpxmlparser.parse_from_string(SAMPLE_EXPORT, lean=True)['results'])
+        self.assertEqual(cache.read(file_digest(export)), rows)
+        self.assertEqual(cache.load_rows(export), rows)
+    
+    def test_eviction(self):
+        cache = ExportCache(self.directory, 1024 * 1024)
+        
+        first_export = BytesIO(SAMPLE_EXPORT.encode("utf-8"))
+        cache.load_rows(first_export)
+        first_path = cache.path(file_digest(first_export))
+        
+        #Make room for exactly one file, with the first one the least recently used
+        cache.max_size = os.path.getsize(first_path)
+        os.utime(first_path, (0, 0))
+        
+        second_export = BytesIO(SAMPLE_EXPORT.replace("ST00001", "ST00009").encode("utf-8"))
+        cache.load_rows(second_export)
+        
+        self.assertFalse(os.path.exists(first_path))
+        self.assertTrue(os.path.exists(cache.path(file_digest(second_export))))
+    
+    def test_directory_is_private(self):
+        directory = os.path.join(self.directory, 'exports')
+        
+        ExportCache(directory, 1024 * 1024).load_rows(BytesIO(SAMPLE_EXPORT.encode("utf-8")))
+        self.assertEqual(os.stat(directory).st_mode & 0o777, 0o700)
+        
+        os.chmod(directory, 0o777)
+        ExportCache(directory, 1024 * 1024).load_rows(BytesIO(SAMPLE_EXPORT.encode("utf-8")))
+        self.assertEqual(os.stat(directory).st_mode & 0o777, 0o700)
+    
+    def test_foreign_directory_is_refused(self):
+        cache = ExportCache(self.directory, 1024 * 1024)
+        
+        with mock.patch('os.getuid', return_value=os.getuid() + 1):
+            with self.assertRaises(UnsafeCacheDirectoryException):
+                cache.load_rows(BytesIO(SAMPLE_EXPORT.encode("utf-8")))
+        
+        self.assertEqual(os.listdir(self.directory), [])
+    
+    def test_stale_decoder_version(self):
+        export = BytesIO(SAMPLE_EXPORT.encode("utf-8"))
+        cache = ExportCache(self.directory, 1024 * 1024)
+        cache.load_rows(export)
+        
+        #A cache file written before the decoder changed is parsed again
+        with mock.patch('academics.utils.exportcache.CACHE_VERSION', (CACHE_FORMAT, fmpxmlparser.DECODER_VERSION + 1)):
+            self.assertIsNone(cache.read(file_digest(export)))
+        
+        self.assertFalse(os.path.exists(cache.path(file_digest(export))))
+
+class SyntheticExportTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def test_write_exports(self):
+        exports = write_exports(self.directory, students=10, sections=5, registrations=20, date_format="M/d/yy")
+        
+        for command_name, (path, row_count) in exports.items():
+            self.assertEqual(len(list(fmpxmlparser.iter_rows(path, lean=True))), row_count)
+        
+        enrollments = list(fmpxmlparser.iter_rows(exports['import_enrollments'][0], lean=True))
+        self.assertEqual(enrollments[1]['EnrollmentDate'], date(2015, 9, 2))
+        self.assertEqual(enrollments[1]['Grade'], Decimal(10))
+    
+    def test_dry_run(self):
+        exports = write_exports(self.directory, students=10, sections=5, registrations=20, date_format="M/d/yy")
+        
+        call_command('import_teachers', exports['import_teachers'][0], dry_run=True)
+        
+        self.assertFalse(Teacher.objects.exists())
+        self.assertFalse(Teacher.history.exists())
+        self.assertFalse(ImportChecksum.objects.exists())
+        
+        call_command('import_teachers', exports['import_teachers'][0])
+        
+        self.assertEqual(Teacher.objects.count(), exports['import_teachers'][1])
+
+class InstrumentationTestCase(TestCase):
+    def test_query_pattern(self):
+        self.assertEqual(query_pattern("SELECT * FROM teacher WHERE id IN (1, 2, 3) AND name = 'O''Brien'"), "SELECT * FROM teacher WHERE id IN (...) AND name = ?")
+        self.assertEqual(query_pattern("QUERY = 'SELECT * FROM teacher WHERE id = %s' - PARAMS = (4,)"), "SELECT * FROM teacher WHERE id = %s")
+    
+    def test_instrumented(self):
+        handle, path = tempfile.mkstemp()
+        os.close(handle)
+        
+        try:
+            with instrumented("test", json_path=path) as measurement:
+                for teacher_id in counted(["T001", "T002", "T003"]):
+                    Teacher.objects.filter(teacher_id=teacher_id).exists()
+                
+                Student.objects.count()
+                
+                self.assertIn("academics_student", connection.queries[-1]['sql'])
+            
+            self.assertEqual(measurement.queries, 4)
+            self.assertEqual(measurement.rows, 3)
+            self.assertEqual(len(measurement.slowest_statements()), 4)
+            self.assertEqual(sorted(pattern['count'] for pattern in measurement.top_patterns()), [1, 3])
+            
+            with open(path) as f:
+                self.assertEqual(json.loads(f.readline())['queries'], 4)
+        
+        finally:
+            os.remove(path)
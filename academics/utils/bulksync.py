@@ -0,0 +1,388 @@
+import logging
+from collections import Counter
+from contextlib import contextmanager
+
+from django.db import connection, router, transaction
+from django.db.models import Case, When, Value, signals
+from django.db.models.deletion import Collector
+from django.db.models.sql import DeleteQuery, UpdateQuery
+from simple_history.models import HistoricalRecords
+
+from academics.utils.history import buffered_history, bulk_create_history, HISTORY_CREATED, HISTORY_CHANGED, HISTORY_DELETED
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+
+@contextmanager
+def sync_transaction(dry_run=False):
+    """One transaction around an import, with its history rows buffered.
+    
+    With dry_run the import still runs in full, so its log shows what it would
+    create, change and delete, and then the whole transaction is rolled back."""
+    
+    with transaction.atomic():
+        with buffered_history():
+            yield
+        
+        #After buffered_history has flushed, since no query may follow set_rollback
+        if dry_run:
+            logger.warn("Dry run; rolling back every change")
+            transaction.set_rollback(True)
+
+def as_key(key_fields, values):
+    return tuple(values[key_field] for key_field in key_fields)
+
+def object_key(key_fields, obj):
+    return tuple(getattr(obj, key_field) for key_field in key_fields)
+
+def preload(queryset, key_fields):
+    #Map the natural key of every row in queryset to its object
+    return dict((object_key(key_fields, obj), obj) for obj in queryset)
+
+def chunks(items, size):
+    items = list(items)
+    
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def collect_deletions(objs, batch_size=BATCH_SIZE):
+    #Work out what deleting objs cascades to, a chunk of objs per Collector
+    collectors = []
+    
+    for chunk in chunks(objs, batch_size):
+        collector = Collector(using=router.db_for_write(type(chunk[0])))
+        collector.collect(chunk)
+        collector.sort()
+        
+        collectors.append(collector)
+    
+    return collectors
+
+def count_deletions(collectors):
+    counts = Counter()
+    
+    for collector in collectors:
+        for model, instances in collector.data.items():
+            counts[model] += len(instances)
+        
+        for qs in collector.fast_deletes:
+            counts[qs.model] += qs.count()
+    
+    return counts
+
+def delete_receivers(signal, model):
+    #The receivers of signal for model, less simple_history's, whose history rows are written in bulk instead
+    return [receiver for receiver in signal._live_receivers(model) if not isinstance(getattr(receiver, '__self__', None), HistoricalRecords)]
+
+def send_delete_signal(signal, model, instances, using):
+    #Collector.delete leaves out auto-created through models too
+    if model._meta.auto_created:
+        return
+    
+    receivers = delete_receivers(signal, model)
+    
+    for obj in instances:
+        for receiver in receivers:
+            receiver(signal=signal, sender=model, instance=obj, using=using)
+
+def execute_deletions(collectors, batch_size=BATCH_SIZE):
+    """Carry out collected deletions without simple_history saving every row.
+    
+    Deleting rows one by one makes simple_history write each history row on its
+    own. Here the history rows for a whole chunk are written in bulk and the
+    rows themselves go in a few DELETE ... WHERE id IN (...) statements. Any
+    other pre_delete and post_delete receivers, like the completion counters
+    of the evaluables a student takes with them, still run for every row."""
+    
+    for collector in collectors:
+        using = collector.using
+        
+        with transaction.atomic(using=using, savepoint=False):
+            for model, instances in collector.data.items():
+                send_delete_signal(signals.pre_delete, model, instances, using)
+                bulk_create_history(instances, HISTORY_DELETED, batch_size=batch_size)
+            
+            for qs in collector.fast_deletes:
+                qs._raw_delete(using=using)
+            
+            for model, instances_for_fieldvalues in collector.field_updates.items():
+                for (field, value), instances in instances_for_fieldvalues.items():
+                    UpdateQuery(model).update_batch([obj.pk for obj in instances], {field.name: value}, using)
+            
+            for model, instances in collector.data.items():
+                DeleteQuery(model).delete_batch([obj.pk for obj in instances], using)
+            
+            for model, instances in collector.data.items():
+                send_delete_signal(signals.post_delete, model, instances, using)
+
+def delete_objects(objs, batch_size=BATCH_SIZE):
+    #Delete objs and everything that cascades from them; returns a Counter of rows per model
+    collectors = collect_deletions(objs, batch_size)
+    counts = count_deletions(collectors)
+    
+    execute_deletions(collectors, batch_size)
+    
+    return counts
+
+class Lookup(object):
+    """Foreign key lookup table loaded once and keyed by natural key.
+    
+    When create is given, a missing key is passed to it and the object it returns
+    is saved and remembered, the way the importers fill in academic years and grades."""
+    
+    def __init__(self, queryset, key_fields, create=None):
+        if isinstance(key_fields, str):
+            key_fields = (key_fields, )
+        
+        self.key_fields = key_fields
+        self.create = create
+        self.objects = preload(queryset, key_fields)
+    
+    def get(self, *key):
+        obj = self.objects.get(key)
+        
+        if obj is None and self.create:
+            obj = self.create(*key)
+            obj.save()
+            
+            self.objects[key] = obj
+        
+        return obj
+    
+    def __contains__(self, key):
+        return key in self.objects
+
+class SharedLookups(object):
+    """The lookup tables of one import run, shared between its stages.
+    
+    A table is loaded the first time a stage asks for it. A stage that syncs
+    a model publishes its BulkSync under the table's name, so the stages after
+    it see the rows it created or deleted without loading the model again."""
+    
+    def __init__(self):
+        self.tables = {}
+    
+    def table(self, name, queryset, key_fields, create=None):
+        if name not in self.tables:
+            self.tables[name] = Lookup(queryset, key_fields, create=create)
+        
+        return self.tables[name]
+    
+    def publish(self, name, table):
+        self.tables[name] = table
+
+class BulkSync(object):
+    """Insert or update the rows of one model from an export in a handful of queries.
+    
+    Every existing row is loaded up front and keyed by its natural key. sync()
+    diffs an incoming row against it in memory, logging each changed attribute,
+    and write() saves all new rows with bulk_create and all changed rows with
+    one CASE update per attribute and batch."""
+    
+    def __init__(self, model, key_fields, queryset=None, batch_size=BATCH_SIZE):
+        if isinstance(key_fields, str):
+            key_fields = (key_fields, )
+        
+        if queryset is None:
+            queryset = model.objects.all()
+        
+        self.model = model
+        self.key_fields = key_fields
+        self.batch_size = batch_size
+        
+        self.existing = preload(queryset, key_fields)
+        self.fields = {}
+        
+        self.created = {}
+        self.updated = {}
+        self.seen = set()
+    
+    def get(self, *key):
+        return self.existing.get(key) or self.created.get(key)
+    
+    def __contains__(self, key):
+        return key in self.existing or key in self.created
+    
+    @property
+    def model_name(self):
+        return self.model._meta.verbose_name
+    
+    def get_field(self, attr):
+        if attr not in self.fields:
+            self.fields[attr] = self.model._meta.get_field(attr)
+        
+        return self.fields[attr]
+    
+    def unchanged(self, obj, attrs):
+        #Foreign keys are compared by id, the way sync() compares them
+        current = []
+        desired = []
+        
+        for attr, desired_value in attrs.items():
+            field = self.get_field(attr)
+            current.append(getattr(obj, field.attname))
+            
+            if field.is_relation and desired_value is not None:
+                desired_value = desired_value.pk
+            
+            desired.append(desired_value)
+        
+        return tuple(current) == tuple(desired)
+    
+    def sync(self, lookup, attrs, label):
+        """Bring the row with the natural key in lookup in line with attrs.
+        
+        lookup maps the key fields to their values and is used to build the
+        object when it does not exist yet. label names the row in the log."""
+        
+        key = as_key(self.key_fields, lookup)
+        self.seen.add(key)
+        
+        obj = self.get(*key)
+        
+        if obj is None:
+            logger.info("Creating {model:} {label:}".format(model=self.model_name, label=label))
+            
+            obj = self.model(**lookup)
+            self.created[key] = obj
+        
+        elif key not in self.created:
+            logger.info("Found {model:} {label:}".format(model=self.model_name, label=label))
+            
+            #Most rows have not changed, and one tuple comparison settles that without diffing attribute by attribute
+            if key not in self.updated and self.unchanged(obj, attrs):
+                return obj
+        
+        changed_attrs = self.updated.get(key, set())
+        
+        for attr, desired_value in attrs.items():
+            field = self.get_field(attr)
+            
+            #Compare foreign keys by id so the related row is never fetched just to diff it
+            if field.is_relation:
+                db_value = getattr(obj, field.attname)
+                desired_id = desired_value.pk if desired_value is not None else None
+                
+                if db_value == desired_id:
+                    continue
+                
+                if key not in self.created:
+                    db_value = getattr(obj, attr)
+            
+            else:
+                db_value = getattr(obj, attr)
+                
+                if db_value == desired_value:
+                    continue
+            
+            setattr(obj, attr, desired_value)
+            
+            if key not in self.created:
+                logger.info("Updating {attr:} on {label:} from {oldValue:} to {newValue:}".format(attr=attr, label=label, oldValue=db_value, newValue=desired_value))
+                changed_attrs.add(attr)
+        
+        if changed_attrs:
+            self.updated[key] = changed_attrs
+        
+        return obj
+    
+    def mark_seen(self, *key):
+        #Keep a row that is in the export but was not synced from deleting as stale
+        self.seen.add(key)
+    
+    def delete_stale(self, dry_run=False, within=None):
+        """Delete the existing rows that were not in the export.
+        
+        within limits the reconciliation to the existing rows it returns true
+        for, so an export that only covers some academic years leaves the
+        other years alone. The counts are logged before anything is deleted;
+        with dry_run they are all that happens."""
+        
+        stale = [obj for key, obj in self.existing.items() if key not in self.seen and (within is None or within(obj))]
+        
+        if not stale:
+            return Counter()
+        
+        for obj in stale:
+            logger.warn("Deleting extra {model:} {key:}".format(model=self.model_name, key="/".join(str(part) for part in object_key(self.key_fields, obj))))
+        
+        collectors = collect_deletions(stale, self.batch_size)
+        counts = count_deletions(collectors)
+        
+        for model, count in counts.items():
+            logger.warn("{action:} {count:} {model:} row(s)".format(action=dry_run and "Would delete" or "Deleting", count=count, model=model._meta.verbose_name))
+        
+        if not dry_run:
+            execute_deletions(collectors, self.batch_size)
+            
+            for obj in stale:
+                del self.existing[object_key(self.key_fields, obj)]
+        
+        return counts
+    
+    def write(self):
+        self.write_created()
+        self.write_updated()
+    
+    def write_created(self):
+        if not self.created:
+            return
+        
+        self.model.objects.bulk_create(self.created.values(), batch_size=self.batch_size)
+        
+        #bulk_create does not give back primary keys, so load the new rows again
+        key_field = self.key_fields[0]
+        
+        for key_chunk in chunks(set(key[0] for key in self.created), self.batch_size):
+            for obj in self.model.objects.filter(**{key_field + "__in": key_chunk}):
+                key = object_key(self.key_fields, obj)
+                
+                if key in self.created:
+                    self.existing[key] = obj
+                    self.created[key] = obj
+        
+        bulk_create_history(self.created.values(), HISTORY_CREATED, batch_size=self.batch_size)
+        
+        self.created = {}
+    
+    def write_updated(self):
+        if not self.updated:
+            return
+        
+        objs = [(self.existing[key], changed_attrs) for key, changed_attrs in self.updated.items()]
+        
+        auto_now_fields = [field for field in self.model._meta.concrete_fields if getattr(field, 'auto_now', False)]
+        
+        #Each object in a batch contributes a WHEN (two parameters) and a pk__in parameter
+        batch_size = min(self.batch_size, connection.ops.bulk_batch_size(['pk', 'pk', 'value'], objs) or self.batch_size)
+        
+        for batch in chunks(objs, batch_size):
+            for field in auto_now_fields:
+                for obj, changed_attrs in batch:
+                    field.pre_save(obj, False)
+                    changed_attrs.add(field.name)
+            
+            attrs = set()
+            for obj, changed_attrs in batch:
+                attrs.update(changed_attrs)
+            
+            for attr in attrs:
+                field = self.model._meta.get_field(attr)
+                changed_objs = [obj for obj, changed_attrs in batch if attr in changed_attrs]
+                
+                #PostgreSQL types a CASE of nothing but NULLs as text, which FK, date and integer columns reject, so cleared values get a plain UPDATE
+                cleared_pks = [obj.pk for obj in changed_objs if getattr(obj, field.attname) is None]
+                changed_objs = [obj for obj in changed_objs if getattr(obj, field.attname) is not None]
+                
+                if cleared_pks:
+                    self.model.objects.filter(pk__in=cleared_pks).update(**{attr: None})
+                
+                if changed_objs:
+                    whens = [When(pk=obj.pk, then=Value(getattr(obj, field.attname), output_field=field)) for obj in changed_objs]
+                    
+                    self.model.objects.filter(pk__in=[obj.pk for obj in changed_objs]).update(**{attr: Case(*whens, output_field=field)})
+        
+        bulk_create_history([obj for obj, changed_attrs in objs], HISTORY_CHANGED, batch_size=self.batch_size)
+        
+        self.updated = {}
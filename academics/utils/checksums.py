@@ -0,0 +1,80 @@
+import hashlib
+import logging
+
+from academics.models import ImportChecksum
+from academics.utils.bulksync import chunks, BATCH_SIZE
+
+logger = logging.getLogger(__name__)
+
+def row_checksum(row, fields=None):
+    #Hash the field names along with the values so a change to the export layout counts as a change
+    if fields is None:
+        fields = tuple(row.keys())
+    
+    return hashlib.sha1(repr((fields, tuple(row[name] for name in fields))).encode('utf-8')).hexdigest()
+
+def checksum_key(key):
+    if isinstance(key, tuple):
+        return "/".join(str(part) for part in key)
+    
+    return str(key)
+
+class RowChecksums(object):
+    """The content hashes of the rows an importer synced on its last run.
+    
+    unchanged() tells the importer whether a row is identical to the last one
+    it synced under the same natural key, so it can be skipped before it is
+    diffed or written. A row only has its new hash stored once the importer
+    calls synced() for it, so rows that were skipped for errors are retried
+    on the next run. Rows written with a lookup that failed are passed to
+    failed() instead, which drops their stored hash so they are retried too.
+    With full every row counts as changed. fields limits the hash to the
+    columns the importer reads."""
+    
+    def __init__(self, importer, full=False, fields=None, batch_size=BATCH_SIZE):
+        self.importer = importer
+        self.full = full
+        self.fields = fields
+        self.batch_size = batch_size
+        
+        self.stored = dict(ImportChecksum.objects.filter(importer=importer).values_list('key', 'checksum'))
+        
+        self.checksums = {}
+        self.synced_keys = set()
+        self.failed_keys = set()
+        self.skipped = 0
+    
+    def unchanged(self, key, row, exists=True):
+        #exists says whether the row the hash describes is still in the database
+        key = checksum_key(key)
+        checksum = row_checksum(row, self.fields)
+        
+        self.checksums[key] = checksum
+        
+        if self.full or not exists or self.stored.get(key) != checksum:
+            return False
+        
+        self.skipped += 1
+        return True
+    
+    def synced(self, key):
+        self.synced_keys.add(checksum_key(key))
+    
+    def failed(self, key):
+        self.failed_keys.add(checksum_key(key))
+    
+    def write(self, dry_run=False):
+        #Replace the hashes of the rows synced this run and drop those of rows that left the export
+        if self.skipped:
+            logger.info("Skipped {count:} unchanged {importer:} row(s)".format(count=self.skipped, importer=self.importer))
+        
+        replaced = set(key for key in self.synced_keys if self.stored.get(key) != self.checksums[key])
+        removed = [key for key in self.stored if key in replaced or key in self.failed_keys or key not in self.checksums]
+        
+        if dry_run:
+            return
+        
+        for key_chunk in chunks(removed, self.batch_size):
+            ImportChecksum.objects.filter(importer=self.importer, key__in=key_chunk).delete()
+        
+        ImportChecksum.objects.bulk_create([ImportChecksum(importer=self.importer, key=key, checksum=self.checksums[key]) for key in replaced], batch_size=self.batch_size)
@@ -0,0 +1,187 @@
+import hashlib
+import logging
+import os
+import pickle
+import tempfile
+
+from stat import S_IMODE
+
+from django.conf import settings
+
+from academics.utils import fmpxmlparser
+
+logger = logging.getLogger(__name__)
+
+#Bump when the layout of a cache file changes so old files are parsed again
+CACHE_FORMAT = 1
+
+#A cache file is only used if both its layout and the decoder that produced it are current
+CACHE_VERSION = (CACHE_FORMAT, fmpxmlparser.DECODER_VERSION)
+
+READ_SIZE = 1024 * 1024
+
+def file_digest(f):
+    #SHA-256 of a path or an open file; an open file is rewound for whoever reads it next
+    digest = hashlib.sha256()
+    
+    if isinstance(f, str):
+        with open(f, 'rb') as export_file:
+            for block in iter(lambda: export_file.read(READ_SIZE), b''):
+                digest.update(block)
+    
+    else:
+        f.seek(0)
+        
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            digest.update(block)
+        
+        f.seek(0)
+    
+    return digest.hexdigest()
+
+class ExportCache(object):
+    """Decoded export rows on local disk, keyed by the SHA-256 of the export.
+    
+    A cache file holds the field names once and then the record IDs and value
+    tuples of every row, pickled with the highest protocol available. Reading
+    an export that is already cached skips XML decoding entirely. Once the
+    files add up to more than max_size bytes the least recently read ones are
+    removed.
+    
+    Unpickling runs code, so the directory is created readable by its owner
+    only, and one owned by another user is refused rather than read from."""
+    
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.prepared = False
+    
+    def prepare(self):
+        if self.prepared:
+            return
+        
+        os.makedirs(self.directory, mode=0o700, exist_ok=True)
+        
+        directory_stat = os.stat(self.directory)
+        
+        if directory_stat.st_uid != os.getuid():
+            raise UnsafeCacheDirectoryException(self.directory)
+        
+        #A directory left over from an older default may still be readable or writable by others
+        if S_IMODE(directory_stat.st_mode) & 0o077:
+            os.chmod(self.directory, 0o700)
+        
+        self.prepared = True
+    
+    def path(self, digest):
+        return os.path.join(self.directory, "{digest:}.pickle".format(digest=digest))
+    
+    def load_rows(self, f):
+        #The rows of the export f as LeanRows, from the cache when it has them
+        digest = file_digest(f)
+        
+        rows = self.read(digest)
+        
+        if rows is None:
+            rows = list(fmpxmlparser.iter_rows(f, lean=True))
+            self.write(digest, rows)
+        
+        return rows
+    
+    def read(self, digest):
+        self.prepare()
+        
+        path = self.path(digest)
+        
+        try:
+            with open(path, 'rb') as cache_file:
+                cache_format, field_names, record_ids, values = pickle.load(cache_file)
+        
+        except FileNotFoundError:
+            return None
+        
+        except (pickle.UnpicklingError, EOFError, ValueError) as e:
+            logger.warn("Discarding unreadable export cache file {path:}: {error:}".format(path=path, error=e))
+            self.remove(path)
+            return None
+        
+        if cache_format != CACHE_VERSION:
+            self.remove(path)
+            return None
+        
+        #Mark the file as recently used so eviction keeps it
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        
+        row_class = fmpxmlparser.lean_row_class(field_names)
+        
+        return [row_class(record_id, row_values) for record_id, row_values in zip(record_ids, values)]
+    
+    def write(self, digest, rows):
+        field_names = rows and rows[0].field_names or ()
+        data = (CACHE_VERSION, field_names, [row.RECORDID for row in rows], [row.values for row in rows])
+        
+        self.prepare()
+        
+        #Write to a temporary file first so a reader never sees half a cache file
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        
+        try:
+            with os.fdopen(handle, 'wb') as cache_file:
+                pickle.dump(data, cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+            
+            os.replace(temp_path, self.path(digest))
+        
+        except Exception:
+            self.remove(temp_path)
+            raise
+        
+        self.evict()
+    
+    def evict(self):
+        entries = []
+        
+        for name in os.listdir(self.directory):
+            if not name.endswith('.pickle'):
+                continue
+            
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            
+            entries.append((stat.st_mtime, stat.st_size, name))
+        
+        total_size = sum(size for mtime, size, name in entries)
+        
+        for mtime, size, name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            
+            logger.info("Evicting {name:} from the export cache".format(name=name))
+            self.remove(os.path.join(self.directory, name))
+            
+            total_size -= size
+    
+    def remove(self, path):
+        #Another process may have removed it first
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+class UnsafeCacheDirectoryException(Exception):
+    def __init__(self, directory, *args, **kwargs):
+        super(UnsafeCacheDirectoryException, self).__init__(self, *args, **kwargs)
+        self.directory = directory
+    
+    def __str__(self):
+        return "Export cache directory {directory:} is not owned by this user".format(directory=self.directory)
+
+def get_export_cache():
+    return ExportCache(settings.EXPORT_CACHE_DIR, settings.EXPORT_CACHE_MAX_SIZE)
+
+def load_rows(f):
+    return get_export_cache().load_rows(f)
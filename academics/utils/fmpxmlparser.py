@@ -1,7 +1,13 @@
+import os
 import xml.etree.ElementTree as ET
 
-from datetime import date
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime
 from decimal import Decimal
+from functools import lru_cache
 
 import logging
 import warnings
@@ -13,21 +19,36 @@ NAMESPACES = {
     'fmpxmlresult': 'http://www.filemaker.com/fmpxmlresult'
 }
 
+TAGS = dict((name, '{{{namespace:}}}{name:}'.format(namespace=NAMESPACES['fmpxmlresult'], name=name)) for name in ('DATABASE', 'METADATA', 'RESULTSET', 'ROW'))
+
+NAN = float('nan')
+
+#Bump whenever a change here alters the values rows decode to, so cached decodes are redone
+DECODER_VERSION = 1
+
+#Parallel decoding cuts the RESULTSET into chunks of about this many bytes
+CHUNK_SIZE = 4 * 1024 * 1024
+HEADER_READ_SIZE = 64 * 1024
+
+ROW_END_TAG = b'</ROW>'
+CHUNK_START_TAG = '<RESULTSET xmlns="{namespace:}">'.format(namespace=NAMESPACES['fmpxmlresult']).encode('utf-8')
+CHUNK_END_TAG = b'</RESULTSET>'
+
 PARSE_MODE_ABSOLUTE = 0
 PARSE_MODE_RELATIVE = 1
 
-def parse_from_file(f):
+def parse_from_file(f, lean=False):
     tree = ET.parse(f)
     root = tree.getroot()
     
-    return parse_from_root(root)
+    return parse_from_root(root, lean=lean)
 
-def parse_from_string(s):
+def parse_from_string(s, lean=False):
     root = ET.fromstring(s)
     
-    return parse_from_root(root)
-    
-def parse_from_root(root):
+    return parse_from_root(root, lean=lean)
+
+def parse_from_root(root, lean=False):
     data = {}
     
     database_node = root.find('fmpxmlresult:DATABASE', NAMESPACES)
@@ -36,15 +57,267 @@ def parse_from_root(root):
     data['PRODUCT'] = root.find('fmpxmlresult:PRODUCT', NAMESPACES).attrib
     
     data['DATABASE'] = database_node.attrib
+    
+    metadata_node = root.find('fmpxmlresult:METADATA', NAMESPACES)
+    field_map = build_field_map(database_node, metadata_node)
+    
+    if lean:
+        decode_row = compile_row_decoder(field_map)
+    else:
+        decode_row = lambda row: parse_row(row, field_map)
+    
+    resultset_node = root.find('fmpxmlresult:RESULTSET', NAMESPACES)
+    rows = resultset_node.findall('fmpxmlresult:ROW', NAMESPACES)
+    
+    data['results'] = []
+    
+    for row in rows:
+        data['results'].append(decode_row(row))
+    
+    return(data)
+
+def iter_rows(f, lean=False):
+    """Yield the rows of an export one at a time without building the whole tree.
+    
+    Each row has the same shape as an entry of parse_from_file(f)['results'],
+    or is a LeanRow when lean is set. Finished ROW elements are discarded as
+    soon as they are yielded, so memory use does not grow with the size of the
+    export."""
+    
+    decode_row = None
+    
+    for kind, value in iter_export(f):
+        if kind == 'ROW':
+            yield decode_row(value)
+        
+        elif kind == 'METADATA':
+            if lean:
+                decode_row = compile_row_decoder(value)
+            else:
+                decode_row = lambda row, field_map=value: parse_row(row, field_map)
+
+def iter_export(f):
+    #Stream ('DATABASE', attributes), then ('METADATA', field map), then ('ROW', element) for every row
+    database_node = None
+    resultset_node = None
+    
+    for event, node in ET.iterparse(f, events=('start', 'end')):
+        if event == 'start':
+            if node.tag == TAGS['RESULTSET']:
+                resultset_node = node
+            
+            continue
+        
+        if node.tag == TAGS['ROW']:
+            yield ('ROW', node)
+            
+            #Drop the finished row from the RESULTSET so it can be collected
+            resultset_node.remove(node)
+        
+        elif node.tag == TAGS['DATABASE']:
+            database_node = node
+            yield ('DATABASE', node.attrib)
+        
+        elif node.tag == TAGS['METADATA']:
+            field_map = build_field_map(database_node, node)
+            node.clear()
+            
+            yield ('METADATA', field_map)
+
+def parse_columnar(f, fields=None):
+    """Decode an export into one column per FIELD rather than one record per ROW.
+    
+    Returns a dict with the DATABASE attributes, the RECORDID of every row
+    and the columns, keyed by field name in export order. NUMBER columns are
+    arrays of floats with NaN for an empty cell; every other column is a list
+    with None for an empty cell, converted as in parse_row. When fields is
+    given only those columns are decoded and the rest are skipped as each row
+    is read."""
+    
+    data = {'RECORDID': []}
+    record_ids = data['RECORDID']
+    decoders = None
+    
+    for kind, value in iter_export(f):
+        if kind == 'ROW':
+            for index, converter, append in decoders:
+                append(converter(value[index][0].text))
+            
+            record_ids.append(value.attrib['RECORDID'])
+        
+        elif kind == 'DATABASE':
+            data['DATABASE'] = value
+        
+        elif kind == 'METADATA':
+            data['columns'], decoders = build_column_decoders(value, fields)
+    
+    return data
+
+def build_column_decoders(field_map, fields=None):
+    field_names = [field['name'] for field in field_map]
+    
+    if fields is None:
+        fields = field_names
+    
+    for name in fields:
+        if name not in field_names:
+            raise FieldNotFoundException(name)
+    
+    columns = OrderedDict()
+    decoders = []
+    
+    for index, field in enumerate(field_map):
+        if field['name'] not in fields:
+            continue
+        
+        if field['type'] == 'NUMBER':
+            column = array('d')
+            converter = lambda value: float(value) if value else NAN
+        else:
+            column = []
+            converter = lambda value, converter=field['converter']: value and converter(value) or None
+        
+        columns[field['name']] = column
+        decoders.append((index, converter, column.append))
+    
+    return columns, decoders
+
+def columnar_rows(data):
+    #LeanRows over the decoded columns of parse_columnar(), for code written against rows
+    row_class = lean_row_class(tuple(data['columns'].keys()))
+    
+    for record_id, values in zip(data['RECORDID'], zip(*data['columns'].values())):
+        yield row_class(record_id, values)
+
+def iter_rows_parallel(f, max_workers=None, chunk_size=CHUNK_SIZE):
+    """Yield the rows of an export as LeanRows, decoded by a pool of processes.
+    
+    The RESULTSET is cut into chunks of about chunk_size bytes, each ending
+    on a ROW boundary, and every chunk is parsed and converted in a worker.
+    Rows come back in export order. Only a couple of chunks per worker are in
+    flight at once, so memory use stays bounded however large the export is.
+    With max_workers of 1 this is iter_rows(f, lean=True)."""
+    
+    if max_workers == 1:
+        yield from iter_rows(f, lean=True)
+        return
+    
+    max_workers = max_workers or os.cpu_count() or 1
+    
+    with open_export(f) as export_file:
+        header, remainder = read_header(export_file)
+        
+        root = ET.fromstring(header + b'</FMPXMLRESULT>')
+        database_node = root.find('fmpxmlresult:DATABASE', NAMESPACES)
+        fields = root.find('fmpxmlresult:METADATA', NAMESPACES).findall('fmpxmlresult:FIELD', NAMESPACES)
+        
+        row_class = lean_row_class(tuple(field.attrib['NAME'] for field in fields))
+        field_types = tuple(field.attrib['TYPE'] for field in fields)
+        date_format = database_node.attrib['DATEFORMAT']
+        
+        if remainder is None:
+            return
+        
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque()
+            
+            for chunk in iter_row_chunks(export_file, remainder, chunk_size):
+                pending.append(executor.submit(decode_chunk, field_types, date_format, chunk))
+                
+                if len(pending) > max_workers * 2:
+                    for record_id, values in zip(*pending.popleft().result()):
+                        yield row_class(record_id, values)
+            
+            while pending:
+                for record_id, values in zip(*pending.popleft().result()):
+                    yield row_class(record_id, values)
 
-    date_parser = get_date_parser(database_node.attrib['DATEFORMAT']).parse_date
+@contextmanager
+def open_export(f):
+    #A path is opened and closed here; an open binary file is left open for the caller
+    if isinstance(f, str):
+        with open(f, 'rb') as export_file:
+            yield export_file
+    else:
+        yield f
+
+def read_header(export_file):
+    #Split off everything up to the RESULTSET start tag; the remainder is None when the RESULTSET is empty
+    buffer = b''
+    
+    while True:
+        start = buffer.find(b'<RESULTSET')
+        end = buffer.find(b'>', start)
+        
+        if start != -1 and end != -1:
+            if buffer[end - 1:end] == b'/':
+                return buffer[:start], None
+            
+            return buffer[:start], buffer[end + 1:]
+        
+        block = export_file.read(HEADER_READ_SIZE)
+        
+        if not block:
+            raise ValueError("The export has no RESULTSET")
+        
+        buffer += block
+
+def iter_row_chunks(export_file, buffer, chunk_size):
+    #Yield runs of whole ROW elements; whatever follows the last ROW is the end of the document
+    while True:
+        block = export_file.read(chunk_size)
+        buffer += block
+        
+        end = buffer.rfind(ROW_END_TAG)
+        
+        if end != -1 and (len(buffer) >= chunk_size or not block):
+            end += len(ROW_END_TAG)
+            
+            yield buffer[:end]
+            buffer = buffer[end:]
+        
+        if not block:
+            return
+
+@lru_cache(maxsize=16)
+def get_chunk_converters(field_types, date_format):
+    converter_map = get_converter_map(date_format)
+    return tuple(converter_map[field_type] for field_type in field_types)
+
+def decode_chunk(field_types, date_format, chunk):
+    #Runs in a worker process; returns the record IDs and value tuples of the ROWs in chunk
+    converters = get_chunk_converters(field_types, date_format)
+    resultset_node = ET.fromstring(CHUNK_START_TAG + chunk + CHUNK_END_TAG)
+    
+    record_ids = []
+    values = []
+    
+    for row in resultset_node:
+        record_ids.append(row.attrib['RECORDID'])
+        values.append(tuple([value and converter(value) or None for converter, value in zip(converters, [col_node[0].text for col_node in row])]))
+    
+    return record_ids, values
+
+def build_field_map(database_node, metadata_node):
+    converter_map = get_converter_map(database_node.attrib['DATEFORMAT'])
     
     field_map = []
     
-    metadata_node = root.find('fmpxmlresult:METADATA', NAMESPACES)
     fields = metadata_node.findall('fmpxmlresult:FIELD', NAMESPACES)
     
-    converter_map = {
+    for field in fields:
+        field_name = field.attrib['NAME']
+        field_type = field.attrib['TYPE']
+        converter = converter_map[field_type]
+        
+        field_map.append({'name': field_name, 'type': field_type, 'converter': converter})
+    
+    return field_map
+
+def get_converter_map(date_format):
+    date_parser = get_date_parser(date_format).parse_date
+    
+    return {
         'TEXT': str.strip,
         'NUMBER': Decimal,
         'DATE': date_parser,
@@ -52,41 +325,108 @@ def parse_from_root(root):
         'TIMESTAMP': lambda c: None,
         'CONTAINER': lambda c: None
     }
+
+def parse_row(row, field_map):
+    data_row = {'RECORDID': row.attrib["RECORDID"], 'fields': {}, 'parsed_fields': {}}
     
-    for field in fields:
-        field_name = field.attrib['NAME']
-        field_type = field.attrib['TYPE']
-        converter = converter_map[field_type]
+    for i, col_node in enumerate(row.findall('fmpxmlresult:COL', NAMESPACES)):
+        value = col_node.find('fmpxmlresult:DATA', NAMESPACES).text
+        field = field_map[i]
         
-        field_map.append({'name': field_name, 'type': field_type, 'converter': converter})
+        col_name = field["name"]
+        col_type = field["type"]
         
-    resultset_node = root.find('fmpxmlresult:RESULTSET', NAMESPACES)
-    rows = resultset_node.findall('fmpxmlresult:ROW', NAMESPACES)
+        converter = field['converter']
+        converted_value = value and converter(value) or None
+        
+        result_row = {'name': col_name, 'type': col_type, 'original_value': value, 'converted_value': converted_value}
+        data_row['fields'][col_name] = result_row
+        
+        data_row['parsed_fields'][col_name] = converted_value
     
-    data['results'] = []
+    return data_row
+
+def compile_row_decoder(field_map):
+    """Build a function that decodes a ROW element straight into a LeanRow.
     
-    for row in rows:
-        data_row = {'RECORDID': row.attrib["RECORDID"], 'fields': {}, 'parsed_fields': {}}
+    The converters are fixed into a tuple once per export, so decoding a row
+    only walks its COL children and never builds the per-cell fields dicts."""
+    
+    field_names = tuple(field['name'] for field in field_map)
+    converters = tuple(field['converter'] for field in field_map)
+    
+    row_class = lean_row_class(field_names)
+    
+    def decode_row(row):
+        #Every COL holds a single DATA node; an empty value is None just as in parse_row
+        values = tuple([value and converter(value) or None for converter, value in zip(converters, [col_node[0].text for col_node in row])])
         
-        for i, col_node in enumerate(row.findall('fmpxmlresult:COL', NAMESPACES)):
-            value = col_node.find('fmpxmlresult:DATA', NAMESPACES).text
-            field = field_map[i]
-            
-            col_name = field["name"]
-            col_type = field["type"]
-            
-            converter = field['converter']
-            converted_value = value and converter(value) or None
-            
-            result_row = {'name': col_name, 'type': col_type, 'original_value': value, 'converted_value': converted_value}
-            data_row['fields'][col_name] = result_row
-            
-            data_row['parsed_fields'][col_name] = converted_value
-            
-        data['results'].append(data_row)
+        return row_class(row.attrib['RECORDID'], values)
     
-    return(data)
+    return decode_row
+
+@lru_cache(maxsize=None)
+def lean_row_class(field_names):
+    #One LeanRow subclass per field layout, shared by every export with that layout
+    return type('LeanRow', (LeanRow, ), {
+        '__slots__': (),
+        'field_names': field_names,
+        'field_index': dict((name, i) for i, name in enumerate(field_names)),
+    })
 
+def rebuild_lean_row(field_names, record_id, values):
+    return lean_row_class(field_names)(record_id, values)
+
+class LeanRow(object):
+    #Read-only mapping of field name to converted value, standing in for parsed_fields
+    __slots__ = ('RECORDID', 'values')
+    
+    field_names = ()
+    field_index = {}
+    
+    def __init__(self, record_id, values):
+        self.RECORDID = record_id
+        self.values = values
+    
+    def __getitem__(self, name):
+        return self.values[self.field_index[name]]
+    
+    def __contains__(self, name):
+        return name in self.field_index
+    
+    def __iter__(self):
+        return iter(self.field_names)
+    
+    def __len__(self):
+        return len(self.field_names)
+    
+    def __eq__(self, other):
+        if isinstance(other, LeanRow):
+            return self.RECORDID == other.RECORDID and self.as_dict() == other.as_dict()
+        
+        return NotImplemented
+    
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+    
+    def keys(self):
+        return self.field_names
+    
+    def items(self):
+        return zip(self.field_names, self.values)
+    
+    def as_dict(self):
+        return dict(self.items())
+    
+    def __reduce__(self):
+        #The row classes are built at runtime, so pickle rows by their field names
+        return (rebuild_lean_row, (self.field_names, self.RECORDID, self.values))
+    
+    def __repr__(self):
+        return "<LeanRow {record_id:}: {values:}>".format(record_id=self.RECORDID, values=self.as_dict())
 
 def get_date_parser(date_format):
     if date_format == "yyyy-mm-dd":
@@ -102,14 +442,14 @@ class ISO8601DateParser(object):
     def parse_date(self, s):
         year, month, day = [int(part) for part in s.split("-")]
         return date(year, month, day)
-        
+
 
 class FilemakerAbsoluteDateParser(object):
     def __init__(self, date_format):
         for attr in ("yy", "mm", "dd"):
             if attr not in date_format:
                 raise ParameterNotFoundException(attr)
-                
+        
         self.date_format = date_format
         
         if "yyyy" in date_format:
@@ -126,7 +466,7 @@ class FilemakerAbsoluteDateParser(object):
         year = int(s[self.year_start:self.year_start + self.year_length])
         if self.year_length == 2:
             year = year + 2000
-            
+        
         month = int(s[self.month_start:self.month_start+2])
         day = int(s[self.day_start:self.day_start+2])
         
@@ -140,8 +480,8 @@ class FilemakerFuzzyDateParser(object):
                 return s.replace(change_from, change_to)
         
         return s
-            
-    def __init__(self, date_format):
+    
+    def __init__(self, date_format, cache_size=4096):
         #Mangle the Filemaker date format into a Python date format
         change_groups = [
             [
@@ -174,11 +514,23 @@ class FilemakerFuzzyDateParser(object):
         
         self.parse_date_format = converted_date_format
         self.date_format = date_format
+        
+        #strptime is strict about the year width, so try four digits before two
+        self.strptime_formats = (converted_date_format.replace("%y", "%Y"), converted_date_format)
+        
+        #Exports repeat the same handful of dates, so remember what each string parsed to
+        self.parse_date = lru_cache(maxsize=cache_size)(self.parse_date_uncached)
     
-    def parse_date(self, s):
+    def parse_date_uncached(self, s):
+        for strptime_format in self.strptime_formats:
+            try:
+                return datetime.strptime(s, strptime_format).date()
+            except ValueError:
+                pass
+        
         dt = dateparser.parse(s, date_formats=[self.parse_date_format])
         return date(dt.year, dt.month, dt.day)
-        
+
 class ParameterNotFoundException(Exception):
     def __init__(self, parameter, *args, **kwargs):
         super(ParameterNotFoundException, self).__init__(self, *args, **kwargs)
@@ -186,6 +538,14 @@ class ParameterNotFoundException(Exception):
     
     def __str__(self):
         return "Parameter {parameter:} was not found".format(parameter=self.parameter)
-        
+
+class FieldNotFoundException(Exception):
+    def __init__(self, field_name, *args, **kwargs):
+        super(FieldNotFoundException, self).__init__(self, *args, **kwargs)
+        self.field_name = field_name
+    
+    def __str__(self):
+        return "Field {field_name:} is not in the export".format(field_name=self.field_name)
+
 class ShortDateWarning(Warning):
     pass
\ No newline at end of file
@@ -0,0 +1,50 @@
+import re
+from xml.sax.saxutils import escape, quoteattr
+
+from academics.utils.fmpxmlparser import NAMESPACES
+
+DATE_TOKENS = re.compile(r'yyyy|yy|mm|M|dd|d')
+
+def format_date(d, date_format):
+    #Render a date in a FileMaker DATEFORMAT such as yyyy-mm-dd or M/d/yy
+    tokens = {
+        'yyyy': "{:04d}".format(d.year),
+        'yy': "{:02d}".format(d.year % 100),
+        'mm': "{:02d}".format(d.month),
+        'M': str(d.month),
+        'dd': "{:02d}".format(d.day),
+        'd': str(d.day),
+    }
+    
+    return DATE_TOKENS.sub(lambda match: tokens[match.group(0)], date_format)
+
+def write_export(f, fields, rows, database_name="export.fmp12", date_format="yyyy-mm-dd"):
+    """Write an FMPXMLRESULT export in the layout Keystone produces.
+    
+    fields is a list of (name, type) pairs and rows an iterable of
+    (record_id, values) pairs, with every value already formatted as text
+    (None for an empty cell). Rows are written as they are consumed, so
+    a generator can describe an export of any size."""
+    
+    f.write('<?xml version="1.0" encoding="UTF-8" ?>\n')
+    f.write('<FMPXMLRESULT xmlns={namespace:}>\n'.format(namespace=quoteattr(NAMESPACES['fmpxmlresult'])))
+    f.write('<ERRORCODE>0</ERRORCODE>\n')
+    f.write('<PRODUCT BUILD="11-07-2013" NAME="FileMaker" VERSION="ProAdvanced 13.0v1"/>\n')
+    f.write('<DATABASE DATEFORMAT={date_format:} LAYOUT="" NAME={name:} RECORDS="0" TIMEFORMAT="h:mm:ss a"/>\n'.format(date_format=quoteattr(date_format), name=quoteattr(database_name)))
+    
+    f.write('<METADATA>\n')
+    for name, field_type in fields:
+        f.write('<FIELD EMPTYOK="YES" MAXREPEAT="1" NAME={name:} TYPE={type:}/>\n'.format(name=quoteattr(name), type=quoteattr(field_type)))
+    f.write('</METADATA>\n')
+    
+    f.write('<RESULTSET FOUND="0">\n')
+    for record_id, values in rows:
+        f.write('<ROW MODID="1" RECORDID="{record_id:}">'.format(record_id=record_id))
+        
+        for value in values:
+            f.write('<COL><DATA>{value:}</DATA></COL>'.format(value=escape(value or "")))
+        
+        f.write('</ROW>\n')
+    f.write('</RESULTSET>\n')
+    
+    f.write('</FMPXMLRESULT>\n')
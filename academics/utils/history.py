@@ -0,0 +1,127 @@
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.utils import timezone
+
+from simple_history.models import HistoricalRecords
+
+logger = logging.getLogger(__name__)
+
+HISTORY_CREATED = '+'
+HISTORY_CHANGED = '~'
+HISTORY_DELETED = '-'
+
+BATCH_SIZE = 500
+
+_local = threading.local()
+
+def get_history_model(model):
+    #The historical model simple_history generated for model, or None if it has no history
+    manager_name = getattr(model._meta, 'simple_history_manager_attribute', None)
+    
+    if not manager_name:
+        return None
+    
+    return getattr(model, manager_name).model
+
+def build_historical_record(instance, history_type, history_date=None, history_user=None):
+    history_model = get_history_model(type(instance))
+    
+    attrs = {}
+    for field in instance._meta.fields:
+        attrs[field.attname] = getattr(instance, field.attname)
+    
+    return history_model(history_date=history_date or timezone.now(), history_type=history_type, history_user=history_user, **attrs)
+
+def bulk_create_history(instances, history_type, batch_size=None):
+    """Write the history records simple_history would have written for instances.
+    
+    bulk_create and queryset updates do not send post_save, so anything written
+    that way has to have its history recorded here to keep the audit trail.
+    Inside buffered_history() the records join the buffer instead."""
+    
+    instances = list(instances)
+    
+    if not instances:
+        return []
+    
+    history_model = get_history_model(type(instances[0]))
+    
+    if not history_model:
+        return []
+    
+    history_date = timezone.now()
+    records = [build_historical_record(instance, history_type, history_date) for instance in instances]
+    
+    history_buffer = get_history_buffer()
+    
+    if history_buffer is not None:
+        history_buffer.extend(records)
+        return records
+    
+    return history_model.objects.bulk_create(records, batch_size=batch_size)
+
+class HistoryBuffer(object):
+    def __init__(self, batch_size=BATCH_SIZE):
+        self.batch_size = batch_size
+        self.records = OrderedDict()
+    
+    def extend(self, records):
+        for record in records:
+            self.records.setdefault(type(record), []).append(record)
+    
+    def __len__(self):
+        return sum(len(records) for records in self.records.values())
+    
+    def flush(self):
+        for history_model, records in self.records.items():
+            logger.info("Writing {count:} {model:} row(s)".format(count=len(records), model=history_model._meta.verbose_name))
+            history_model.objects.bulk_create(records, batch_size=self.batch_size)
+        
+        self.records = OrderedDict()
+
+def get_history_buffer():
+    return getattr(_local, 'history_buffer', None)
+
+_create_historical_record = HistoricalRecords.create_historical_record
+
+def create_historical_record(self, instance, history_type):
+    history_buffer = get_history_buffer()
+    
+    if history_buffer is None:
+        return _create_historical_record(self, instance, history_type)
+    
+    #Snapshot the row now, with the date and user simple_history would have used
+    history_date = getattr(instance, '_history_date', None) or timezone.now()
+    history_buffer.extend([build_historical_record(instance, history_type, history_date, self.get_history_user(instance))])
+
+HistoricalRecords.create_historical_record = create_historical_record
+
+@contextmanager
+def buffered_history(batch_size=BATCH_SIZE):
+    """Collect every history record written in the block and bulk insert them at the end.
+    
+    This covers the records simple_history writes from post_save and post_delete
+    as well as those from bulk_create_history(). Use it inside transaction.atomic()
+    so the buffer is flushed just before the import commits; if the block raises,
+    the buffered records are dropped along with the rolled back rows. Nested
+    blocks share the outermost buffer."""
+    
+    if get_history_buffer() is not None:
+        yield get_history_buffer()
+        return
+    
+    _local.history_buffer = HistoryBuffer(batch_size)
+    
+    try:
+        yield _local.history_buffer
+        
+        history_buffer = _local.history_buffer
+        _local.history_buffer = None
+        
+        history_buffer.flush()
+    
+    finally:
+        _local.history_buffer = None
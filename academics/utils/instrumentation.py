@@ -0,0 +1,213 @@
+import heapq
+import json
+import logging
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+SLOWEST_COUNT = 10
+PATTERN_COUNT = 10
+SQL_DISPLAY_LENGTH = 500
+
+_local = threading.local()
+
+#Literals become ? and lists of them collapse, so statements that differ only in their values share a pattern
+QUERY_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+QUERY_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+QUERY_WHENS = re.compile(r"(?:WHEN \S+ = \? THEN \? ?)+")
+
+#SQLite's debug cursor logs the statement quoted, with its parameters alongside
+SQLITE_QUERY = re.compile(r"^QUERY = '(.*)' - PARAMS = .*$", re.S)
+
+def query_pattern(sql):
+    match = SQLITE_QUERY.match(sql)
+    
+    if match:
+        sql = match.group(1)
+    
+    pattern = QUERY_LITERALS.sub("?", sql)
+    pattern = QUERY_LISTS.sub("(...)", pattern)
+    return QUERY_WHENS.sub("WHEN ... ", pattern)
+
+class QueryRecorder(object):
+    """Stands in for a connection's queries_log while a command is measured.
+    
+    Every statement the debug cursor logs is counted, timed and grouped by
+    pattern before being passed on to the original log. The parts of the
+    deque interface Django touches are passed through too, so code that reads
+    connection.queries keeps working while a command is measured."""
+    
+    def __init__(self, measurement, queries_log):
+        self.measurement = measurement
+        self.queries_log = queries_log
+    
+    def append(self, query):
+        self.measurement.record_query(query['sql'], float(query['time']))
+        self.queries_log.append(query)
+    
+    def clear(self):
+        self.queries_log.clear()
+    
+    @property
+    def maxlen(self):
+        #connection.queries compares the log's length to this to warn when old queries were dropped
+        return self.queries_log.maxlen
+    
+    def __iter__(self):
+        return iter(self.queries_log)
+    
+    def __len__(self):
+        return len(self.queries_log)
+
+class Measurement(object):
+    def __init__(self, name):
+        self.name = name
+        self.started = timezone.now()
+        
+        self.rows = 0
+        self.queries = 0
+        self.db_time = 0.0
+        self.wall_time = None
+        
+        self.slowest = []
+        self.pattern_counts = Counter()
+        self.pattern_times = defaultdict(float)
+    
+    def record_query(self, sql, query_time):
+        self.queries += 1
+        self.db_time += query_time
+        
+        pattern = query_pattern(sql)
+        self.pattern_counts[pattern] += 1
+        self.pattern_times[pattern] += query_time
+        
+        #A min-heap of the slowest statements so far; the query number breaks ties
+        entry = (query_time, self.queries, sql[:SQL_DISPLAY_LENGTH])
+        
+        if len(self.slowest) < SLOWEST_COUNT:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+    
+    def slowest_statements(self):
+        return [{'time': query_time, 'sql': sql} for query_time, query_number, sql in sorted(self.slowest, reverse=True)]
+    
+    def top_patterns(self):
+        patterns = sorted(self.pattern_times, key=lambda pattern: self.pattern_times[pattern], reverse=True)[:PATTERN_COUNT]
+        return [{'pattern': pattern[:SQL_DISPLAY_LENGTH], 'count': self.pattern_counts[pattern], 'time': self.pattern_times[pattern]} for pattern in patterns]
+    
+    def as_dict(self):
+        return {
+            'command': self.name,
+            'started': self.started.isoformat(),
+            'wall_time': self.wall_time,
+            'db_time': self.db_time,
+            'queries': self.queries,
+            'rows': self.rows,
+            'slowest': self.slowest_statements(),
+            'patterns': self.top_patterns(),
+        }
+    
+    def log(self):
+        logger.info("{name:} finished in {wall_time:.2f}s: {rows:} row(s), {queries:} queries, {db_time:.2f}s in the database".format(name=self.name, wall_time=self.wall_time, rows=self.rows, queries=self.queries, db_time=self.db_time))
+        
+        for pattern in self.top_patterns():
+            logger.info("{count:>8} queries {time:>8.3f}s  {pattern:}".format(**pattern))
+        
+        for statement in self.slowest_statements():
+            logger.info("Slow query {time:.3f}s: {sql:}".format(**statement))
+    
+    def write_json(self, path):
+        #One JSON document per line, so every command of a nightly run can share a file
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(self.as_dict()) + "\n")
+
+def get_measurement():
+    return getattr(_local, 'measurement', None)
+
+@contextmanager
+def instrumented(name, json_path=None):
+    """Measure the queries, database time, wall time and rows of the block.
+    
+    The debug cursor is switched on for every connection and its log is
+    wrapped by a QueryRecorder. Rows are counted by counted() and
+    count_rows(). The results are logged when the block exits and, with
+    json_path, appended to that file. Nested blocks share the outermost
+    measurement."""
+    
+    if get_measurement() is not None:
+        yield get_measurement()
+        return
+    
+    measurement = Measurement(name)
+    _local.measurement = measurement
+    
+    saved = []
+    for connection in connections.all():
+        saved.append((connection, connection.force_debug_cursor, connection.queries_log))
+        
+        connection.force_debug_cursor = True
+        connection.queries_log = QueryRecorder(measurement, connection.queries_log)
+    
+    start = time.perf_counter()
+    
+    try:
+        yield measurement
+    
+    finally:
+        measurement.wall_time = time.perf_counter() - start
+        _local.measurement = None
+        
+        for connection, force_debug_cursor, queries_log in saved:
+            connection.force_debug_cursor = force_debug_cursor
+            connection.queries_log = queries_log
+        
+        measurement.log()
+        
+        if json_path:
+            measurement.write_json(json_path)
+
+def count_rows(count=1):
+    measurement = get_measurement()
+    
+    if measurement is not None:
+        measurement.rows += count
+
+def counted(rows):
+    #Pass rows through, counting them against the current measurement
+    measurement = get_measurement()
+    
+    if measurement is None:
+        return rows
+    
+    return _counted(rows, measurement)
+
+def _counted(rows, measurement):
+    for row in rows:
+        measurement.rows += 1
+        yield row
+
+class InstrumentedCommand(BaseCommand):
+    """A management command whose every run is measured with instrumented().
+    
+    Adds a --metrics-json option for appending the results to a file."""
+    
+    def create_parser(self, prog_name, subcommand):
+        parser = super(InstrumentedCommand, self).create_parser(prog_name, subcommand)
+        parser.add_argument('--metrics-json', metavar='FILENAME', default=None, help='Append the query and timing measurements of this run to a JSON lines file')
+        
+        return parser
+    
+    def execute(self, *args, **options):
+        name = self.__module__.rsplit('.', 1)[-1]
+        
+        with instrumented(name, json_path=options.get('metrics_json')):
+            return super(InstrumentedCommand, self).execute(*args, **options)
@@ -0,0 +1,92 @@
+import os
+from datetime import date, timedelta
+
+from academics.utils.fmpxmlwriter import write_export, format_date
+
+#The DATEFORMAT values Keystone has been seen to export with
+DATE_FORMATS = ('yyyy-mm-dd', 'M/d/yyyy', 'mm/dd/yyyy', 'M/d/yy')
+
+ACADEMIC_YEAR = "2015-2016"
+
+TEACHER_FIELDS = ['IDTEACHER', 'NameFirst', 'NameLast', 'NamePrefix', 'EmailSchool', 'Active Employee', 'NameUnique']
+COURSE_FIELDS = ['CourseNumber', 'CourseName', 'CourseNameShort', 'CourseNameTranscript', 'Division', 'GradeLevel', 'DepartmentName', 'CourseType']
+FAMILY_FIELDS = ['IDFAMILY', 'P_address_full', 'P_phone_H', 'Pa_first', 'Pa_last', 'Pa_email', 'Pa_phone_W', 'Pa_phone_cell', 'Pb_first', 'Pb_last', 'Pb_email', 'Pb_phone_W', 'Pb_phone_cell']
+PERMREC_FIELDS = ['IDSTUDENT', 'NameFirst', 'NameLast', 'NameNickname', 'EMailSchool', 'PasswordActiveDirctory', 'Network_User_Name', 'Sex'] + [
+    name for family_number in '1234' for name in ['IDFamily' + family_number, 'P' + family_number + 'a_Relation', 'P' + family_number + 'b_Relation']
+]
+ENROLLMENT_FIELDS = [('IDStudent', 'TEXT'), ('AcademicYear', 'TEXT'), ('BoarderDay', 'TEXT'), ('DormName', 'TEXT'), ('Grade', 'NUMBER'), ('Division', 'TEXT'), ('Section Letter', 'TEXT'), ('IDAdvisor', 'TEXT'), ('StatusEnrollment', 'TEXT'), ('StatusAttending', 'TEXT'), ('EnrollmentDate', 'DATE')]
+SECTION_FIELDS = ['CourseNumber', 'CourseSectionNumber', 'AcademicYear', 'IDTeacher']
+STUDENTREG_FIELDS = ['CSN', 'AcademicYear', 'IDStudent', 'IDSTUDENTREG']
+
+def text_fields(names):
+    return [(name, 'TEXT') for name in names]
+
+def teacher_id(i):
+    return "T{:04d}".format(i)
+
+def student_id(i):
+    return "S{:06d}".format(i)
+
+def family_id(i):
+    return "F{:06d}".format(i)
+
+def course_number(i):
+    return "C{:04d}".format(i)
+
+def csn(i):
+    return "CSN{:05d}".format(i)
+
+def write_exports(directory, students=1000, sections=200, registrations=None, date_format='yyyy-mm-dd'):
+    """Write a consistent set of Keystone exports of the given size to directory.
+    
+    There is one family per student, a teacher for every five sections and a
+    course for every four, and registrations are spread evenly over the
+    students and sections (six per student unless registrations is given).
+    Returns the path and row count of each export, keyed by import command."""
+    
+    if registrations is None:
+        registrations = students * 6
+    
+    teachers = max(1, sections // 5)
+    courses = max(1, sections // 4)
+    
+    enrolled_date = date(2015, 9, 1)
+    
+    exports = [
+        ('import_teachers', 'teachers.xml', text_fields(TEACHER_FIELDS), teachers, lambda i: [
+            teacher_id(i), "First{}".format(i), "Teacher{}".format(i), "Mr.", "teacher{}@example.com".format(i), "1", "Teacher{}".format(i),
+        ]),
+        ('import_courses', 'courses.xml', text_fields(COURSE_FIELDS), courses, lambda i: [
+            course_number(i), "Course {}".format(i), "Course {}".format(i), "Course {}".format(i), "US", str(9 + i % 4), "Department {}".format(i % 8), "Academic",
+        ]),
+        ('import_families', 'families.xml', text_fields(FAMILY_FIELDS), students, lambda i: [
+            family_id(i), "{} Main Street\nPomfret, CT".format(i), "555-0100", "Parent{}".format(i), "Family{}".format(i), "a{}@example.com".format(i), "", "555-0101",
+            "Other{}".format(i), "Family{}".format(i), "b{}@example.com".format(i), "", "555-0102",
+        ]),
+        ('import_permrecs', 'permrecs.xml', text_fields(PERMREC_FIELDS), students, lambda i: [
+            student_id(i), "First{}".format(i), "Student{}".format(i), "", "student{}@example.com".format(i), "password", "student{}".format(i), i % 2 and "F" or "M",
+            family_id(i), "Mother", "Father",
+        ] + [None] * 9),
+        ('import_enrollments', 'enrollments.xml', ENROLLMENT_FIELDS, students, lambda i: [
+            student_id(i), ACADEMIC_YEAR, i % 2 and "B" or "D", None, str(9 + i % 4), "US", "A", teacher_id(i % teachers), "Enrolled", "Attending",
+            format_date(enrolled_date + timedelta(days=i % 30), date_format),
+        ]),
+        ('import_sections', 'sections.xml', text_fields(SECTION_FIELDS), sections, lambda i: [
+            course_number(i % courses), csn(i), ACADEMIC_YEAR, teacher_id(i % teachers),
+        ]),
+        ('import_studentreg', 'studentreg.xml', text_fields(STUDENTREG_FIELDS), registrations, lambda i: [
+            csn(i % sections), ACADEMIC_YEAR, student_id(i % students), "R{:07d}".format(i),
+        ]),
+    ]
+    
+    paths = {}
+    
+    for command_name, filename, fields, row_count, build_row in exports:
+        path = os.path.join(directory, filename)
+        
+        with open(path, 'w', encoding='utf-8') as f:
+            write_export(f, fields, ((i + 1, build_row(i)) for i in range(row_count)), date_format=date_format)
+        
+        paths[command_name] = (path, row_count)
+    
+    return paths
@@ -12,10 +12,11 @@ from django.core.mail import send_mail
 
 from academics.models import Parent, StudentParentRelation
 from change_notifier.models import FamilyChangeNotification
+from academics.utils.instrumentation import InstrumentedCommand, counted
 
 logger = logging.getLogger(__name__)
 
-class Command(BaseCommand):
+class Command(InstrumentedCommand):
     help = "Import reset student's current status"
     
     def handle(self, *args, **kwargs):
@@ -46,7 +47,7 @@ class Command(BaseCommand):
         relevant_parents = []
         irrelevant_parents = []
         
-        for parent_i, updated_parent in enumerate(updated_parents):
+        for parent_i, updated_parent in enumerate(counted(updated_parents)):
           if config.current_students_only:
             is_relevant = False
           
@@ -1,7 +1,7 @@
 from django.contrib import admin, messages
 from django.core import urlresolvers
 from django.contrib.admin.utils import flatten_fieldsets
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from django.conf.urls import url
 from django.shortcuts import redirect, get_object_or_404
 from django.db import transaction
@@ -9,10 +9,12 @@ from django.contrib.auth.decorators import permission_required
 
 from adminsortable.admin import SortableAdmin, NonSortableParentAdmin, SortableStackedInline
 
-from courseevaluations.models import QuestionSet, FreeformQuestion, MultipleChoiceQuestion, MultipleChoiceQuestionOption, EvaluationSet, DormParentEvaluation, CourseEvaluation, IIPEvaluation, MultipleChoiceQuestionAnswer, FreeformQuestionAnswer, StudentEmailTemplate
+from courseevaluations.models import QuestionSet, FreeformQuestion, MultipleChoiceQuestion, MultipleChoiceQuestionOption, EvaluationSet, DormParentEvaluation, CourseEvaluation, IIPEvaluation, MultipleChoiceQuestionAnswer, FreeformQuestionAnswer, StudentEmailTemplate, EvaluableCreationJob
 from academics.models import Student, AcademicYear, Enrollment, Section, Course, Teacher
 
-from academics.utils import fmpxmlparser
+from courseevaluations.lib.async import create_evaluables
+
+import django_rq
 
 class ReadOnlyAdmin(admin.ModelAdmin):
     def get_readonly_fields(self, request, obj=None):
@@ -129,6 +131,7 @@ class EvaluationSetAdmin(admin.ModelAdmin):
         extra_context = extra_context or {}
         
         extra_context["question_sets"] = QuestionSet.objects.all()
+        extra_context["creation_jobs"] = EvaluableCreationJob.objects.filter(evaluation_set_id=object_id)[:5]
         
         return super().change_view(request=request, object_id=object_id, form_url=form_url, extra_context=extra_context)
     
@@ -155,39 +158,7 @@ class EvaluationSetAdmin(admin.ModelAdmin):
             messages.error(request, "IIP evaluation file is required. No evaluations created.")
             return redirect(redirect_url)
             
-        data = fmpxmlparser.parse_from_file(iip_evaluation_file)
-        results = data['results']
-        
-        creation_count = 0
-        
-        with transaction.atomic():
-            question_set = get_object_or_404(QuestionSet, pk=question_set_id)
-            evaluation_set = get_object_or_404(EvaluationSet, pk=object_id)
-            academic_year = AcademicYear.objects.current()
-            
-            for row in results:
-                fields = row['parsed_fields']
-                
-                student_id = fields['IDStudent']
-                teacher_id = fields['SectionTeacher::IDTEACHER']
-                
-                student = Student.objects.get(student_id=student_id)
-                teacher = Teacher.objects.get(teacher_id=teacher_id)
-                enrollment = Enrollment.objects.get(student=student, academic_year=academic_year)
-                
-                evaluable = IIPEvaluation()
-                evaluable.student = student
-                evaluable.teacher = teacher
-                evaluable.evaluation_set = evaluation_set
-                evaluable.question_set = question_set
-                evaluable.enrollment = enrollment
-                
-                evaluable.save()
-                
-                creation_count += 1
-        
-        messages.add_message(request, messages.SUCCESS, "Successfully created {count:} IIP evaluations".format(count=creation_count))
-        return redirect(redirect_url)
+        return self.enqueue_creation_job(request, object_id, question_set_id, 'iip', upload=iip_evaluation_file)
         
     def create_course_evaluations(self, request, object_id):
         redirect_url = urlresolvers.reverse('admin:courseevaluations_evaluationset_change', args=(object_id, ))
@@ -212,38 +183,7 @@ class EvaluationSetAdmin(admin.ModelAdmin):
             messages.error(request, "Course evaluation file is required. No evaluations created.")
             return redirect(redirect_url)
             
-        data = fmpxmlparser.parse_from_file(course_evaluation_file)
-        results = data['results']
-        
-        creation_count = 0
-        
-        with transaction.atomic():
-            question_set = get_object_or_404(QuestionSet, pk=question_set_id)
-            evaluation_set = get_object_or_404(EvaluationSet, pk=object_id)
-            
-            for row in results:
-                fields = row['parsed_fields']
-                
-                csn = fields['CourseSectionNumber']
-                academic_year = fields['AcademicYear']
-                
-                section = Section.objects.get(csn=csn, academic_year__year=academic_year)
-                
-                for student in section.students.all():
-                    enrollment = Enrollment.objects.get(student=student, academic_year__year=academic_year)
-                    
-                    evaluable = CourseEvaluation()
-                    evaluable.student = student
-                    evaluable.enrollment = enrollment
-                    evaluable.section = section
-                    evaluable.question_set = question_set
-                    evaluable.evaluation_set = evaluation_set
-                    evaluable.save()
-                    
-                    creation_count += 1
-        
-        messages.add_message(request, messages.SUCCESS, "Successfully created {count:} course evaluations".format(count=creation_count))
-        return redirect(redirect_url)
+        return self.enqueue_creation_job(request, object_id, question_set_id, 'course', upload=course_evaluation_file)
     
     def create_dorm_parent_evaluations(self, request, object_id):
         redirect_url = urlresolvers.reverse('admin:courseevaluations_evaluationset_change', args=(object_id, ))
@@ -262,37 +202,31 @@ class EvaluationSetAdmin(admin.ModelAdmin):
             messages.error(request, "Question set is required. No evaluations created.")
             return redirect(redirect_url)
         
-        with transaction.atomic():
-            question_set = get_object_or_404(QuestionSet, pk=question_set_id)
-            evaluation_set = get_object_or_404(EvaluationSet, pk=object_id)
+        return self.enqueue_creation_job(request, object_id, question_set_id, 'dorm_parent')
             
-            academic_year = AcademicYear.objects.current()
+    def enqueue_creation_job(self, request, object_id, question_set_id, evaluation_type, upload=None):
+        #Hand the creation to the RQ worker so a large upload never holds up the request
+        redirect_url = urlresolvers.reverse('admin:courseevaluations_evaluationset_change', args=(object_id, ))
             
-            enrollments = Enrollment.objects.filter(student__current=True, academic_year=academic_year).exclude(dorm=None)
+        question_set = get_object_or_404(QuestionSet, pk=question_set_id)
+        evaluation_set = get_object_or_404(EvaluationSet, pk=object_id)
             
-            creation_count = 0
+        job = EvaluableCreationJob(evaluation_set=evaluation_set, question_set=question_set, evaluation_type=evaluation_type)
             
-            for enrollment in enrollments:
-                student = enrollment.student
-                dorm = enrollment.dorm
-                heads = dorm.heads.all()
+        if upload:
+            job.upload.save(upload.name, upload, save=False)
                 
-                for teacher in heads:
-                    evaluable = DormParentEvaluation()
-                    evaluable.question_set = question_set
-                    evaluable.evaluation_set = evaluation_set
+        job.save()
                     
-                    evaluable.dorm = dorm
-                    evaluable.parent = teacher
-                    evaluable.student = student
-                    evaluable.enrollment = enrollment
+        django_rq.enqueue(create_evaluables, job.id)
                     
-                    evaluable.save()
-                    creation_count += 1
+        messages.info(request, "Creating {evaluation_type:} in the background; progress is shown below".format(evaluation_type=job.get_evaluation_type_display()))
+        return redirect(redirect_url)
         
-        messages.add_message(request, messages.SUCCESS, "Successfully created {count:} dorm parent evaluations".format(count=creation_count))
+    def creation_job_status(self, request, object_id, job_id):
+        job = get_object_or_404(EvaluableCreationJob, pk=job_id, evaluation_set_id=object_id)
         
-        return redirect(redirect_url)
+        return JsonResponse(job.as_status())
     
     def get_urls(self):
         urls = super().get_urls()
@@ -309,6 +243,10 @@ class EvaluationSetAdmin(admin.ModelAdmin):
             url(r'^(?P<object_id>[0-9]+)/process/create/iip/$', 
                 self.admin_site.admin_view(self.create_iip_evaluations),
                 name='courseevaluations_evaluationset_create_iip_evals'),
+            
+            url(r'^(?P<object_id>[0-9]+)/process/jobs/(?P<job_id>[0-9]+)/$', 
+                self.admin_site.admin_view(self.creation_job_status),
+                name='courseevaluations_evaluationset_creation_job_status'),
         ]
         
         return my_urls + urls
@@ -319,6 +257,10 @@ class IIPEvaluationAdmin(ReadOnlyAdmin):
 class DormParentEvaluationAdmin(ReadOnlyAdmin):
     list_filter = ['evaluation_set__name', 'dorm', ('student', admin.RelatedOnlyFieldListFilter)]
     
+class EvaluableCreationJobAdmin(ReadOnlyAdmin):
+    list_display = ['__str__', 'rows_read', 'evaluable_count', 'created_at', 'updated_at']
+    list_filter = ['evaluation_set__name', 'evaluation_type', 'status']
+
 # Register your models here.
 admin.site.register(QuestionSet, QuestionSetAdmin)
 admin.site.register(FreeformQuestion, SortableAdmin)
@@ -327,4 +269,5 @@ admin.site.register(EvaluationSet, EvaluationSetAdmin)
 admin.site.register(CourseEvaluation, CourseEvaluationAdmin)
 admin.site.register(IIPEvaluation, IIPEvaluationAdmin)
 admin.site.register(DormParentEvaluation, DormParentEvaluationAdmin)
-admin.site.register(StudentEmailTemplate)
\ No newline at end of file
+admin.site.register(StudentEmailTemplate)
+admin.site.register(EvaluableCreationJob, EvaluableCreationJobAdmin)
\ No newline at end of file
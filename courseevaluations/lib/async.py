@@ -1,26 +1,39 @@
-from courseevaluations.models import StudentEmailTemplate
+from courseevaluations.models import StudentEmailTemplate, EvaluableCreationJob
+from courseevaluations.lib.creation import run_creation_job
+from courseevaluations.lib.mailing import send_throttled, EMAIL_BATCH_SIZE
+from academics.utils.bulksync import chunks
 from academics.models import Student
-from django.core.mail import send_mail
-import time
+from django.core.mail import EmailMessage
 
 def send_student_email_from_template(template_id, student_id, override_email=None):
-    time.sleep(1) #Make an e-mail take at least one second to slow down for SES
-    student = Student.objects.get(pk=student_id)
+    send_student_emails_from_template(template_id, [student_id], override_email=override_email)
+
+def send_student_emails_from_template(template_id, student_ids, override_email=None):
     template = StudentEmailTemplate.objects.get(pk=template_id)
+    students = Student.objects.filter(pk__in=student_ids).order_by('last_name', 'first_name')
     
-    msg = template.get_message(student)
+    def messages():
+        #Render a batch of students at a time, loading each batch's evaluables together
+        for batch in chunks(students, EMAIL_BATCH_SIZE):
+            for msg in template.get_messages(batch):
+                if override_email:
+                    msg.to = [override_email]
     
-    if override_email:
-        msg.to = [override_email]
+                yield msg
     
-    msg.send()
+    send_throttled(messages())
 
 def send_confirmation_email(addresses, to_addresses):
-    time.sleep(1) #Make an e-mail take at least one second to slow down for SES
     body = "Your e-mail was sent to the following {count:} people: \n\n{addresses:}".format(count=len(addresses), addresses="\n".join(addresses))
     
-    send_mail("Message confirmation", body, "technology@rectoryschool.org", to_addresses)
+    send_throttled([EmailMessage("Message confirmation", body, "technology@rectoryschool.org", to_addresses)])
 
 def send_msg(message):
-    time.sleep(1)
-    message.send()
\ No newline at end of file
+    send_throttled([message])
+
+def send_msgs(messages):
+    send_throttled(messages)
+
+def create_evaluables(job_id):
+    job = EvaluableCreationJob.objects.get(pk=job_id)
+    run_creation_job(job)
@@ -0,0 +1,282 @@
+#!/usr/bin/python
+
+import logging
+from collections import defaultdict
+
+from django.db import connections, router, transaction
+from django.db.models import AutoField, Max
+
+from academics.models import Student, Teacher, Enrollment, Section, StudentRegistration, Dorm, AcademicYear
+from academics.utils import fmpxmlparser
+from academics.utils.bulksync import chunks, BATCH_SIZE
+from courseevaluations.models import EvaluationSet, Evaluable, CompletionCounter, CourseEvaluation, IIPEvaluation, DormParentEvaluation
+
+logger = logging.getLogger(__name__)
+
+#How many upload rows a creation job reads between progress updates
+PROGRESS_INTERVAL = 200
+
+class EvaluableCreationError(Exception):
+    pass
+
+def load_enrollments(student_ids, academic_year_ids):
+    #Map (student id, academic year id) to enrollment id, a chunk of students per query
+    enrollments = {}
+    
+    for student_chunk in chunks(set(student_ids), BATCH_SIZE):
+        enrollments.update(((student_id, academic_year_id), enrollment_id) for enrollment_id, student_id, academic_year_id in Enrollment.objects.filter(student_id__in=student_chunk, academic_year_id__in=academic_year_ids).order_by().values_list('id', 'student_id', 'academic_year_id'))
+    
+    return enrollments
+
+def build_course_evaluations(rows, evaluation_set, question_set):
+    """A CourseEvaluation for every student registered in each section of rows.
+    
+    rows are the CourseSectionNumber/AcademicYear rows of a Keystone export.
+    The sections, their registrations and the students' enrollments are each
+    loaded with one query per chunk rather than one query per row."""
+    
+    section_keys = []
+    
+    for fields in rows:
+        section_keys.append((fields['CourseSectionNumber'], fields['AcademicYear']))
+    
+    sections = {}
+    
+    for key_chunk in chunks(set(section_keys), BATCH_SIZE):
+        csns = set(csn for csn, year in key_chunk)
+        years = set(year for csn, year in key_chunk)
+        
+        for section in Section.objects.filter(csn__in=csns, academic_year__year__in=years).select_related('academic_year'):
+            sections[(section.csn, section.academic_year.year)] = section
+    
+    for csn, year in section_keys:
+        if (csn, year) not in sections:
+            raise EvaluableCreationError("Section {csn:} does not exist for {year:}".format(csn=csn, year=year))
+    
+    section_students = defaultdict(list)
+    
+    for section_chunk in chunks(set(section.id for section in sections.values()), BATCH_SIZE):
+        for section_id, student_id in StudentRegistration.objects.filter(section_id__in=section_chunk).values_list('section_id', 'student_id'):
+            section_students[section_id].append(student_id)
+    
+    academic_year_ids = set(section.academic_year_id for section in sections.values())
+    enrollments = load_enrollments((student_id for student_ids in section_students.values() for student_id in student_ids), academic_year_ids)
+    
+    evaluables = []
+    
+    for key in section_keys:
+        section = sections[key]
+        
+        for student_id in section_students[section.id]:
+            enrollment_id = enrollments.get((student_id, section.academic_year_id))
+            
+            if enrollment_id is None:
+                raise EvaluableCreationError("Student {student:} in section {csn:} has no {year:} enrollment".format(student=Student.objects.get(pk=student_id), csn=section.csn, year=section.academic_year.year))
+            
+            evaluables.append(CourseEvaluation(student_id=student_id, enrollment_id=enrollment_id, section=section, question_set=question_set, evaluation_set=evaluation_set))
+    
+    return evaluables
+
+def build_iip_evaluations(rows, evaluation_set, question_set, academic_year):
+    #An IIPEvaluation for every IDStudent/SectionTeacher::IDTEACHER row, with students, teachers and enrollments loaded up front
+    pairs = []
+    
+    for fields in rows:
+        pairs.append((fields['IDStudent'], fields['SectionTeacher::IDTEACHER']))
+    
+    students = {}
+    teachers = {}
+    
+    for student_chunk in chunks(set(student_id for student_id, teacher_id in pairs), BATCH_SIZE):
+        students.update(Student.objects.filter(student_id__in=student_chunk).values_list('student_id', 'id'))
+    
+    for teacher_chunk in chunks(set(teacher_id for student_id, teacher_id in pairs), BATCH_SIZE):
+        teachers.update(Teacher.objects.filter(teacher_id__in=teacher_chunk).values_list('teacher_id', 'id'))
+    
+    enrollments = load_enrollments(students.values(), [academic_year.id])
+    
+    evaluables = []
+    
+    for student_id, teacher_id in pairs:
+        if student_id not in students:
+            raise EvaluableCreationError("Student {student_id:} does not exist".format(student_id=student_id))
+        
+        if teacher_id not in teachers:
+            raise EvaluableCreationError("Teacher {teacher_id:} does not exist".format(teacher_id=teacher_id))
+        
+        enrollment_id = enrollments.get((students[student_id], academic_year.id))
+        
+        if enrollment_id is None:
+            raise EvaluableCreationError("Student {student_id:} has no {year:} enrollment".format(student_id=student_id, year=academic_year.year))
+        
+        evaluables.append(IIPEvaluation(student_id=students[student_id], teacher_id=teachers[teacher_id], enrollment_id=enrollment_id, question_set=question_set, evaluation_set=evaluation_set))
+    
+    return evaluables
+
+def build_dorm_parent_evaluations(evaluation_set, question_set, academic_year):
+    #A DormParentEvaluation for every current boarder and each head of their dorm
+    enrollments = list(Enrollment.objects.filter(student__current=True, academic_year=academic_year).exclude(dorm=None).order_by().values_list('id', 'student_id', 'dorm_id'))
+    
+    dorm_heads = defaultdict(list)
+    
+    for dorm_id, teacher_id in Dorm.heads.through.objects.filter(dorm_id__in=set(dorm_id for enrollment_id, student_id, dorm_id in enrollments)).values_list('dorm_id', 'teacher_id'):
+        dorm_heads[dorm_id].append(teacher_id)
+    
+    evaluables = []
+    
+    for enrollment_id, student_id, dorm_id in enrollments:
+        for teacher_id in dorm_heads[dorm_id]:
+            evaluables.append(DormParentEvaluation(student_id=student_id, enrollment_id=enrollment_id, dorm_id=dorm_id, parent_id=teacher_id, question_set=question_set, evaluation_set=evaluation_set))
+    
+    return evaluables
+
+def table_chain(model):
+    #The multi-table models between Evaluable and model, in the order their rows have to be inserted
+    chain = []
+    
+    while model is not Evaluable:
+        chain.insert(0, model)
+        model = next(iter(model._meta.parents))
+    
+    return chain
+
+def insert_rows(model, objs, fields, using):
+    batch_size = connections[using].ops.bulk_batch_size(fields, objs) or len(objs)
+    
+    for batch in chunks(objs, batch_size):
+        model._base_manager._insert(batch, fields=fields, using=using)
+
+def bulk_create_evaluables(evaluables, batch_size=BATCH_SIZE):
+    """Insert evaluables of any Evaluable subclass in batches; returns how many.
+    
+    Django cannot bulk_create multi-table inherited models, so the Evaluable
+    rows of a batch go in first and their ids are read back by matching the
+    new rows to the objects on their column values. Rows that match the same
+    values are identical, so which of them an object gets does not matter. The
+    rows of each subclass table then follow, a multi-row INSERT per table, and
+    the completion counters are moved to match. The evaluation sets are
+    locked for the rest of the transaction, so creation jobs for the same set
+    cannot pick up each other's rows."""
+    
+    using = router.db_for_write(Evaluable)
+    
+    evaluable_fields = [field for field in Evaluable._meta.local_concrete_fields if not isinstance(field, AutoField)]
+    attnames = tuple(field.attname for field in evaluable_fields)
+    
+    count = 0
+    
+    with transaction.atomic(using=using):
+        #Jobs for the same set take turns, so no other job's rows for it can be committed between reading Max(id) and reading the new rows back
+        list(EvaluationSet.objects.using(using).select_for_update().filter(pk__in=set(evaluable.evaluation_set_id for evaluable in evaluables)).order_by('pk').values_list('pk', flat=True))
+        
+        for batch in chunks(evaluables, batch_size):
+            for evaluable in batch:
+                evaluable.pre_save_polymorphic()
+            
+            last_id = Evaluable.base_objects.using(using).aggregate(last_id=Max('id'))['last_id'] or 0
+            
+            insert_rows(Evaluable, batch, evaluable_fields, using)
+            
+            new_ids = defaultdict(list)
+            
+            for row in Evaluable.base_objects.using(using).filter(id__gt=last_id, evaluation_set_id__in=set(evaluable.evaluation_set_id for evaluable in batch)).order_by('id').values_list('id', *attnames):
+                new_ids[row[1:]].append(row[0])
+            
+            for evaluable in batch:
+                key = tuple(getattr(evaluable, attname) for attname in attnames)
+                
+                if not new_ids[key]:
+                    raise EvaluableCreationError("Could not find the new row for {evaluable:}".format(evaluable=evaluable))
+                
+                evaluable_id = new_ids[key].pop(0)
+                evaluable.id = evaluable_id
+                
+                for model in table_chain(type(evaluable)):
+                    setattr(evaluable, model._meta.pk.attname, evaluable_id)
+            
+            models = defaultdict(list)
+            for evaluable in batch:
+                models[type(evaluable)].append(evaluable)
+            
+            for evaluable_model, objs in models.items():
+                for model in table_chain(evaluable_model):
+                    insert_rows(model, objs, model._meta.local_concrete_fields, using)
+            
+            CompletionCounter.objects.adjust_many(batch)
+            
+            count += len(batch)
+            logger.info("Created {count:} of {total:} evaluables".format(count=count, total=len(evaluables)))
+    
+    return count
+
+def track_rows(job, rows, interval=PROGRESS_INTERVAL):
+    #Pass rows through, publishing how many have been read every interval rows
+    rows_read = 0
+    
+    for fields in rows:
+        yield fields
+        
+        rows_read += 1
+        
+        if rows_read % interval == 0:
+            job.publish(rows_read=rows_read)
+    
+    job.publish(rows_read=rows_read)
+
+def discard_upload(job):
+    #Delete a finished job's upload from storage; returns the field for publish() to save
+    if not job.upload:
+        return {}
+    
+    job.upload.delete(save=False)
+    
+    return {'upload': job.upload}
+
+def run_creation_job(job):
+    """Create the evaluables of an EvaluableCreationJob, publishing its progress.
+    
+    The upload is streamed a row at a time while the evaluables are built,
+    with the rows read published as it goes. The evaluables are then inserted
+    in one transaction, so a failed job creates nothing. The upload is deleted
+    once the job completes or fails. Returns how many evaluables were created."""
+    
+    evaluation_set = job.evaluation_set
+    question_set = job.question_set
+    
+    job.publish(status='reading')
+    
+    try:
+        if job.evaluation_type == 'dorm_parent':
+            evaluables = build_dorm_parent_evaluations(evaluation_set, question_set, AcademicYear.objects.current())
+        
+        else:
+            #Read through the storage API, which the worker may not share a filesystem with
+            job.upload.open('rb')
+            
+            try:
+                rows = track_rows(job, fmpxmlparser.iter_rows(job.upload, lean=True))
+                
+                if job.evaluation_type == 'course':
+                    evaluables = build_course_evaluations(rows, evaluation_set, question_set)
+                else:
+                    evaluables = build_iip_evaluations(rows, evaluation_set, question_set, AcademicYear.objects.current())
+            
+            finally:
+                job.upload.close()
+        
+        job.publish(status='creating', evaluable_count=len(evaluables))
+        
+        with transaction.atomic():
+            creation_count = bulk_create_evaluables(evaluables)
+    
+    except EvaluableCreationError as e:
+        job.publish(status='failed', message="{error:}. No evaluations created.".format(error=e), **discard_upload(job))
+        return 0
+    
+    except Exception as e:
+        job.publish(status='failed', message="Unexpected error: {error:}. No evaluations created.".format(error=e), **discard_upload(job))
+        raise
+    
+    job.publish(status='complete', message="Successfully created {count:} {evaluation_type:}".format(count=creation_count, evaluation_type=job.get_evaluation_type_display()), **discard_upload(job))
+    
+    return creation_count
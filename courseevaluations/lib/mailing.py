@@ -0,0 +1,94 @@
+#!/usr/bin/python
+
+import logging
+import time
+
+from django.conf import settings
+from django.core.mail import get_connection
+
+logger = logging.getLogger(__name__)
+
+#How many messages are rendered at once, and how often sending progress is logged
+EMAIL_BATCH_SIZE = 50
+
+#Seconds an e-mail job may run beyond its throttled sending time before RQ gives up on it
+SEND_TIMEOUT_MARGIN = 300
+
+class TokenBucket(object):
+    """Hands out tokens at rate per second, saving up at most capacity of them.
+    
+    take() blocks until a token is free, so callers that take one per message
+    average rate messages per second while idle time is not wasted."""
+    
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.clock = clock
+        self.sleep = sleep
+        
+        self.tokens = self.capacity
+        self.updated = clock()
+    
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def take(self):
+        self.refill()
+        
+        while self.tokens < 1:
+            self.sleep((1 - self.tokens) / self.rate)
+            self.refill()
+        
+        self.tokens -= 1
+
+def send_throttled(messages, rate=None, connection=None, bucket=None):
+    """Send messages one at a time over one connection; returns how many were sent.
+    
+    Each message takes a token from a TokenBucket right before it goes out, so
+    the mail backend never sees more than rate (EMAIL_MESSAGES_PER_SECOND by
+    default) messages per second. messages may be a generator, so rendering
+    can happen a batch at a time. A message that fails is logged and skipped;
+    stopping there would leave the rest unsent, and running the job again
+    would resend the ones already delivered. bucket replaces the TokenBucket
+    built from rate."""
+    
+    bucket = bucket or TokenBucket(rate or settings.EMAIL_MESSAGES_PER_SECOND)
+    connection = connection or get_connection()
+    
+    sent = 0
+    failed = 0
+    
+    connection.open()
+    
+    try:
+        for message in messages:
+            bucket.take()
+            
+            try:
+                sent += connection.send_messages([message]) or 0
+            
+            except Exception:
+                logger.exception("Could not send {subject:} to {to:}".format(subject=message.subject, to=", ".join(message.to)))
+                failed += 1
+                
+                #The failure may have left the connection unusable for the next message
+                connection.close()
+                connection.open()
+                
+                continue
+            
+            if sent % EMAIL_BATCH_SIZE == 0:
+                logger.info("Sent {sent:} messages".format(sent=sent))
+    
+    finally:
+        connection.close()
+    
+    logger.info("Sent {sent:} messages, {failed:} failed".format(sent=sent, failed=failed))
+    
+    return sent
+
+def send_timeout(message_count, rate=None):
+    #The RQ timeout for a job sending message_count messages
+    return int(message_count / (rate or settings.EMAIL_MESSAGES_PER_SECOND)) + SEND_TIMEOUT_MARGIN
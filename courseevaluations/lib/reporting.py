@@ -1,80 +1,77 @@
 #!/usr/bin/python
 
-from academics.models import Student, Section
-from courseevaluations.models import CourseEvaluation, IIPEvaluation, DormParentEvaluation
+from collections import OrderedDict
 
-def get_incomplete_evaluables_by_teacher(evaluation_set):
-    course_evaluables = CourseEvaluation.objects.filter(evaluation_set=evaluation_set, complete=False)
-    iip_evaluables = IIPEvaluation.objects.filter(evaluation_set=evaluation_set, complete=False)
-    dorm_parent_evaluables = DormParentEvaluation.objects.filter(evaluation_set=evaluation_set, complete=False)
+from django.db.models import Count, Case, When
     
-    data = {}
+from academics.models import Student, Enrollment, StudentRegistration
+from courseevaluations.models import Evaluable, CourseEvaluation, IIPEvaluation, DormParentEvaluation
+
+STUDENT_ORDER = ('student__last_name', 'student__first_name')
+
+def get_incomplete_evaluables_report(evaluation_set):
+    """The students with incomplete evaluables of evaluation_set, by teacher.
+    
+    Returns [(teacher, [(group, [students])])] with teachers by name, each
+    teacher's sections first, then IIP, then dorms, and students by name. Each
+    evaluable type is one select_related query ordered by student, so the
+    groups fill up already sorted in a single pass."""
+    
+    course_evaluables = CourseEvaluation.objects.non_polymorphic().filter(evaluation_set=evaluation_set, complete=False).select_related('student', 'section__course', 'section__teacher').order_by(*STUDENT_ORDER)
+    iip_evaluables = IIPEvaluation.objects.non_polymorphic().filter(evaluation_set=evaluation_set, complete=False).select_related('student', 'teacher').order_by(*STUDENT_ORDER)
+    dorm_parent_evaluables = DormParentEvaluation.objects.non_polymorphic().filter(evaluation_set=evaluation_set, complete=False).select_related('student', 'parent', 'dorm').order_by(*STUDENT_ORDER)
+    
+    #teacher: {(sort key, group label): [students]}
+    data = OrderedDict()
+    
+    def add(teacher, group, student):
+        data.setdefault(teacher, OrderedDict()).setdefault(group, []).append(student)
     
     for evaluable in course_evaluables:
         section = evaluable.section
-        course = section.course
-        teacher = section.teacher
-        student = evaluable.student
-        
-        if not teacher in data:
-            data[teacher] = {}
-        
-        if not 'course' in data[teacher]:
-            data[teacher]['course'] = {}
-            
-        if not section in data[teacher]['course']:
-            data[teacher]['course'][section] = []
-        
-        data[teacher]['course'][section].append(student)
+        label = "{course:}: {csn:}".format(course=section.course.course_name, csn=section.csn)
+        add(section.teacher, ((0, section.course.course_name, section.csn), label), evaluable.student)
     
     for evaluable in iip_evaluables:
-        teacher = evaluable.teacher
-        student = evaluable.student
-                
-        if not teacher in data:
-            data[teacher] = {}
-        
-        if not 'iip' in data[teacher]:
-            data[teacher]['iip'] = []
-        
-        data[teacher]['iip'].append(student)
+        add(evaluable.teacher, ((1, ), "IIP"), evaluable.student)
     
     for evaluable in dorm_parent_evaluables:
-        teacher = evaluable.parent
-        dorm = evaluable.dorm
-        student = evaluable.student
+        label = str(evaluable.dorm)
+        add(evaluable.parent, ((2, label), label), evaluable.student)
                 
-        if not teacher in data:
-            data[teacher] = {}
+    report = []
         
-        if not 'dorm' in data[teacher]:
-            data[teacher]['dorm'] = {}
+    for teacher in sorted(data, key=lambda t: (t.last_name, t.first_name)):
+        report.append((teacher, [(label, data[teacher][(key, label)]) for key, label in sorted(data[teacher])]))
         
-        if not dorm in data[teacher]['dorm']:
-            data[teacher]['dorm'][dorm] = []
+    return report
             
-        data[teacher]['dorm'][dorm].append(student)
+def get_advisor_tutor_status(evaluation_set, academic_year, iip_course_numbers):
+    """Each student's evaluable counts in evaluation_set, by advisor and IIP tutor.
     
-    return data
+    Returns {teacher: {student: (complete count, total count)}}. The counts are
+    one grouped query, and the students' advisors and IIP tutors one query
+    each, however many students there are."""
 
-def flatten_evaluables_by_teacher(data):
-    flattened_data = []
-    for teacher in sorted(data.keys(), key=lambda t: (t.last_name, t.first_name)):
-        section_row = []
-        flattened_data.append((teacher, section_row))
+    students = Student.objects.filter(evaluable__evaluation_set=evaluation_set)
+    students = students.annotate(complete_count=Count(Case(When(evaluable__complete=True, evaluable__evaluation_set=evaluation_set, then=1))))
+    students = students.annotate(total_count=Count(Case(When(evaluable__evaluation_set=evaluation_set, then=1))))
         
-        if 'course' in data[teacher]:
-            for section in sorted(data[teacher]['course'].keys(), key=lambda sec: (sec.course.course_name, sec.csn)):
-                student_row = sorted(data[teacher]['course'][section], key=lambda stu: (stu.last_name, stu.first_name))
-                section_row.append(("{course:}: {csn:}".format(course=section.course.course_name, csn=section.csn), student_row))
+    student_counts = dict((student.id, (student, (student.complete_count, student.total_count))) for student in students)
+    student_ids = Evaluable.base_objects.filter(evaluation_set=evaluation_set).values('student_id')
         
-        if 'iip' in data[teacher]:
-            student_row = sorted(data[teacher]['iip'], key=lambda stu: (stu.last_name, stu.first_name))
-            section_row.append(("IIP", student_row))
+    teacher_student_mapping = {}
         
-        if 'dorm' in data[teacher]:
-            for dorm in sorted(data[teacher]['dorm'].keys(), key=lambda d: (str(d))):
-                student_row = sorted(data[teacher]['dorm'][dorm], key=lambda stu: (stu.last_name, stu.first_name))
-                section_row.append((str(dorm), student_row))
+    def add(teacher, student_id):
+        student, counts = student_counts[student_id]
+        teacher_student_mapping.setdefault(teacher, {})[student] = counts
                 
-    return flattened_data
\ No newline at end of file
+    for enrollment in Enrollment.objects.filter(student__in=student_ids, academic_year=academic_year).exclude(advisor=None).select_related('advisor'):
+        add(enrollment.advisor, enrollment.student_id)
+    
+    iip_registrations = StudentRegistration.objects.filter(section__course__number__in=iip_course_numbers, student__in=student_ids, section__academic_year=academic_year)
+    
+    for registration in iip_registrations.exclude(section__teacher=None).select_related('section__teacher'):
+        add(registration.section.teacher, registration.student_id)
+    
+    return teacher_student_mapping
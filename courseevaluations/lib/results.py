@@ -1,6 +1,10 @@
 #!/usr/bin/python
 
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
+from zipfile import ZipFile, ZIP_STORED
 
 from reportlab.lib import enums
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, KeepTogether, Table, TableStyle
@@ -8,6 +12,10 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.units import inch
 
+from collections import Counter, defaultdict
+
+from django.db.models import Count
+
 from courseevaluations.models import QuestionSet, MultipleChoiceQuestionAnswer, FreeformQuestionAnswer
 
 title_style = ParagraphStyle(getSampleStyleSheet()["Normal"])
@@ -31,7 +39,65 @@ multiple_choice_count_style.alignment = enums.TA_CENTER
 
 freeform_answer_style.fontSize = 8
 
-def build_report(output, evaluables, title=None, comments=True, unmask_comments=False):
+def load_answer_counts(evaluables):
+    #How many times each multiple choice option was picked, from one grouped query
+    answer_counts = MultipleChoiceQuestionAnswer.objects.filter(evaluable__in=evaluables).order_by().values_list('answer_id').annotate(count=Count('id'))
+    
+    return Counter(dict(answer_counts))
+
+def load_comments(evaluables, unmask_comments=False):
+    #The freeform answers grouped by question id, shuffled so their order says nothing about who wrote them
+    answers = FreeformQuestionAnswer.objects.filter(evaluable__in=evaluables).order_by("?")
+    
+    if unmask_comments:
+        answers = answers.select_related('evaluable__student')
+    
+    comments = defaultdict(list)
+    
+    for answer in answers:
+        if unmask_comments:
+            display_answer = "({student:}) {answer:}".format(student=answer.evaluable.student.name, answer=answer.answer)
+        else:
+            display_answer = answer.answer
+        
+        comments[answer.question_id].append(display_answer)
+    
+    return comments
+
+def load_report_data(evaluables, comments=True, unmask_comments=False):
+    """Everything a report on evaluables shows, as plain lists and tuples.
+    
+    One (name, multiple choice questions, freeform questions) tuple per
+    question set, where a multiple choice question is its text and the
+    (option, count) of each option and a freeform question is its text and
+    its comments. It pickles, so the report can be rendered in another
+    process, and takes a fixed number of queries however many questions
+    there are."""
+    
+    question_sets = list(QuestionSet.objects.filter(evaluable__in=evaluables).distinct().prefetch_related('multiplechoicequestion_set__multiplechoicequestionoption_set', 'freeformquestion_set'))
+    answer_counts = load_answer_counts(evaluables)
+    
+    if comments:
+        freeform_answers = load_comments(evaluables, unmask_comments)
+    
+    report_data = []
+    
+    for question_set in question_sets:
+        multiple_choice_questions = []
+        freeform_questions = []
+        
+        for question in question_set.multiplechoicequestion_set.all():
+            multiple_choice_questions.append((question.question, [(option.option, answer_counts[option.id]) for option in question.multiplechoicequestionoption_set.all()]))
+        
+        if comments:
+            for question in question_set.freeformquestion_set.all():
+                freeform_questions.append((question.question, freeform_answers[question.id]))
+        
+        report_data.append((question_set.name, multiple_choice_questions, freeform_questions))
+    
+    return report_data
+
+def render_report(output, report_data, title=None):
     doc_args = {
         'author': 'Rectory School Evaluation System',
         'pagesize': letter,
@@ -49,47 +115,111 @@ def build_report(output, evaluables, title=None, comments=True, unmask_comments=
     if title:
         story.append(Paragraph(title, title_style))
     
-    question_sets = QuestionSet.objects.filter(evaluable__in=evaluables).distinct()
+    for question_set_name, multiple_choice_questions, freeform_questions in report_data:
+        if len(report_data) > 1:
+            story.append(Paragraph(question_set_name, question_set_style))
     
-    for question_set in question_sets:
-        if question_sets.count() > 1:
-            story.append(Paragraph(question_set.name, question_set_style))
-            
-        for question in question_set.multiplechoicequestion_set.all():
+        for question, options in multiple_choice_questions:
             answer_labels = []
-            answer_counts = []
+            answer_count_cells = []
             
-            for option in question.multiplechoicequestionoption_set.all():
-                count = MultipleChoiceQuestionAnswer.objects.filter(evaluable__in=evaluables, answer=option).count()
-                
-                answer_labels.append(Paragraph(option.option, multiple_choice_option_style))
-                answer_counts.append(Paragraph(str(count), multiple_choice_count_style))
+            for option, count in options:
+                answer_labels.append(Paragraph(option, multiple_choice_option_style))
+                answer_count_cells.append(Paragraph(str(count), multiple_choice_count_style))
             
             cols = len(answer_labels)
-            t = Table([answer_labels, answer_counts], cols*[inner_width/cols])
+            t = Table([answer_labels, answer_count_cells], cols*[inner_width/cols])
             
             together = [
-                Paragraph(question.question, question_style),
+                Paragraph(question, question_style),
                 t
             ]
             story.append(Spacer(1, 4))
             story.append(KeepTogether(together))
                         
-        if comments:
-            for question in question_set.freeformquestion_set.all():
-                together = []
-                together.append(Paragraph(question.question, question_style))
-                together.append(Spacer(1, .1*inch))
+        for question, answers in freeform_questions:
+            together = []
+            together.append(Paragraph(question, question_style))
+            together.append(Spacer(1, .1*inch))
                 
-                for answer in FreeformQuestionAnswer.objects.filter(evaluable__in=evaluables, question=question).order_by("?"):
-                    if unmask_comments:
-                        display_answer = "({student:}) {answer:}".format(student=answer.evaluable.student.name, answer=answer.answer)
-                    else:
-                        display_answer = answer.answer
+            for display_answer in answers:
+                together.append(Paragraph(display_answer, freeform_answer_style, bulletText='-'))
                         
-                    together.append(Paragraph(display_answer, freeform_answer_style, bulletText='-'))
-                
-                story.append(KeepTogether(together))
+            story.append(KeepTogether(together))
         
     doc = SimpleDocTemplate(output, **doc_args)
-    doc.build(story)
\ No newline at end of file
+    doc.build(story)
+
+def build_report(output, evaluables, title=None, comments=True, unmask_comments=False):
+    render_report(output, load_report_data(evaluables, comments, unmask_comments), title)
+
+def render_report_pdf(report_data, title):
+    #Runs in a worker process; returns the finished PDF
+    output = BytesIO()
+    render_report(output, report_data, title)
+    
+    return output.getvalue()
+
+def render_reports(reports, max_workers=None):
+    """Yield a (file name, PDF) pair for each (file name, report data, title) in reports.
+    
+    The PDFs are rendered by a pool of processes and come back in the order
+    of reports. reports is consumed only a couple of reports per worker ahead
+    of the PDFs being yielded, so memory use stays bounded however many
+    reports there are. With max_workers of 1 everything renders in this
+    process."""
+    
+    if max_workers == 1:
+        for file_name, report_data, title in reports:
+            yield file_name, render_report_pdf(report_data, title)
+        
+        return
+    
+    max_workers = max_workers or os.cpu_count() or 1
+    
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque()
+        
+        for file_name, report_data, title in reports:
+            pending.append((file_name, executor.submit(render_report_pdf, report_data, title)))
+            
+            if len(pending) > max_workers * 2:
+                file_name, future = pending.popleft()
+                yield file_name, future.result()
+        
+        while pending:
+            file_name, future = pending.popleft()
+            yield file_name, future.result()
+
+class ZipStreamBuffer(object):
+    #A write-only file for ZipFile that hands over what has been written so far each time it is drained
+    def __init__(self):
+        self.chunks = []
+    
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        
+        return data
+
+def stream_zip(entries):
+    """Yield the bytes of a zip archive of the (file name, data) pairs in entries as it is written.
+    
+    The archive is never held in memory as a whole; each entry is passed on
+    as soon as it has been added, and the central directory comes last."""
+    
+    buffer = ZipStreamBuffer()
+    
+    with ZipFile(buffer, mode='w', compression=ZIP_STORED) as zip_file:
+        for file_name, data in entries:
+            zip_file.writestr(file_name, data)
+            yield buffer.drain()
+    
+    yield buffer.drain()
@@ -0,0 +1,18 @@
+#!/usr/bin/python
+
+import logging
+
+from django.core.management.base import BaseCommand
+
+from courseevaluations.models import CompletionCounter
+
+logger = logging.getLogger(__name__)
+
+class Command(BaseCommand):
+    help = "Recount the complete and incomplete evaluables of every evaluation set and type"
+    
+    def handle(self, *args, **kwargs):
+        counter_count = CompletionCounter.objects.rebuild()
+        
+        logger.info("Rebuilt {count:} completion counters".format(count=counter_count))
+        self.stdout.write("Rebuilt {count:} completion counters".format(count=counter_count))
@@ -1,6 +1,8 @@
 import logging
+from collections import Counter
 
-from django.db import models
+from django.db import models, transaction, IntegrityError
+from django.db.models import Count, F, Sum
 from datetime import date
 
 logger = logging.getLogger(__name__)
@@ -8,3 +10,69 @@ logger = logging.getLogger(__name__)
 class EvaluationSetManager(models.Manager):
     def open(self):
         return self.filter(available_until__gte=date.today())
+
+class CompletionCounterManager(models.Manager):
+    def adjust(self, evaluation_set_id, evaluable_type_id, complete=0, incomplete=0):
+        #Move a counter with an UPDATE so concurrent submissions do not overwrite each other
+        counters = self.filter(evaluation_set_id=evaluation_set_id, evaluable_type_id=evaluable_type_id)
+        
+        if counters.update(complete_count=F('complete_count') + complete, incomplete_count=F('incomplete_count') + incomplete):
+            return
+        
+        #Only an insert starts a counter; a decrement with no counter to move is a set being deleted, or one rebuild will count
+        if complete < 0 or incomplete < 0:
+            return
+        
+        try:
+            with transaction.atomic():
+                self.create(evaluation_set_id=evaluation_set_id, evaluable_type_id=evaluable_type_id, complete_count=complete, incomplete_count=incomplete)
+        
+        except IntegrityError:
+            counters.update(complete_count=F('complete_count') + complete, incomplete_count=F('incomplete_count') + incomplete)
+    
+    def adjust_many(self, evaluables):
+        #Count newly inserted evaluables, one adjustment per evaluation set and type
+        counts = Counter((evaluable.evaluation_set_id, evaluable.polymorphic_ctype_id, evaluable.complete) for evaluable in evaluables)
+        
+        for evaluation_set_id, evaluable_type_id in set((key[0], key[1]) for key in counts):
+            self.adjust(evaluation_set_id, evaluable_type_id, complete=counts[(evaluation_set_id, evaluable_type_id, True)], incomplete=counts[(evaluation_set_id, evaluable_type_id, False)])
+    
+    def rebuild(self):
+        """Recount every counter from the Evaluable table in one grouped query.
+        
+        Counters only follow Evaluable.save, deletes and bulk_create_evaluables,
+        so anything changed with a queryset update needs a rebuild. The counters
+        are locked before the count and updated in place, so a submission that
+        comes in meanwhile waits and then moves the recounted row."""
+        
+        from courseevaluations.models import Evaluable
+        
+        with transaction.atomic():
+            existing = dict(((counter.evaluation_set_id, counter.evaluable_type_id), counter) for counter in self.select_for_update())
+            
+            counts = {}
+            
+            for row in Evaluable.base_objects.order_by().values('evaluation_set_id', 'polymorphic_ctype_id', 'complete').annotate(count=Count('id')):
+                key = (row['evaluation_set_id'], row['polymorphic_ctype_id'])
+                counts.setdefault(key, {'complete_count': 0, 'incomplete_count': 0})
+                counts[key][row['complete'] and 'complete_count' or 'incomplete_count'] = row['count']
+            
+            for key, count in counts.items():
+                counter = existing.get(key)
+                
+                if counter is not None and (counter.complete_count, counter.incomplete_count) != (count['complete_count'], count['incomplete_count']):
+                    self.filter(pk=counter.pk).update(**count)
+            
+            self.filter(pk__in=[counter.pk for key, counter in existing.items() if key not in counts]).delete()
+            self.bulk_create([self.model(evaluation_set_id=evaluation_set_id, evaluable_type_id=evaluable_type_id, **count) for (evaluation_set_id, evaluable_type_id), count in counts.items() if (evaluation_set_id, evaluable_type_id) not in existing])
+        
+        return len(counts)
+    
+    def totals(self):
+        #Complete and incomplete counts keyed by evaluation set id
+        totals = {}
+        
+        for row in self.order_by().values('evaluation_set_id').annotate(complete_count=Sum('complete_count'), incomplete_count=Sum('incomplete_count')):
+            totals[row['evaluation_set_id']] = (row['complete_count'], row['incomplete_count'])
+        
+        return totals
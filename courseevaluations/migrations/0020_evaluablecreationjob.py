@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courseevaluations', '0019_auto_20160108_1019'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EvaluableCreationJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('evaluation_type', models.CharField(max_length=11, choices=[('course', 'course evaluations'), ('iip', 'IIP evaluations'), ('dorm_parent', 'dorm parent evaluations')])),
+                ('upload', models.FileField(blank=True, upload_to='courseevaluations/evaluable_uploads/%Y/%m')),
+                ('status', models.CharField(max_length=8, default='queued', choices=[('queued', 'Queued'), ('reading', 'Reading'), ('creating', 'Creating'), ('complete', 'Complete'), ('failed', 'Failed')])),
+                ('rows_read', models.PositiveIntegerField(default=0)),
+                ('evaluable_count', models.PositiveIntegerField(default=0)),
+                ('message', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('evaluation_set', models.ForeignKey(to='courseevaluations.EvaluationSet')),
+                ('question_set', models.ForeignKey(to='courseevaluations.QuestionSet')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count
+
+def count_evaluables(apps, schema_editor):
+    Evaluable = apps.get_model("courseevaluations", "Evaluable")
+    CompletionCounter = apps.get_model("courseevaluations", "CompletionCounter")
+    
+    counters = {}
+    
+    for row in Evaluable.objects.order_by().values('evaluation_set_id', 'polymorphic_ctype_id', 'complete').annotate(count=Count('id')):
+        key = (row['evaluation_set_id'], row['polymorphic_ctype_id'])
+        counters.setdefault(key, CompletionCounter(evaluation_set_id=key[0], evaluable_type_id=key[1]))
+        
+        if row['complete']:
+            counters[key].complete_count = row['count']
+        else:
+            counters[key].incomplete_count = row['count']
+    
+    CompletionCounter.objects.bulk_create(counters.values())
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('courseevaluations', '0020_evaluablecreationjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CompletionCounter',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', primary_key=True, serialize=False, auto_created=True)),
+                ('complete_count', models.IntegerField(default=0)),
+                ('incomplete_count', models.IntegerField(default=0)),
+                ('evaluable_type', models.ForeignKey(to='contenttypes.ContentType')),
+                ('evaluation_set', models.ForeignKey(to='courseevaluations.EvaluationSet')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='completioncounter',
+            unique_together=set([('evaluation_set', 'evaluable_type')]),
+        ),
+        migrations.RunPython(count_evaluables, migrations.RunPython.noop),
+    ]
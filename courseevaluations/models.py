@@ -1,9 +1,13 @@
 #!/usr/bin/python
 
 import email.utils
+from collections import defaultdict
 from datetime import date
 
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ValidationError
 
@@ -104,6 +108,31 @@ class Evaluable(PolymorphicModel):
     
     complete = models.BooleanField(default=False)
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        
+        #Remember the stored completion so save() knows which counter to move
+        if 'complete' in field_names:
+            instance._saved_complete = instance.complete
+        
+        return instance
+    
+    def save(self, *args, **kwargs):
+        created = self.pk is None
+        saved_complete = getattr(self, '_saved_complete', None)
+        
+        super().save(*args, **kwargs)
+        
+        if created:
+            CompletionCounter.objects.adjust(self.evaluation_set_id, self.polymorphic_ctype_id, complete=int(self.complete), incomplete=int(not self.complete))
+        
+        elif saved_complete is not None and saved_complete != self.complete:
+            change = self.complete and 1 or -1
+            CompletionCounter.objects.adjust(self.evaluation_set_id, self.polymorphic_ctype_id, complete=change, incomplete=-change)
+        
+        self._saved_complete = self.complete
+    
     @property
     def student_display(self):
         return None
@@ -185,6 +214,31 @@ class IIPEvaluation(Evaluable):
     def student_display(self):
         return "IIP with {teacher:}".format(teacher=self.teacher.name_for_students)
     
+class CompletionCounter(models.Model):
+    #How many evaluables of one type in an evaluation set are complete, so the status pages need not count the Evaluable table
+    evaluation_set = models.ForeignKey(EvaluationSet)
+    evaluable_type = models.ForeignKey(ContentType)
+    
+    complete_count = models.IntegerField(default=0)
+    incomplete_count = models.IntegerField(default=0)
+    
+    objects = courseevaluations.managers.CompletionCounterManager()
+    
+    class Meta:
+        unique_together = (('evaluation_set', 'evaluable_type'), )
+    
+    @property
+    def total_count(self):
+        return self.complete_count + self.incomplete_count
+    
+    def __str__(self):
+        return "{evaluation_set:}: {complete_count:}/{total_count:} {evaluable_type:} complete".format(evaluation_set=self.evaluation_set, complete_count=self.complete_count, total_count=self.total_count, evaluable_type=self.evaluable_type)
+
+@receiver(post_delete, sender=Evaluable)
+def count_deleted_evaluable(sender, instance, **kwargs):
+    #Deleting a subclass deletes its Evaluable row too, so this runs once per evaluable
+    CompletionCounter.objects.adjust(instance.evaluation_set_id, instance.polymorphic_ctype_id, complete=-int(instance.complete), incomplete=-int(not instance.complete))
+
 class MultipleChoiceQuestionAnswer(models.Model):
     evaluable = models.ForeignKey(Evaluable)
     answer = models.ForeignKey(MultipleChoiceQuestionOption)
@@ -194,6 +248,63 @@ class FreeformQuestionAnswer(models.Model):
     question = models.ForeignKey(FreeformQuestion)
     answer = models.TextField()
 
+class EvaluableCreationJob(models.Model):
+    #An evaluable creation run handed to the RQ worker; the worker records its progress here for the admin page to poll
+    EVALUATION_TYPE_CHOICES = (('course', 'course evaluations'), ('iip', 'IIP evaluations'), ('dorm_parent', 'dorm parent evaluations'))
+    EVALUATION_TYPE_LENGTH = max(len(choice[0]) for choice in EVALUATION_TYPE_CHOICES)
+    
+    STATUS_CHOICES = (('queued', 'Queued'), ('reading', 'Reading'), ('creating', 'Creating'), ('complete', 'Complete'), ('failed', 'Failed'))
+    STATUS_LENGTH = max(len(choice[0]) for choice in STATUS_CHOICES)
+    FINISHED_STATUSES = ('complete', 'failed')
+    
+    evaluation_set = models.ForeignKey(EvaluationSet)
+    question_set = models.ForeignKey(QuestionSet)
+    evaluation_type = models.CharField(max_length=EVALUATION_TYPE_LENGTH, choices=EVALUATION_TYPE_CHOICES)
+    upload = models.FileField(upload_to='courseevaluations/evaluable_uploads/%Y/%m', blank=True)
+    
+    status = models.CharField(max_length=STATUS_LENGTH, choices=STATUS_CHOICES, default='queued')
+    rows_read = models.PositiveIntegerField(default=0)
+    evaluable_count = models.PositiveIntegerField(default=0)
+    message = models.TextField(blank=True)
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        ordering = ['-created_at']
+    
+    @property
+    def finished(self):
+        return self.status in self.FINISHED_STATUSES
+    
+    def publish(self, **attrs):
+        #Save only the given progress fields, committing them straight away when no transaction is open
+        for attr, value in attrs.items():
+            setattr(self, attr, value)
+        
+        self.save(update_fields=list(attrs.keys()) + ['updated_at'])
+    
+    def as_status(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'status_display': self.get_status_display(),
+            'rows_read': self.rows_read,
+            'evaluable_count': self.evaluable_count,
+            'message': self.message,
+            'finished': self.finished,
+        }
+    
+    def __str__(self):
+        return "{evaluation_set:}: {evaluation_type:} ({status:})".format(evaluation_set=self.evaluation_set, evaluation_type=self.get_evaluation_type_display(), status=self.get_status_display())
+
+def with_results(queryset, results):
+    #Fill a queryset's result cache, as prefetch_related does, so it answers from results instead of the database
+    queryset._result_cache = list(results)
+    queryset._prefetch_done = True
+    
+    return queryset
+
 class StudentEmailTemplate(models.Model):
     CONTENT_SUBTYPE_CHOICES = (('html', 'HTML'), ('plain', 'Plain Text'))
     CONTENT_SUBTYPE_LENGTH = max(len(choice[0]) for choice in CONTENT_SUBTYPE_CHOICES)
@@ -209,27 +320,37 @@ class StudentEmailTemplate(models.Model):
     content_subtype = models.CharField(max_length=CONTENT_SUBTYPE_LENGTH, choices=CONTENT_SUBTYPE_CHOICES, default="plain")
 
     def get_template_vars(self, student):
-        try:
-            return self._template_vars
-        except AttributeError:
-            pass
+        return self.get_students_template_vars([student])[student.pk]
         
-        evaluation_sets = EvaluationSet.objects.open()
+    def get_students_template_vars(self, students):
+        """The template vars of each student, keyed by student id.
         
-        complete_evaluations = Evaluable.objects.filter(evaluation_set__in=evaluation_sets, student=student, complete=True)
-        incomplete_evaluations = Evaluable.objects.filter(evaluation_set__in=evaluation_sets, student=student, complete=False)
-        evaluations = Evaluable.objects.filter(evaluation_set__in=evaluation_sets, student=student)
-        evaluation_landing_page = "https://apps.rectoryschool.org{url:}?auth_key={auth_key:}".format(url=reverse('courseevaluations_student_landing'), auth_key=student.auth_key)
+        The complete and incomplete evaluables of the open evaluation sets are
+        loaded for all of students at once, one grouped query each. Every
+        student's evaluations are handed to the template as querysets that
+        already hold their results, so count and iteration do not query again."""
         
-        template_vars = {
-            'student': student,
-            'complete_evaluations': complete_evaluations,
-            'incomplete_evaluations': incomplete_evaluations,
-            'evaluations': evaluations,
-            'evaluation_landing': evaluation_landing_page
-        }
+        evaluables = Evaluable.objects.filter(evaluation_set__in=EvaluationSet.objects.open()).order_by('id')
         
-        self._template_vars = template_vars
+        by_student = {True: defaultdict(list), False: defaultdict(list)}
+        
+        for complete in (True, False):
+            for evaluable in evaluables.filter(student__in=[student.pk for student in students], complete=complete):
+                by_student[complete][evaluable.student_id].append(evaluable)
+        
+        template_vars = {}
+        
+        for student in students:
+            complete_evaluations = by_student[True][student.pk]
+            incomplete_evaluations = by_student[False][student.pk]
+            
+            template_vars[student.pk] = {
+                'student': student,
+                'complete_evaluations': with_results(evaluables.filter(student=student, complete=True), complete_evaluations),
+                'incomplete_evaluations': with_results(evaluables.filter(student=student, complete=False), incomplete_evaluations),
+                'evaluations': with_results(evaluables.filter(student=student), sorted(complete_evaluations + incomplete_evaluations, key=lambda evaluable: evaluable.id)),
+                'evaluation_landing': "https://apps.rectoryschool.org{url:}?auth_key={auth_key:}".format(url=reverse('courseevaluations_student_landing'), auth_key=student.auth_key),
+            }
         
         return template_vars
     
@@ -245,15 +366,32 @@ class StudentEmailTemplate(models.Model):
         
         return template.render(Context(template_vars))
  
-    def get_message(self, student):
+    def build_message(self, student, subject, body):
         m = EmailMessage()
-        m.subject = self.render_subject(student)
-        m.body = self.render_body(student)
+        m.subject = subject
+        m.body = body
         m.from_email = email.utils.formataddr((self.from_name, self.from_address))
         m.to = [student.email]
         m.content_subtype = self.content_subtype
 
         return m
             
+    def get_message(self, student):
+        return next(self.get_messages([student]))
+    
+    def get_messages(self, students):
+        #One message per student, with the subject and body compiled once for them all
+        students = list(students)
+        
+        subject_template = Template(self.subject)
+        body_template = Template(self.body)
+        
+        template_vars = self.get_students_template_vars(students)
+        
+        for student in students:
+            context = Context(template_vars[student.pk])
+            
+            yield self.build_message(student, subject_template.render(context), body_template.render(context))
+    
     def __str__(self):
         return self.description
@@ -14,4 +14,21 @@ $(document).ready(function() {
     $(target).dialog('open');
     e.preventDefault();
   })
+  
+  //Poll the evaluation creation jobs that are still running until they finish
+  function pollCreationJob(row) {
+    $.getJSON(row.data("status-url"), function(job) {
+      row.find(".status").text(job.status_display);
+      row.find(".progress").text(job.rows_read + " rows read, " + job.evaluable_count + " evaluations");
+      row.find(".message").text(job.message);
+      
+      if (!job.finished) {
+        setTimeout(function() { pollCreationJob(row); }, 2000);
+      }
+    });
+  }
+  
+  $("tr.creation_job[data-finished=false]").each(function() {
+    pollCreationJob($(this));
+  });
 })
\ No newline at end of file
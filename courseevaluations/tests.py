@@ -1,3 +1,337 @@
-from django.test import TestCase
+import shutil
+import tempfile
+from zipfile import ZipFile
+from datetime import date, timedelta
+from io import StringIO, BytesIO
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core import mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.urlresolvers import reverse
+from django.test import TestCase, override_settings
+
+from academics.models import Student, AcademicYear, Teacher, Enrollment, Course, Section, StudentRegistration, Dorm
+from academics.utils.bulksync import delete_objects
+from academics.utils.fmpxmlwriter import write_export
+from courseevaluations.models import QuestionSet, EvaluationSet, Evaluable, CompletionCounter, StudentEmailTemplate, CourseEvaluation, IIPEvaluation, DormParentEvaluation, EvaluableCreationJob, MultipleChoiceQuestion, MultipleChoiceQuestionOption, MultipleChoiceQuestionAnswer, FreeformQuestion, FreeformQuestionAnswer
+from courseevaluations.lib.creation import build_course_evaluations, build_iip_evaluations, build_dorm_parent_evaluations, bulk_create_evaluables, run_creation_job, EvaluableCreationError
+from courseevaluations.lib.reporting import get_incomplete_evaluables_report, get_advisor_tutor_status
+from courseevaluations.lib.async import send_student_emails_from_template
+from courseevaluations.lib.mailing import TokenBucket, send_throttled
+from courseevaluations.lib.results import build_report, load_answer_counts, load_comments, load_report_data, render_reports, stream_zip
+
+class EvaluationTestCase(TestCase):
+    def setUp(self):
+        self.academic_year = AcademicYear.objects.create(year="2015-2016", current=True)
+        
+        self.teachers = [Teacher.objects.create(teacher_id="T00{}".format(i), first_name="Teacher", last_name="T{}".format(i)) for i in range(1, 3)]
+        self.students = [Student.objects.create(student_id="S00000{}".format(i), first_name="Student", last_name="S{}".format(i), current=True) for i in range(1, 4)]
+        
+        self.dorm = Dorm.objects.create(dorm_name="Hall", building="Hall")
+        self.dorm.heads.add(*self.teachers)
+        
+        self.enrollments = [Enrollment.objects.create(student=student, academic_year=self.academic_year, boarder=True, dorm=self.dorm, division="MS") for student in self.students]
+        
+        course = Course.objects.create(number="1010", course_name="Algebra I", course_name_short="Algebra", course_name_transcript="Algebra I", division="MS", department="Mathematics", course_type="Academic")
+        self.sections = [Section.objects.create(course=course, csn="1010-0{}".format(i), academic_year=self.academic_year, teacher=teacher) for i, teacher in enumerate(self.teachers, 1)]
+        
+        for i, student in enumerate(self.students):
+            StudentRegistration.objects.create(student_reg_id="R{}".format(i), student=student, section=self.sections[i % 2])
+        
+        self.question_set = QuestionSet.objects.create(name="Questions")
+        self.evaluation_set = EvaluationSet.objects.create(name="Fall", available_until=date.today() + timedelta(days=7))
+
+class EvaluableCreationTestCase(EvaluationTestCase):
+    def test_course_evaluations(self):
+        rows = [{'CourseSectionNumber': section.csn, 'AcademicYear': "2015-2016"} for section in self.sections]
+        
+        with self.assertNumQueries(3):
+            evaluables = build_course_evaluations(rows, self.evaluation_set, self.question_set)
+        
+        self.assertEqual(bulk_create_evaluables(evaluables, batch_size=2), 3)
+        
+        created = sorted((evaluation.student.student_id, evaluation.section.csn, evaluation.enrollment.student_id) for evaluation in CourseEvaluation.objects.all())
+        self.assertEqual(created, [("S000001", "1010-01", self.students[0].id), ("S000002", "1010-02", self.students[1].id), ("S000003", "1010-01", self.students[2].id)])
+        
+        self.assertTrue(all(isinstance(evaluable, CourseEvaluation) for evaluable in Evaluable.objects.all()))
+    
+    def test_missing_section(self):
+        with self.assertRaises(EvaluableCreationError):
+            build_course_evaluations([{'CourseSectionNumber': "9999-01", 'AcademicYear': "2015-2016"}], self.evaluation_set, self.question_set)
+    
+    def test_iip_and_dorm_parent_evaluations(self):
+        rows = [{'IDStudent': "S000001", 'SectionTeacher::IDTEACHER': "T001"}, {'IDStudent': "S000001", 'SectionTeacher::IDTEACHER': "T002"}]
+        
+        evaluables = build_iip_evaluations(rows, self.evaluation_set, self.question_set, self.academic_year)
+        evaluables += build_dorm_parent_evaluations(self.evaluation_set, self.question_set, self.academic_year)
+        
+        self.assertEqual(bulk_create_evaluables(evaluables), 8)
+        
+        self.assertEqual(sorted(IIPEvaluation.objects.values_list('teacher__teacher_id', flat=True)), ["T001", "T002"])
+        self.assertEqual(DormParentEvaluation.objects.filter(dorm=self.dorm).count(), 6)
+        self.assertEqual(sorted(str(evaluable.student_display) for evaluable in Evaluable.objects.filter(student=self.students[0]))[0], "Hall with T1, Teacher")
+
+class EvaluableCreationJobTestCase(EvaluationTestCase):
+    def setUp(self):
+        super().setUp()
+        
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings_override.enable()
+    
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+    
+    def create_job(self, csns):
+        upload = StringIO()
+        write_export(upload, [('CourseSectionNumber', 'TEXT'), ('AcademicYear', 'TEXT')], ((i, [csn, "2015-2016"]) for i, csn in enumerate(csns, 1)))
+        
+        job = EvaluableCreationJob(evaluation_set=self.evaluation_set, question_set=self.question_set, evaluation_type='course')
+        job.upload.save("sections.xml", ContentFile(upload.getvalue().encode('utf-8')))
+        
+        return job
+    
+    def test_course_job(self):
+        job = self.create_job([section.csn for section in self.sections])
+        upload_name = job.upload.name
+        
+        self.assertEqual(run_creation_job(job), 3)
+        
+        job = EvaluableCreationJob.objects.get(pk=job.pk)
+        self.assertEqual((job.status, job.rows_read, job.evaluable_count), ('complete', 2, 3))
+        self.assertFalse(job.upload)
+        self.assertFalse(default_storage.exists(upload_name))
+        self.assertEqual(CourseEvaluation.objects.count(), 3)
+    
+    def test_failed_job(self):
+        job = self.create_job(["1010-01", "9999-01"])
+        
+        self.assertEqual(run_creation_job(job), 0)
+        
+        job = EvaluableCreationJob.objects.get(pk=job.pk)
+        self.assertEqual(job.status, 'failed')
+        self.assertFalse(job.upload)
+        self.assertTrue(job.as_status()['finished'])
+        self.assertFalse(Evaluable.objects.exists())
+
+class CompletionCounterTestCase(EvaluationTestCase):
+    def setUp(self):
+        super().setUp()
+        
+        rows = [{'CourseSectionNumber': section.csn, 'AcademicYear': "2015-2016"} for section in self.sections]
+        bulk_create_evaluables(build_course_evaluations(rows, self.evaluation_set, self.question_set) + build_dorm_parent_evaluations(self.evaluation_set, self.question_set, self.academic_year))
+    
+    def counts(self):
+        return sorted((counter.evaluable_type.model, counter.complete_count, counter.incomplete_count) for counter in CompletionCounter.objects.all())
+    
+    def test_counters_follow_evaluables(self):
+        self.assertEqual(self.counts(), [('courseevaluation', 0, 3), ('dormparentevaluation', 0, 6)])
+        
+        evaluable = Evaluable.objects.filter(student=self.students[0]).order_by('id').first()
+        evaluable.complete = True
+        evaluable.save()
+        evaluable.save()
+        
+        self.assertEqual(self.counts(), [('courseevaluation', 1, 2), ('dormparentevaluation', 0, 6)])
+        
+        DormParentEvaluation.objects.filter(student=self.students[1]).delete()
+        evaluable.delete()
+        
+        self.assertEqual(self.counts(), [('courseevaluation', 0, 2), ('dormparentevaluation', 0, 4)])
+    
+    def test_evaluation_set_deletion(self):
+        #The set's counters go in the cascade before its evaluables, whose deletes must not bring them back
+        other_set = EvaluationSet.objects.create(name="Spring", available_until=date.today() + timedelta(days=7))
+        bulk_create_evaluables(build_dorm_parent_evaluations(other_set, self.question_set, self.academic_year))
+        
+        self.evaluation_set.delete()
+        
+        self.assertEqual(list(CompletionCounter.objects.values_list('evaluation_set_id', 'complete_count', 'incomplete_count')), [(other_set.id, 0, 6)])
+    
+    def test_bulk_deletion_cascade(self):
+        #A student the imports drop takes their evaluables with them
+        delete_objects([self.students[2]])
+        
+        self.assertEqual(self.counts(), [('courseevaluation', 0, 2), ('dormparentevaluation', 0, 4)])
+    
+    def test_rebuild(self):
+        Evaluable.objects.filter(student=self.students[0]).update(complete=True)
+        CompletionCounter.objects.filter(evaluable_type__model='courseevaluation').delete()
+        
+        dorm_counter = CompletionCounter.objects.get()
+        other_set = EvaluationSet.objects.create(name="Spring", available_until=date.today() + timedelta(days=7))
+        CompletionCounter.objects.create(evaluation_set=other_set, evaluable_type=dorm_counter.evaluable_type, incomplete_count=4)
+        
+        self.assertEqual(CompletionCounter.objects.rebuild(), 2)
+        self.assertEqual(self.counts(), [('courseevaluation', 1, 2), ('dormparentevaluation', 2, 4)])
+        self.assertEqual(CompletionCounter.objects.totals(), {self.evaluation_set.id: (3, 6)})
+        
+        #Counters are recounted in place, so a submission waiting on one still finds it
+        self.assertEqual(CompletionCounter.objects.get(evaluable_type=dorm_counter.evaluable_type).id, dorm_counter.id)
+
+class IncompleteReportTestCase(EvaluationTestCase):
+    def test_incomplete_evaluables_report(self):
+        rows = [{'CourseSectionNumber': section.csn, 'AcademicYear': "2015-2016"} for section in self.sections]
+        iip_rows = [{'IDStudent': "S000003", 'SectionTeacher::IDTEACHER': "T001"}]
+        
+        evaluables = build_course_evaluations(rows, self.evaluation_set, self.question_set)
+        evaluables += build_iip_evaluations(iip_rows, self.evaluation_set, self.question_set, self.academic_year)
+        evaluables += build_dorm_parent_evaluations(self.evaluation_set, self.question_set, self.academic_year)
+        bulk_create_evaluables(evaluables)
+        
+        Evaluable.objects.filter(student=self.students[1]).update(complete=True)
+        
+        with self.assertNumQueries(3):
+            report = get_incomplete_evaluables_report(self.evaluation_set)
+        
+        flattened = [(teacher.last_name, [(group, [student.last_name for student in students]) for group, students in groups]) for teacher, groups in report]
+        
+        self.assertEqual(flattened, [
+            ("T1", [("Algebra I: 1010-01", ["S1", "S3"]), ("IIP", ["S3"]), ("Hall", ["S1", "S3"])]),
+            ("T2", [("Hall", ["S1", "S3"])]),
+        ])
+    
+    def test_advisor_tutor_status(self):
+        for enrollment, teacher in zip(self.enrollments, (self.teachers[0], self.teachers[1], None)):
+            enrollment.advisor = teacher
+            enrollment.save()
+        
+        iip_course = Course.objects.create(number="9999", course_name="IIP", course_name_short="IIP", course_name_transcript="IIP", division="MS", department="IIP", course_type="Academic")
+        iip_section = Section.objects.create(course=iip_course, csn="9999-01", academic_year=self.academic_year, teacher=self.teachers[0])
+        StudentRegistration.objects.create(student_reg_id="R9", student=self.students[2], section=iip_section)
+        
+        rows = [{'CourseSectionNumber': section.csn, 'AcademicYear': "2015-2016"} for section in self.sections]
+        bulk_create_evaluables(build_course_evaluations(rows, self.evaluation_set, self.question_set) + build_dorm_parent_evaluations(self.evaluation_set, self.question_set, self.academic_year))
+        Evaluable.objects.filter(student=self.students[0]).update(complete=True)
+        
+        with self.assertNumQueries(3):
+            mapping = get_advisor_tutor_status(self.evaluation_set, self.academic_year, ["9999"])
+        
+        self.assertEqual(mapping, {
+            self.teachers[0]: {self.students[0]: (3, 3), self.students[2]: (0, 3)},
+            self.teachers[1]: {self.students[1]: (0, 3)},
+        })
+
+class ReportTestCase(EvaluationTestCase):
+    def setUp(self):
+        super().setUp()
+        
+        rows = [{'CourseSectionNumber': section.csn, 'AcademicYear': "2015-2016"} for section in self.sections]
+        bulk_create_evaluables(build_course_evaluations(rows, self.evaluation_set, self.question_set))
+        
+        self.evaluables = CourseEvaluation.objects.filter(evaluation_set=self.evaluation_set)
+        
+        for question_number in range(3):
+            question = MultipleChoiceQuestion.objects.create(question="Question {}".format(question_number), question_set=self.question_set)
+            options = [MultipleChoiceQuestionOption.objects.create(question=question, option=option) for option in ("Yes", "No")]
+            
+            for evaluable in self.evaluables:
+                MultipleChoiceQuestionAnswer.objects.create(evaluable=evaluable, answer=options[evaluable.student_id % 2])
+        
+        self.freeform_question = FreeformQuestion.objects.create(question="Comments", question_set=self.question_set)
+        
+        for evaluable in self.evaluables:
+            FreeformQuestionAnswer.objects.create(evaluable=evaluable, question=self.freeform_question, answer="Comment from {}".format(evaluable.student.last_name))
+    
+    def test_report_data(self):
+        answer_counts = load_answer_counts(self.evaluables)
+        
+        self.assertEqual(sorted(answer_counts.values()), [1, 1, 1, 2, 2, 2])
+        self.assertEqual(sorted(load_comments(self.evaluables, unmask_comments=True)[self.freeform_question.id])[0], "(Student S1) Comment from S1")
+    
+    def test_constant_queries(self):
+        with self.assertNumQueries(6):
+            build_report(BytesIO(), self.evaluables, title="Report", unmask_comments=True)
+    
+    def test_zip_reports(self):
+        report_data = load_report_data(self.evaluables)
+        reports = (("Teacher {}.pdf".format(i), report_data, "Report {}".format(i)) for i in range(5))
+        
+        archive = BytesIO(b"".join(stream_zip(render_reports(reports, max_workers=2))))
+        
+        with ZipFile(archive) as zip_file:
+            self.assertEqual(zip_file.namelist(), ["Teacher {}.pdf".format(i) for i in range(5)])
+            self.assertTrue(zip_file.read("Teacher 4.pdf").startswith(b"%PDF"))
+    
+    @override_settings(REPORT_RENDER_WORKERS=1)
+    def test_zip_teacher_course(self):
+        User.objects.create_superuser("admin", "admin@example.com", "password")
+        self.client.login(username="admin", password="password")
+        
+        response = self.client.get(reverse('courseevaluations_zip_course_results_teacher_course', kwargs={'evaluation_set_id': self.evaluation_set.id}))
+        
+        with ZipFile(BytesIO(b"".join(response.streaming_content))) as zip_file:
+            self.assertEqual(sorted(zip_file.namelist()), ["Mathematics/T1, Teacher/Algebra I.pdf", "Mathematics/T2, Teacher/Algebra I.pdf"])
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+    
+    def __call__(self):
+        return self.now
+    
+    def sleep(self, seconds):
+        self.now += seconds
+
+class RecordingEmailBackend(EmailBackend):
+    #Notes the clock at every send and refuses messages to fail@example.com
+    def __init__(self, clock, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.clock = clock
+        self.sends = []
+    
+    def send_messages(self, messages):
+        self.sends.append((self.clock(), [message.subject for message in messages]))
+        
+        if any("fail@example.com" in message.to for message in messages):
+            raise ConnectionError("Refused")
+        
+        return super().send_messages(messages)
+
+class MailingTestCase(EvaluationTestCase):
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = TokenBucket(2, clock=clock, sleep=clock.sleep)
+        
+        for i in range(6):
+            bucket.take()
+        
+        #Two saved up tokens go straight away, the other four at two a second
+        self.assertAlmostEqual(clock.now, 2.0)
+    
+    def test_send_throttled(self):
+        clock = FakeClock()
+        connection = RecordingEmailBackend(clock)
+        messages = (mail.EmailMessage("Subject {}".format(i), "Body", "from@example.com", [i == 2 and "fail@example.com" or "to@example.com"]) for i in range(5))
+        
+        self.assertEqual(send_throttled(messages, connection=connection, bucket=TokenBucket(2, capacity=1, clock=clock, sleep=clock.sleep)), 4)
+        
+        #Every message goes out on its own as its token comes in, and the refused one does not stop the rest
+        self.assertEqual(connection.sends, [(i * 0.5, ["Subject {}".format(i)]) for i in range(5)])
+        self.assertEqual([message.subject for message in mail.outbox], ["Subject 0", "Subject 1", "Subject 3", "Subject 4"])
+    
+    @override_settings(EMAIL_MESSAGES_PER_SECOND=1000)
+    def test_student_emails(self):
+        bulk_create_evaluables(build_dorm_parent_evaluations(self.evaluation_set, self.question_set, self.academic_year))
+        template = StudentEmailTemplate.objects.create(description="Reminder", subject="Evaluations for {{ student.first_name }}", body="{{ student.last_name }}: {{ incomplete_evaluations|length }}", from_name="Technology", from_address="technology@example.com")
+        
+        send_student_emails_from_template(template.id, [student.id for student in self.students], override_email="admin@example.com")
+        
+        self.assertEqual([message.body for message in mail.outbox], ["S1: 2", "S2: 2", "S3: 2"])
+        self.assertEqual(set(tuple(message.to) for message in mail.outbox), {("admin@example.com", )})
+    
+    def test_bulk_rendering(self):
+        bulk_create_evaluables(build_dorm_parent_evaluations(self.evaluation_set, self.question_set, self.academic_year))
+        DormParentEvaluation.objects.filter(student=self.students[0], parent=self.teachers[0]).update(complete=True)
+        template = StudentEmailTemplate.objects.create(description="Reminder", subject="Evaluations for {{ student.first_name }}", body="{{ student.last_name }}: {{ complete_evaluations.count }}/{{ evaluations|length }}{% for evaluation in incomplete_evaluations %} {{ evaluation.parent_id }}{% endfor %}", from_name="Technology", from_address="technology@example.com")
+        
+        #The complete and incomplete evaluables, each a base query and a DormParentEvaluation query
+        with self.assertNumQueries(4):
+            messages = list(template.get_messages(self.students))
+        
+        first, second = (teacher.id for teacher in self.teachers)
+        self.assertEqual([message.body for message in messages], ["S1: 1/2 {}".format(second), "S2: 0/2 {} {}".format(first, second), "S3: 0/2 {} {}".format(first, second)])
+        self.assertEqual(messages[0].to, [self.students[0].email])
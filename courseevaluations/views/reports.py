@@ -11,29 +11,31 @@ from django.http import HttpResponse
 from django.conf import settings
 from django.core.mail import EmailMessage
 
-from academics.models import Student, Section, Course, AcademicYear, Enrollment, StudentRegistration
-from courseevaluations.models import EvaluationSet, Evaluable, CourseEvaluation, IIPEvaluation, DormParentEvaluation, StudentEmailTemplate
-from courseevaluations.lib.async import send_student_email_from_template, send_confirmation_email, send_msg
-from courseevaluations.lib.reporting import get_incomplete_evaluables_by_teacher
+from academics.models import Student, Section, AcademicYear
+from courseevaluations.models import EvaluationSet, Evaluable, CompletionCounter, CourseEvaluation, IIPEvaluation, DormParentEvaluation, StudentEmailTemplate
+from courseevaluations.lib.async import send_student_email_from_template, send_student_emails_from_template, send_confirmation_email, send_msg, send_msgs
+from courseevaluations.lib.mailing import send_timeout
+from courseevaluations.lib.reporting import get_incomplete_evaluables_report, get_advisor_tutor_status
 
 from django.contrib.auth.decorators import permission_required
 
 import django_rq
 
-import courseevaluations.lib.reporting
-
 @permission_required('courseevaluations.can_view_status_reports')
 def index(request):
     evaluation_sets = EvaluationSet.objects.all()
+    totals = CompletionCounter.objects.totals()
     
     flattened_evaluation_sets = []
     
     for evaluation_set in evaluation_sets:
+        complete_count, incomplete_count = totals.get(evaluation_set.id, (0, 0))
+        
         flattened_evaluation_sets.append({
             'evaluation_set': evaluation_set, 
-            'complete_count': evaluation_set.evaluable_set.filter(complete=True).count(), 
-            'incomplete_count': evaluation_set.evaluable_set.filter(complete=False).count(), 
-            'total_count': evaluation_set.evaluable_set.count(), 
+            'complete_count': complete_count, 
+            'incomplete_count': incomplete_count, 
+            'total_count': complete_count + incomplete_count, 
         })
     
     return render(request, "courseevaluations/reports/index.html", {'evaluation_sets': flattened_evaluation_sets})
@@ -42,17 +44,22 @@ def index(request):
 def evaluation_set_index(request, id):
     evaluation_set = get_object_or_404(EvaluationSet, pk=id)
     
-    evaluables = Evaluable.objects.filter(evaluation_set=evaluation_set)
+    counters = list(CompletionCounter.objects.filter(evaluation_set=evaluation_set).select_related('evaluable_type'))
     
-    complete_evaluables = evaluables.filter(complete=True)
-    incomplete_evaluables = evaluables.filter(complete=False)
+    for counter in counters:
+        counter.evaluation_type_title_plural = counter.evaluable_type.model_class().evaluation_type_title_plural
+    
+    complete_count = sum(counter.complete_count for counter in counters)
+    incomplete_count = sum(counter.incomplete_count for counter in counters)
+    total_count = complete_count + incomplete_count
     
     template_vars = {
-        'evaluables': evaluables,
-        'evaluables_complete': complete_evaluables, 
-        'evaluables_incomplete': incomplete_evaluables,
+        'counters': sorted(counters, key=lambda counter: counter.evaluation_type_title_plural),
+        'complete_count': complete_count, 
+        'incomplete_count': incomplete_count,
+        'total_count': total_count,
         'evaluation_set': evaluation_set,
-        'percent_completed': (complete_evaluables.count() / evaluables.count() * 100),
+        'percent_completed': total_count and (complete_count / total_count * 100) or 0,
         'student_email_templates': StudentEmailTemplate.objects.all()
     }
     
@@ -110,11 +117,9 @@ def by_student(request, id, show_evaluables):
 def by_section(request, id):
     evaluation_set = get_object_or_404(EvaluationSet, pk=id)
     
-    data = courseevaluations.lib.reporting.get_incomplete_evaluables_by_teacher(evaluation_set)
-    
-    flattened_data = courseevaluations.lib.reporting.flatten_evaluables_by_teacher(data)
+    report_data = get_incomplete_evaluables_report(evaluation_set)
     
-    template_vars = {'report_data': flattened_data, 'evaluation_set': evaluation_set}
+    template_vars = {'report_data': report_data, 'evaluation_set': evaluation_set}
         
     return render(request, "courseevaluations/reports/by_section.html", template_vars)
 
@@ -144,7 +149,8 @@ def send_student_email(request):
         
         for student in students:
             to_students.append(student)
-            django_rq.enqueue(send_student_email_from_template, template.id, student.id, override_email=request.user.email)
+        
+        django_rq.enqueue(send_student_emails_from_template, template.id, [student.id for student in to_students], override_email=request.user.email, timeout=send_timeout(len(to_students)))
             
         return HttpResponse("All {count:} student e-mails have been generated and are being redirected to you.".format(count=len(to_students)), content_type="text/plain")
             
@@ -156,9 +162,10 @@ def send_student_email(request):
         
         for student in students:
             to_students.append(student)
-            django_rq.enqueue(send_student_email_from_template, template.id, student.id)
             confirmation_addresses.append(student.email)
         
+        django_rq.enqueue(send_student_emails_from_template, template.id, [student.id for student in to_students], timeout=send_timeout(len(to_students)))
+        
         django_rq.enqueue(send_confirmation_email, confirmation_addresses, [request.user.email])
         
         return HttpResponse("All {count:} student e-mails have been generated and are on their way.".format(count=len(to_students)), content_type="text/plain")
@@ -170,10 +177,10 @@ def send_teacher_per_section_email(request):
     
     evaluation_set = EvaluationSet.objects.get(pk=evaluation_set_id)
     
-    data = get_incomplete_evaluables_by_teacher(evaluation_set)
+    data = get_incomplete_evaluables_report(evaluation_set)
     confirmation_addresses = []
     
-    def generate_message(teacher):
+    def generate_message(teacher, groups):
         body = StringIO()
         
         body.write("Incomplete evaluations for {}\n\n".format(teacher.name))
@@ -181,32 +188,14 @@ def send_teacher_per_section_email(request):
         msg = EmailMessage()
         msg.to = [teacher.email]
         
-        if 'course' in data[teacher]:
-            for section in sorted(data[teacher]['course'].keys(), key=lambda sec: (sec.course.course_name, sec.csn)):
-                body.write("{course:}: {csn:}\n".format(course=section.course.course_name, csn=section.csn))
+        for group, students in groups:
+            body.write("{group:}\n".format(group=group))
                 
-                for student in sorted(data[teacher]['course'][section], key=lambda stu: (stu.last_name, stu.first_name)):
-                    body.write("\t {first:} {last:}\n".format(first=student.first_name, last=student.last_name))
-                
-                body.write("\n")
-        
-        if 'iip' in data[teacher]:
-            body.write("IIP\n")
-            
-            for student in sorted(data[teacher]['iip'], key=lambda stu: (stu.last_name, stu.first_name)):
+            for student in students:
                 body.write("\t {first:} {last:}\n".format(first=student.first_name, last=student.last_name))
             
             body.write("\n")
         
-        if 'dorm' in data[teacher]:
-            for dorm in sorted(data[teacher]['dorm'].keys(), key=lambda d: (str(d))):
-                body.write(str(dorm) + "\n")
-                
-                for student in sorted(data[teacher]['dorm'][dorm], key=lambda stu: (stu.last_name, stu.first_name)):
-                    body.write("\t {first:} {last:}\n".format(first=student.first_name, last=student.last_name))
-                
-                body.write("\n")
-        
         msg.subject = "Students that have not completed their evaluations for you"
         msg.body = body.getvalue()
         msg.from_email = "technology@rectoryschool.org"
@@ -214,8 +203,7 @@ def send_teacher_per_section_email(request):
         return msg
     
     if operation == 'sample':
-        teacher = choice(list(data.keys()))
-        msg = generate_message(teacher)
+        msg = generate_message(*choice(data))
         msg.to = [request.user.email]
         
         django_rq.enqueue(send_msg, msg)
@@ -223,20 +211,26 @@ def send_teacher_per_section_email(request):
         return HttpResponse("Your sample is on the way", content_type="text/plain")
     
     elif operation == 'redirect':
-        for teacher in data:
-            msg = generate_message(teacher)
+        messages = []
+        
+        for teacher, groups in data:
+            msg = generate_message(teacher, groups)
             msg.to = [request.user.email]
+            messages.append(msg)
         
-            django_rq.enqueue(send_msg, msg)
+        django_rq.enqueue(send_msgs, messages, timeout=send_timeout(len(messages)))
         
         return HttpResponse("All {count:} teacher e-mails have been generated and are being redirected to you.".format(count=len(data)), content_type="text/plain")
     
     elif operation == 'send':
-        for teacher in data:
-            msg = generate_message(teacher)
+        messages = []
+        
+        for teacher, groups in data:
+            msg = generate_message(teacher, groups)
             confirmation_addresses.extend(msg.to)
+            messages.append(msg)
             
-            django_rq.enqueue(send_msg, msg)
+        django_rq.enqueue(send_msgs, messages, timeout=send_timeout(len(messages)))
         
         django_rq.enqueue(send_confirmation_email, confirmation_addresses, [request.user.email])
         
@@ -253,51 +247,21 @@ def send_advisor_tutor_status(request):
     operation = request.POST['send_type']
     
     evaluation_set = EvaluationSet.objects.get(pk=evaluation_set_id)
-    iip_courses = Course.objects.filter(number__in=iip_course_numbers)
     academic_year = AcademicYear.objects.current()
     
-    evaluables = Evaluable.objects.filter(evaluation_set=evaluation_set).prefetch_related('student')
-    students = {}
+    teacher_student_mapping = get_advisor_tutor_status(evaluation_set, academic_year, iip_course_numbers)
     
     confirmation_addresses = []
     
-    for evaluable in evaluables:
-        if evaluable.student not in students:
-            students[evaluable.student] = {'complete': [], 'incomplete': []}
-        
-        if evaluable.complete:
-            students[evaluable.student]['complete'].append(evaluable)
-        else:
-            students[evaluable.student]['incomplete'].append(evaluable)
-    
-    teacher_student_mapping = {}
-    
-    for student in students:
-        enrollment = Enrollment.objects.get(student=student, academic_year=academic_year)
-        advisor = enrollment.advisor
-        if not advisor in teacher_student_mapping:
-            teacher_student_mapping[advisor] = {}
-        
-        teacher_student_mapping[advisor][student] = students[student]
-        
-        iip_registrations = StudentRegistration.objects.filter(section__course__in=iip_courses, student=student, section__academic_year=academic_year)
-        for registration in iip_registrations:
-            tutor = registration.section.teacher
-            if not tutor in teacher_student_mapping:
-                teacher_student_mapping[tutor] = {}
-            
-            teacher_student_mapping[tutor][student] = students[student]
-    
     def generate_message(teacher):
         any_incomplete = False
         status_lines = []
         
         for student in sorted(teacher_student_mapping[teacher], key=lambda s: (s.last_name, s.first_name)):
-            complete_count = len(teacher_student_mapping[teacher][student]['complete'])
-            incomplete_count = len(teacher_student_mapping[teacher][student]['incomplete'])
-            total_count = complete_count + incomplete_count
+            complete_count, total_count = teacher_student_mapping[teacher][student]
+            incomplete_count = total_count - complete_count
             
-            if teacher_student_mapping[teacher][student]['incomplete']:    
+            if incomplete_count:
                 any_incomplete = True
                 status_lines.append("{student:}: {complete_count:}/{total_count:} complete".format(student=student.name, complete_count=complete_count, incomplete_count=incomplete_count, total_count=total_count))
             else:
@@ -326,20 +290,26 @@ def send_advisor_tutor_status(request):
         return HttpResponse("Your sample is on the way", content_type="text/plain")
     
     elif operation == 'redirect':
+        messages = []
+        
         for teacher in teacher_student_mapping:
             msg = generate_message(teacher)
             msg.to = [request.user.email]
+            messages.append(msg)
         
-            django_rq.enqueue(send_msg, msg)
+        django_rq.enqueue(send_msgs, messages, timeout=send_timeout(len(messages)))
         
         return HttpResponse("All {count:} advisor/tutor e-mails have been generated and are being redirected to you.".format(count=len(teacher_student_mapping)), content_type="text/plain")
     
     elif operation == 'send':
+        messages = []
+        
         for teacher in teacher_student_mapping:
             msg = generate_message(teacher)
             confirmation_addresses.extend(msg.to)
+            messages.append(msg)
             
-            django_rq.enqueue(send_msg, msg)
+        django_rq.enqueue(send_msgs, messages, timeout=send_timeout(len(messages)))
         
         django_rq.enqueue(send_confirmation_email, confirmation_addresses, [request.user.email])
         
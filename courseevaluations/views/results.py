@@ -1,28 +1,28 @@
 #!/usr/bin/python
 
-from io import BytesIO
-from zipfile import ZipFile, ZIP_STORED
-
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.contrib.auth.decorators import permission_required
 
 from academics.models import Course, Section, Teacher, Dorm, Grade
 from courseevaluations.models import Evaluable, CourseEvaluation, DormParentEvaluation, IIPEvaluation, EvaluationSet
 
-from courseevaluations.lib.results import build_report
+from courseevaluations.lib.results import build_report, load_report_data, render_reports, stream_zip
 
 @permission_required('courseevaluations.can_view_results')
 def zip_teacher_course(request, evaluation_set_id):
     evaluation_set = EvaluationSet.objects.get(pk=evaluation_set_id)
     
-    evaluables = CourseEvaluation.objects.filter(evaluation_set=evaluation_set)
+    #Group the evaluable ids by teacher and course from two queries, whatever the size of the set
+    sections = Section.objects.filter(courseevaluation__evaluation_set=evaluation_set).distinct().select_related('teacher', 'course')
+    sections = dict((section.id, section) for section in sections)
     
     by_teacher = {}
     
-    for course_evaluation in evaluables:
-        teacher = course_evaluation.section.teacher
-        course = course_evaluation.section.course
+    for evaluable_id, section_id in CourseEvaluation.objects.filter(evaluation_set=evaluation_set).order_by('id').values_list('id', 'section_id'):
+        teacher = sections[section_id].teacher
+        course = sections[section_id].course
         
         if not teacher in by_teacher:
             by_teacher[teacher] = {}
@@ -30,10 +30,9 @@ def zip_teacher_course(request, evaluation_set_id):
         if not course in by_teacher[teacher]:
             by_teacher[teacher][course] = []
         
-        by_teacher[teacher][course].append(course_evaluation)
+        by_teacher[teacher][course].append(evaluable_id)
     
-    out = BytesIO()
-    with ZipFile(out, mode='w', compression=ZIP_STORED) as zip_file:
+    def reports():
         for teacher in by_teacher:
             for course in by_teacher[teacher]:
                 evaluables = by_teacher[teacher][course]
@@ -43,9 +42,6 @@ def zip_teacher_course(request, evaluation_set_id):
                     evaluation_set=evaluation_set.name
                     )
                 
-                
-                report_file = BytesIO()
-                build_report(report_file, evaluables, title)
                 file_name = "{department:}/{last_name:}, {first_name:}/{course:}.pdf".format(
                     department = course.department,
                     last_name = teacher.last_name,
@@ -53,12 +49,11 @@ def zip_teacher_course(request, evaluation_set_id):
                     course=course.course_name,
                 )
                 
-                zip_file.writestr(file_name, report_file.getvalue())
+                yield file_name, load_report_data(evaluables), title
     
-    response = HttpResponse(content_type='application/zip')
+    response = StreamingHttpResponse(stream_zip(render_reports(reports(), max_workers=settings.REPORT_RENDER_WORKERS)), content_type='application/zip')
     response['Content-Disposition'] = 'filename="Course Evaluations by Department, Teacher, and Course for {evaluation_set:}.zip"'.format(evaluation_set=evaluation_set.name)
     
-    response.write(out.getvalue())
     return response
 
 @permission_required('courseevaluations.can_view_results')
@@ -193,20 +188,20 @@ def iip(request, evaluation_set_id, teacher_id):
 def zip_iip(request, evaluation_set_id):
     evaluation_set = EvaluationSet.objects.get(pk=evaluation_set_id)
     
-    evaluables = IIPEvaluation.objects.filter(evaluation_set=evaluation_set)
+    teachers = Teacher.objects.filter(iipevaluation__evaluation_set=evaluation_set).distinct()
+    teachers = dict((teacher.id, teacher) for teacher in teachers)
     
     by_teacher = {}
     
-    for iip_evaluation in evaluables:
-        teacher = iip_evaluation.teacher
+    for evaluable_id, teacher_id in IIPEvaluation.objects.filter(evaluation_set=evaluation_set).order_by('id').values_list('id', 'teacher_id'):
+        teacher = teachers[teacher_id]
         
         if not teacher in by_teacher:
             by_teacher[teacher] = []
         
-        by_teacher[teacher].append(iip_evaluation)
+        by_teacher[teacher].append(evaluable_id)
     
-    out = BytesIO()
-    with ZipFile(out, mode='w', compression=ZIP_STORED) as zip_file:
+    def reports():
         for teacher in by_teacher:
             evaluables = by_teacher[teacher]
             title = "IIP with {teacher:} ({evaluation_set:})".format(
@@ -214,20 +209,16 @@ def zip_iip(request, evaluation_set_id):
                 evaluation_set=evaluation_set.name
                 )
             
-            
-            report_file = BytesIO()
-            build_report(report_file, evaluables, title)
             file_name = "{last_name:}, {first_name:}.pdf".format(
                 last_name = teacher.last_name,
                 first_name=teacher.first_name,
             )
             
-            zip_file.writestr(file_name, report_file.getvalue())
+            yield file_name, load_report_data(evaluables), title
     
-    response = HttpResponse(content_type='application/zip')
+    response = StreamingHttpResponse(stream_zip(render_reports(reports(), max_workers=settings.REPORT_RENDER_WORKERS)), content_type='application/zip')
     response['Content-Disposition'] = 'filename="IIP Evaluations by Teacher for {evaluation_set:}.zip"'.format(evaluation_set=evaluation_set.name)
     
-    response.write(out.getvalue())
     return response
 
 @permission_required('courseevaluations.can_view_results')
@@ -300,13 +291,16 @@ def dorm_parent_parent(request, evaluation_set_id, parent_id):
 def zip_dorm_parent_dorm_dorm_parent(request, evaluation_set_id):
     evaluation_set = EvaluationSet.objects.get(pk=evaluation_set_id)
     
-    evaluables = DormParentEvaluation.objects.filter(evaluation_set=evaluation_set)
+    evaluables = DormParentEvaluation.objects.filter(evaluation_set=evaluation_set).order_by('id')
+    
+    dorms = Dorm.objects.in_bulk(list(evaluables.values_list('dorm_id', flat=True).distinct()))
+    parents = Teacher.objects.in_bulk(list(evaluables.values_list('parent_id', flat=True).distinct()))
     
     by_dorm = {}
     
-    for dorm_parent_evaluation in evaluables:
-        dorm = dorm_parent_evaluation.dorm
-        parent = dorm_parent_evaluation.parent
+    for evaluable_id, dorm_id, parent_id in evaluables.values_list('id', 'dorm_id', 'parent_id'):
+        dorm = dorms[dorm_id]
+        parent = parents[parent_id]
         
         if not dorm in by_dorm:
             by_dorm[dorm] = {}
@@ -314,10 +308,9 @@ def zip_dorm_parent_dorm_dorm_parent(request, evaluation_set_id):
         if not parent in by_dorm[dorm]:
             by_dorm[dorm][parent] = []
         
-        by_dorm[dorm][parent].append(dorm_parent_evaluation)
+        by_dorm[dorm][parent].append(evaluable_id)
     
-    out = BytesIO()
-    with ZipFile(out, mode='w', compression=ZIP_STORED) as zip_file:
+    def reports():
         for dorm in by_dorm:
             for parent in by_dorm[dorm]:
                 evaluables = by_dorm[dorm][parent]
@@ -327,20 +320,17 @@ def zip_dorm_parent_dorm_dorm_parent(request, evaluation_set_id):
                     evaluation_set=evaluation_set.name
                     )
                 
-                report_file = BytesIO()
-                build_report(report_file, evaluables, title)
                 file_name = "{dorm:}/{last_name:}, {first_name:}.pdf".format(
                     dorm = str(dorm),
                     last_name = parent.last_name,
                     first_name=parent.first_name,
                 )
                 
-                zip_file.writestr(file_name, report_file.getvalue())
+                yield file_name, load_report_data(evaluables), title
     
-    response = HttpResponse(content_type='application/zip')
+    response = StreamingHttpResponse(stream_zip(render_reports(reports(), max_workers=settings.REPORT_RENDER_WORKERS)), content_type='application/zip')
     response['Content-Disposition'] = 'filename="Dorm Evaluations by Dorm and Parent for {evaluation_set:}.zip"'.format(evaluation_set=evaluation_set.name)
     
-    response.write(out.getvalue())
     return response
 
 @permission_required('courseevaluations.can_view_results')
@@ -48,6 +48,11 @@ ALLOWED_HOSTS = [host.strip() for host in config['production'].get('ALLOWED_HOST
 
 STATICFILES_STORAGE = config['files']['STORAGE']
 
+#Decoded Keystone exports, keyed by file digest so re-reading an export skips the XML parse.
+#The cache holds pickles, so the directory must be private to the user running the imports.
+EXPORT_CACHE_DIR = config['files'].get('EXPORT_CACHE_DIR', os.path.join(BASE_DIR, 'export-cache'))
+EXPORT_CACHE_MAX_SIZE = config.getint('files', 'EXPORT_CACHE_MAX_SIZE', fallback=256 * 1024 * 1024)
+
 EMAIL_BACKEND = config['email'].get('BACKEND', 'django.core.mail.backends.console.EmailBackend')
 SERVER_EMAIL = config['email'].get('SERVER_ADDRESS', 'root@localhost')
 
@@ -62,6 +67,12 @@ SECRET_KEY = config['django']['SECRET_KEY']
 
 IIP_COURSE_IDS = config['courseevaluations']['IIP_COURSE_IDS']
 
+#Processes rendering the PDFs of the zipped result downloads; 0 means one per CPU
+REPORT_RENDER_WORKERS = config.getint('courseevaluations', 'REPORT_RENDER_WORKERS', fallback=0) or None
+
+#How fast the evaluation e-mail jobs hand messages to the mail backend; SES rejects anything over the account's sending rate
+EMAIL_MESSAGES_PER_SECOND = config.getfloat('courseevaluations', 'EMAIL_MESSAGES_PER_SECOND', fallback=1.0)
+
 INSTALLED_APPS = (
     'django.contrib.admin',
     'django.contrib.auth',
@@ -10,17 +10,18 @@ from validate_email import validate_email
 
 from academics.models import Enrollment, AcademicYear
 from seating_charts.models import SeatingStudent
+from academics.utils.instrumentation import InstrumentedCommand, counted
 
 logger = logging.getLogger(__name__)
 
-class Command(BaseCommand):
+class Command(InstrumentedCommand):
   help = "Sync academic students with seating students"
   
   def handle(self, *args, **kwargs):
     academic_year = AcademicYear.objects.current()
     current_enrollments = Enrollment.objects.filter(student__current=True, academic_year=academic_year)
     
-    for enrollment in current_enrollments:
+    for enrollment in counted(current_enrollments):
       #Get the seating student based on the student, not the enrollment
       try:
         seating_student = SeatingStudent.objects.get(enrollment__student=enrollment.student)